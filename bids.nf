@@ -8,7 +8,9 @@ bindings = [ "rewrite":"$params.rewrite",
              "descriptor":"$params.descriptor",
              "invocation":"$params.invocation",
              "license":"$params.license",
-             "resources": "$params.resources"]
+             "resources": "$params.resources",
+             "batch_time": "$params.batch_time",
+             "batch_size": "$params.batch_size"]
 
 engine = new groovy.text.SimpleTemplateEngine()
 toprint = engine.createTemplate(usage.text).make(bindings)
@@ -64,45 +66,46 @@ process save_invocation{
 }
 
 
-process modify_invocation{
-
-    input:
-
-    val sub
-    output:
-    tuple val(sub), path("${sub}.json"), emit: json
-
-    """
-
-    #!/usr/bin/env python
-
-    import json
-    import sys
+// Staged inputs are a single path when only one file is given
+def as_list(x){
+    return (x instanceof java.nio.file.Path) ? [x] : x.collect{ it }
+}
 
-    out_file = '${sub}.json'
-    invoke_file = '${params.invocation}'
+// Walltime in minutes as H:MM:SS, for queue selection
+def hms(minutes){
+    return "${minutes.intdiv(60)}:${(minutes % 60).toString().padLeft(2,'0')}:00"
+}
 
-    x = '${sub}'.replace('sub-','')
 
-    with open(invoke_file,'r') as f:
-        j_dict = json.load(f)
+process plan_bids{
 
-    j_dict.update({'participant_label' : [x]})
+    input:
+    path fallback
 
-    with open(out_file,'w') as f:
-        json.dump(j_dict,f,indent=4)
+    output:
+    path "plan.tsv", emit: plan
+    path "invocations/*.json", emit: invocations
 
-    """
+    shell:
+    '''
+    plan_bids.py !{params.bids} !{params.invocation} !{fallback} \
+        --logs !{params.out}/pipeline_logs/!{params.application} \
+        --batch-time !{params.batch_time} \
+        --batch-size !{params.batch_size} \
+        --default-mem-mb !{params.default_mem_mb}
+    '''
 }
 
 
 process run_bids{
 
-    time { params.cluster_time(s) }
-    queue { params.cluster_queue(s) }
+    tag { as_list(sub_inputs).collect{ it.getBaseName() }.join(",") }
+    time { "${minutes * task.attempt}m" }
+    memory { "${mem_mb * task.attempt} MB" }
+    queue { params.cluster_queue(hms(minutes * task.attempt)) }
 
     input:
-    tuple path(sub_input), val(s)
+    tuple val(batch), val(minutes), val(mem_mb), path(sub_inputs)
 
     scratch params.scratchDir
     stageInMode 'copy'
@@ -117,28 +120,57 @@ process run_bids{
     logging_dir=!{params.out}/pipeline_logs/!{params.application}
     mkdir -p ${logging_dir}
 
-    #Set up logging output
-    sub_json=!{sub_input}
-    sub=${sub_json%.json}
-    log_out=${logging_dir}/${sub}.out
-    log_err=${logging_dir}/${sub}.err
-
-
-    echo "TASK ATTEMPT !{task.attempt}" >> ${log_out}
-    echo "============================" >> ${log_out}
-    echo "TASK ATTEMPT !{task.attempt}" >> ${log_err}
-    echo "============================" >> ${log_err}
-
-    mkdir work
-    bosh exec launch \
-    -v !{params.bids}:/bids \
-    -v !{params.out}:/output \
-    -v !{params.license}:/license \
-    !{ (params.resources) ? "-v $params.resources:/resources" : ""} \
-    -v $(pwd)/work:/work \
-    !{params.descriptor} $(pwd)/!{sub_input} \
-    --imagepath !{params.simg} -x --stream 2>> ${log_out} \
-                                           1>> ${log_err}
+    # Subjects completed by an earlier attempt of this run (or of the run
+    # it resumes) are marked, so a retry only runs the ones that failed
+    done_dir=${logging_dir}/completed/!{workflow.sessionId}
+    mkdir -p ${done_dir}
+
+    # Subjects of the batch run one after the other, the batch fails if any
+    # of them did
+    failed=0
+    for sub_json in !{as_list(sub_inputs).join(" ")}; do
+
+        #Set up logging output
+        sub=${sub_json%.json}
+        log_out=${logging_dir}/${sub}.out
+        log_err=${logging_dir}/${sub}.err
+
+        if [ -f ${done_dir}/${sub} ]; then
+            echo "Completed in an earlier attempt, skipping" >> ${log_out}
+            continue
+        fi
+
+        echo "TASK ATTEMPT !{task.attempt}" >> ${log_out}
+        echo "============================" >> ${log_out}
+        echo "TASK ATTEMPT !{task.attempt}" >> ${log_err}
+        echo "============================" >> ${log_err}
+
+        start=${SECONDS}
+        mkdir -p work/${sub}
+        bosh exec launch \
+        -v !{params.bids}:/bids \
+        -v !{params.out}:/output \
+        -v !{params.license}:/license \
+        !{ (params.resources) ? "-v $params.resources:/resources" : ""} \
+        -v $(pwd)/work/${sub}:/work \
+        !{params.descriptor} $(pwd)/${sub_json} \
+        --imagepath !{params.simg} -x --stream 2>> ${log_out} \
+                                               1>> ${log_err}
+        status=$?
+        rm -rf work/${sub}
+
+        # Runtime history the next plan learns from
+        echo -e "${sub}\t$((SECONDS - start))\t${status}\t$(date +%s)" \
+            >> ${logging_dir}/runtime_history.tsv
+
+        if [ ${status} -eq 0 ]; then
+            touch ${done_dir}/${sub}
+        else
+            failed=1
+        fi
+    done
+
+    exit ${failed}
 
     '''
 }
@@ -177,19 +209,29 @@ workflow {
 
     main:
 
-    // Pull # of sessions per subject
-    sub_ses_channel = input_channel
-                        .map{ s ->[
-                                   s,
-                                   new File("$params.bids/$s/").listFiles().size()
-                                  ]
-                            }
+    // Configured walltime of each subject, used until it has a history
+    fallback = input_channel
+                    .map{ s ->
+                        def n = new File("$params.bids/$s/").listFiles().size()
+                        "${s}\t${params.cluster_time(n)}\n"
+                    }
+                    .collectFile(name: "fallback.tsv")
 
     save_invocation(params.invocation)
-    modify_invocation(input_channel)
-
-    run_bids_input = modify_invocation.out.json
-                                .join(sub_ses_channel, by: 0)
-                                .map { s,i,n -> [i, n]}
+    plan_bids(fallback)
+
+    // Batches of subjects sized from their past runtimes
+    invocations = plan_bids.out.invocations
+                            .flatten()
+                            .map{ i -> [i.getBaseName(), i] }
+    run_bids_input = plan_bids.out.plan
+                            .splitCsv(sep: "\t", header: true)
+                            .flatMap{ r -> r.subjects.tokenize(",").collect{ s ->
+                                [s, r.batch, r.minutes.toInteger(),
+                                r.mem_mb.toInteger()]
+                            }}
+                            .join(invocations, by: 0)
+                            .map{ s,b,m,mem,i -> [b,m,mem,i] }
+                            .groupTuple(by: [0,1,2])
     run_bids(run_bids_input)
 }
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+
+from confounds import (init_batch_confound_wf, _read_run_info, _read_tr,
+                       ROI_PARAMS, ACOMPCOR_PARAMS)
+from profiling import init_profiler, measure
+from execution import (add_engine_args, add_execution_args, task_resources,
+                       limit_threads, run_workflow)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Extract confounds from WM and CSF for all BOLD runs '
+        'of a subject, sharing the T1 space ROIs across runs')
+    parser.add_argument('t1', type=str, help='T1 image')
+    parser.add_argument('t1_mask', type=str, help='Binary brain mask')
+    parser.add_argument('wm_tpm',
+                        type=str,
+                        help='White matter tissue probability map')
+    parser.add_argument('csf_tpm', type=str, help='CSF tissue probability map')
+    parser.add_argument('--run',
+                        nargs=4,
+                        action='append',
+                        required=True,
+                        metavar=('BOLD', 'BOLD_MASK', 'BOLD_JSON',
+                                 'OUT_BASENAME'),
+                        help='BOLD image, BOLD mask, BOLD JSON metadata file '
+                        'and output file path with basename of a run. '
+                        'Can be repeated')
+    parser.add_argument('--workdir',
+                        type=str,
+                        help='Path to use for workdir'
+                        ' this path must already exist')
+    parser.add_argument('--resample-cache',
+                        type=str,
+                        help='Directory to cache T1 to BOLD grid resampling '
+                        'index maps in, can be shared across runs and '
+                        'subjects')
+    parser.add_argument('--profile-out',
+                        type=str,
+                        help='JSON file to write per-node wall time, CPU '
+                        'time, peak RSS, I/O and cache reuse records to')
+    add_engine_args(parser)
+    add_execution_args(parser)
+
+    args = parser.parse_args()
+    if args.acompcor_svd != 'full' and args.engine != 'direct':
+        parser.error('--acompcor-svd truncated requires --engine direct')
+    profiler = init_profiler(args.profile_out)
+    nprocs, mem_gb = task_resources(args.nprocs, args.mem_gb)
+    limit_threads()
+
+    if args.engine == 'direct':
+        from direct import build_anat_rois, run_bold_confounds
+        with measure(profiler, 'build_anat_rois'):
+            rois = build_anat_rois(args.t1_mask, args.wm_tpm, args.csf_tpm,
+                                   ROI_PARAMS)
+        for bold, bold_mask, bold_json, outbase in args.run:
+            with measure(profiler,
+                         f'run_bold_confounds.{os.path.basename(outbase)}'):
+                run_bold_confounds(rois,
+                                   bold,
+                                   bold_mask,
+                                   _read_tr(bold_json),
+                                   outbase,
+                                   ACOMPCOR_PARAMS,
+                                   resample_cache=args.resample_cache,
+                                   svd=args.acompcor_svd)
+        return
+
+    runs = []
+    for bold, bold_mask, bold_json, outbase in args.run:
+        with measure(profiler, f'read_run_info.{os.path.basename(outbase)}'):
+            tr, skipvol = _read_run_info(bold, bold_json)
+        runs.append({
+            'bold': bold,
+            'bold_mask': bold_mask,
+            'tr': tr,
+            'skip_vols': skipvol,
+            'out_basename': outbase
+        })
+
+    batch_dir = os.path.join(args.workdir, 'batch_confound_wf')
+    try:
+        os.makedirs(batch_dir)
+    except OSError:
+        pass
+
+    wf = init_batch_confound_wf(args.t1,
+                                args.t1_mask,
+                                args.wm_tpm,
+                                args.csf_tpm,
+                                runs,
+                                resample_cache=args.resample_cache)
+    wf.base_dir = batch_dir
+    run_workflow(wf, profiler, nprocs=nprocs, mem_gb=mem_gb)
+
+
+if __name__ == '__main__':
+    main()
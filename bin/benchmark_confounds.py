@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+"""
+Benchmark the stages of the confound workflow on synthetic data
+
+Generates a T1 space brain mask, WM/CSF tissue probability maps and a BOLD
+series with its mask, then runs every interface of init_confound_wf on them
+in turn. Each stage runs in its own freshly spawned process so the wall time
+and the peak RSS of every stage are recorded separately. Results are written as JSON
+and can be compared against an earlier run with --compare.
+
+Runs offline, without a container, as long as the Python dependencies of
+confounds.py are installed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import multiprocessing as mp
+from queue import Empty
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import nibabel as nib
+
+# Field of view of the synthetic head, in mm
+FOV = (182, 218, 182)
+
+# Semi-axes of the ellipsoidal brain, in mm
+BRAIN_RADII = (70., 90., 65.)
+
+# Seconds between checks that a stage's process is still alive
+POLL_SECONDS = 5
+
+PACKAGES = ['nipype', 'niworkflows', 'nilearn', 'nibabel', 'numpy', 'scipy']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Time the stages of the confound workflow and record '
+        'their peak memory on synthetic data')
+    parser.add_argument('out_json', type=str, help='Output JSON file')
+    parser.add_argument('--workdir',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Directory to write fixtures and stage '
+                        'outputs to (default: current directory)')
+    parser.add_argument('--bold-zoom',
+                        type=float,
+                        default=3.0,
+                        help='BOLD voxel size in mm (default: 3.0)')
+    parser.add_argument('--n-vols',
+                        type=int,
+                        default=300,
+                        help='Number of BOLD volumes (default: 300)')
+    parser.add_argument('--tr',
+                        type=float,
+                        default=2.0,
+                        help='BOLD repetition time in s (default: 2.0)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='Number of times to run each stage, the '
+                        'fastest run is reported (default: 1)')
+    parser.add_argument('--stage-timeout',
+                        type=float,
+                        default=3600,
+                        help='Seconds after which a stage is killed and the '
+                        'benchmark fails (default: 3600)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--compare',
+                        type=str,
+                        help='Earlier benchmark JSON to compare against')
+
+    args = parser.parse_args()
+
+    fixture_dir = os.path.join(args.workdir, 'fixtures')
+    fixtures = make_fixtures(fixture_dir,
+                             bold_zoom=args.bold_zoom,
+                             n_vols=args.n_vols,
+                             tr=args.tr,
+                             seed=args.seed)
+
+    stages = run_stages(fixtures, os.path.join(args.workdir, 'stages'),
+                        args.tr, args.repeat, args.stage_timeout)
+
+    results = OrderedDict([
+        ('created', datetime.now().isoformat()),
+        ('host', platform.node()),
+        ('python', platform.python_version()),
+        ('versions', _package_versions()),
+        ('fixtures', OrderedDict([('bold_zoom', args.bold_zoom),
+                                  ('n_vols', args.n_vols), ('tr', args.tr),
+                                  ('seed', args.seed),
+                                  ('bold_shape',
+                                   list(nib.load(fixtures['bold']).shape))])),
+        ('repeat', args.repeat),
+        ('stages', stages),
+    ])
+
+    with open(args.out_json, 'w') as f:
+        json.dump(results, f, indent=3)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print_comparison(json.load(f), results)
+    else:
+        print_comparison(None, results)
+
+
+def make_fixtures(out_dir, bold_zoom=3.0, n_vols=300, tr=2.0, seed=0):
+    '''
+    Write a synthetic 1 mm T1 space brain mask, T1w, WM and CSF tissue
+    probability maps, and a BOLD series with its mask and JSON sidecar
+
+    The brain is an ellipsoid with CSF in its centre and on its surface and
+    a WM shell in between, so that the ROI erosions have something to erode.
+    Returns a dictionary of the written file paths
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+
+    # T1 space, 1 mm isotropic
+    t1_affine = _grid_affine(1.0)
+    r = _brain_radius(FOV, t1_affine)
+    mask = r < 1
+
+    wm = np.clip((0.2 - np.abs(r - 0.55)) / 0.05, 0, 1)
+    csf = np.clip((0.2 - r) / 0.05, 0, 1) + np.clip((r - 0.85) / 0.05, 0, 1)
+    wm = np.clip(wm + 0.02 * rng.randn(*FOV), 0, 1) * mask
+    csf = np.clip(csf + 0.02 * rng.randn(*FOV), 0, 1) * mask
+    t1 = (1000 * wm + 700 * (1 - wm - csf).clip(0) + 300 * csf) * mask
+
+    fixtures = {
+        't1_mask': _save(mask.astype(np.uint8), t1_affine, out_dir,
+                         't1_mask.nii.gz'),
+        't1': _save(t1.astype(np.float32), t1_affine, out_dir,
+                    't1.nii.gz'),
+        'wm_tpm': _save(wm.astype(np.float32), t1_affine, out_dir,
+                        'wm_tpm.nii.gz'),
+        'csf_tpm': _save(csf.astype(np.float32), t1_affine, out_dir,
+                         'csf_tpm.nii.gz')
+    }
+    del r, mask, wm, csf, t1
+
+    # BOLD space, offset by half a voxel from the T1 grid
+    bold_affine = _grid_affine(bold_zoom)
+    bold_affine[:3, 3] += bold_zoom / 2
+    shape = tuple(int(np.ceil(f / bold_zoom)) for f in FOV)
+    r = _brain_radius(shape, bold_affine)
+    bold_mask = r < 1
+
+    fixtures['bold_mask'] = _save(bold_mask.astype(np.uint8), bold_affine,
+                                  out_dir, 'bold_mask.nii.gz')
+    fixtures['bold'] = _write_bold(os.path.join(out_dir, 'bold.nii'), r,
+                                   bold_affine, n_vols, tr, rng)
+
+    fixtures['bold_json'] = os.path.join(out_dir, 'bold.json')
+    with open(fixtures['bold_json'], 'w') as f:
+        json.dump({'RepetitionTime': tr}, f)
+
+    return fixtures
+
+
+def _grid_affine(zoom):
+    affine = np.diag([zoom, zoom, zoom, 1.])
+    affine[:3, 3] = [-f / 2. for f in FOV]
+    return affine
+
+
+def _brain_radius(shape, affine):
+    '''
+    Normalized ellipsoidal radius of every voxel, 1 on the brain surface
+    '''
+    ijk = np.indices(shape).reshape(3, -1)
+    xyz = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    r = np.sqrt(sum((x / a)**2 for x, a in zip(xyz, BRAIN_RADII)))
+    return r.reshape(shape)
+
+
+def _save(data, affine, out_dir, name):
+    out_file = os.path.join(out_dir, name)
+    nib.Nifti1Image(data, affine).to_filename(out_file)
+    return out_file
+
+
+def _write_bold(out_file, r, affine, n_vols, tr, rng):
+    '''
+    Write an int16 BOLD series one volume at a time through a memory map,
+    so series of a thousand volumes and more fit in memory
+
+    Tissue specific fluctuations are added over a slow drift, and the first
+    volumes are brighter to mimic non-steady state volumes
+    '''
+    shape = r.shape + (n_vols, )
+    brain = r < 1
+    wm = np.abs(r - 0.55) < 0.2
+    csf = brain & ((r < 0.2) | (r > 0.85))
+
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(np.int16)
+    hdr.set_zooms(tuple(np.abs(np.diag(affine)[:3])) + (tr, ))
+    hdr.set_qform(affine, code=1)
+    hdr.set_sform(affine, code=1)
+    hdr.set_xyzt_units('mm', 'sec')
+    hdr.set_data_offset(352)
+
+    with open(out_file, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\0' * (352 - f.tell()))
+
+    data = np.memmap(out_file,
+                     dtype=hdr.get_data_dtype(),
+                     mode='r+',
+                     offset=352,
+                     shape=shape,
+                     order='F')
+
+    drift = np.cumsum(rng.randn(n_vols)) * 0.002
+    wm_signal = rng.randn(n_vols) * 0.01
+    csf_signal = rng.randn(n_vols) * 0.02
+    for t in range(n_vols):
+        vol = 1000. * brain * (1 + drift[t])
+        vol += 1000. * wm * wm_signal[t]
+        vol += 1000. * csf * csf_signal[t]
+        vol += 20. * rng.randn(*r.shape) * brain
+        if t < 3:
+            vol *= 1.5 - 0.15 * t
+        data[..., t] = vol.round()
+    data.flush()
+    del data
+
+    return out_file
+
+
+def run_stages(fixtures, stage_dir, tr, repeat=1, timeout=3600):
+    '''
+    Run the interfaces of the confound workflow in order, each stage in a
+    spawned process, and return their timings and peak RSS
+
+    A forked process would start with the address space, and so the peak
+    RSS, of the benchmark itself. Stages that die (e.g. killed for running out
+    of memory) or run past `timeout` seconds fail the benchmark.
+    '''
+
+    from confounds import ROI_PARAMS, ACOMPCOR_PARAMS
+
+    f = fixtures
+    stages = [
+        ('run_info', _run_info, lambda o: (f['bold'], f['bold_json'])),
+        ('anat_rois', _anat_rois, lambda o:
+         (f['t1_mask'], f['wm_tpm'], f['csf_tpm'], ROI_PARAMS)),
+        ('bold_rois', _bold_rois, lambda o:
+         ([o['anat_rois'][n] for n in ('acc', 'csf', 'wm')], f['bold_mask'])),
+        ('signal_extraction', _signals, lambda o:
+         (f['bold'], [o['bold_rois'][2], o['bold_rois'][1]])),
+        ('acompcor', _acompcor, lambda o:
+         (f['bold'], o['bold_rois'], tr, o['run_info'], ACOMPCOR_PARAMS)),
+        ('gather_confounds', _gather,
+         lambda o: (o['signal_extraction'], o['acompcor'])),
+    ]
+
+    ctx = mp.get_context('spawn')
+    outputs = {}
+    results = []
+    for name, func, get_args in stages:
+        runs = []
+        for i in range(repeat):
+            cwd = os.path.join(stage_dir, name, str(i))
+            os.makedirs(cwd, exist_ok=True)
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run_stage,
+                               args=(queue, cwd, func, get_args(outputs)))
+            proc.start()
+            status, out, seconds, start_mb, peak_mb = _stage_result(
+                name, queue, proc, timeout)
+            proc.join()
+            if proc.exitcode != 0:
+                raise RuntimeError(f'Stage {name} exited with code '
+                                   f'{proc.exitcode}')
+            if status != 'ok':
+                raise RuntimeError(f'Stage {name} failed:\n{out}')
+            runs.append((seconds, start_mb, peak_mb))
+        outputs[name] = out
+
+        seconds = [s for s, _, _ in runs]
+        results.append(
+            OrderedDict([('name', name), ('seconds', min(seconds)),
+                         ('all_seconds', seconds),
+                         ('start_rss_mb', max(r[1] for r in runs)),
+                         ('peak_rss_mb', max(r[2] for r in runs))]))
+
+    return results
+
+
+def _stage_result(name, queue, proc, timeout):
+    '''
+    Wait for the result of a stage, failing once its process is gone
+    without one or after `timeout` seconds
+    '''
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return queue.get(timeout=POLL_SECONDS)
+        except Empty:
+            pass
+        if not proc.is_alive():
+            # The result may have been sent just before the process exited
+            try:
+                return queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                raise RuntimeError(f'Stage {name} exited with code '
+                                   f'{proc.exitcode} without a result')
+        if time.perf_counter() > deadline:
+            proc.kill()
+            proc.join()
+            raise RuntimeError(f'Stage {name} timed out after {timeout} s')
+
+
+def _run_stage(queue, cwd, func, args):
+    '''
+    Run a single stage in the spawned process and report its wall time, the
+    RSS inherited at start and the peak RSS
+    '''
+    os.chdir(cwd)
+    start_mb = _maxrss_mb()
+    try:
+        t0 = time.perf_counter()
+        out = func(*args)
+        seconds = time.perf_counter() - t0
+    except Exception:
+        import traceback
+        queue.put(('error', traceback.format_exc(), 0, 0, 0))
+        return
+    queue.put(('ok', out, seconds, start_mb, _maxrss_mb()))
+
+
+def _maxrss_mb():
+    # ru_maxrss carries the peak of the parent over fork and exec on Linux,
+    # VmHWM is the peak of this process' own address space
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _run_info(bold, bold_json):
+    from confounds import _read_run_info
+    return _read_run_info(bold, bold_json)[1]
+
+
+def _anat_rois(t1_mask, wm_tpm, csf_tpm, roi_params):
+    from rois import AnatROIs
+    outputs = AnatROIs(t1w_mask=t1_mask,
+                       wm_tpm=wm_tpm,
+                       csf_tpm=csf_tpm,
+                       roi_params=roi_params).run().outputs
+    return {
+        'wm': outputs.wm_roi,
+        'csf': outputs.csf_roi,
+        'acc': outputs.acc_roi
+    }
+
+
+def _bold_rois(roi_files, mask_file):
+    from resample import ResampleMaskedROIs
+    return ResampleMaskedROIs(roi_files=roi_files,
+                              mask_file=mask_file).run().outputs.out_files
+
+
+def _signals(bold, label_files):
+    from niworkflows.interfaces.images import SignalExtraction
+    return SignalExtraction(class_labels=['white_matter', 'csf'],
+                            in_file=bold,
+                            label_files=label_files).run().outputs.out_file
+
+
+def _acompcor(bold, mask_files, tr, skip_vols, params):
+    from niworkflows.interfaces.patches import RobustACompCor as ACompCor
+    acompcor = ACompCor(components_file='acompcor.tsv',
+                        header_prefix='a_comp_cor_',
+                        pre_filter='cosine',
+                        save_pre_filter=True,
+                        save_metadata=True,
+                        merge_method='none',
+                        mask_names=params['mask_names'],
+                        high_pass_cutoff=params['period_cut'],
+                        failure_mode='NaN',
+                        realigned_file=bold,
+                        mask_files=mask_files,
+                        repetition_time=tr,
+                        ignore_initial_volumes=skip_vols)
+    acompcor.inputs.variance_threshold = params['variance_threshold']
+    return acompcor.run().outputs.components_file
+
+
+def _gather(signals, acompcor):
+    from interfaces import GatherConfounds
+    return GatherConfounds(signals=signals,
+                           acompcor=acompcor).run().outputs.confounds_file
+
+
+def _package_versions():
+    versions = OrderedDict()
+    for name in PACKAGES:
+        try:
+            versions[name] = __import__(name).__version__
+        except (ImportError, AttributeError):
+            versions[name] = None
+    return versions
+
+
+def print_comparison(before, after):
+    '''
+    Print the time and peak RSS of every stage, next to an earlier run when
+    one is given
+    '''
+
+    old = {s['name']: s for s in before['stages']} if before else {}
+    for stage in after['stages']:
+        line = (f'{stage["name"]:<20} {stage["seconds"]:9.3f} s '
+                f'{stage["peak_rss_mb"]:9.1f} MB')
+        prev = old.get(stage['name'])
+        if prev:
+            ratio = stage['seconds'] / max(prev['seconds'], 1e-9)
+            line += (f'   was {prev["seconds"]:9.3f} s '
+                     f'{prev["peak_rss_mb"]:9.1f} MB  ({ratio:.2f}x)')
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Size-bounded on-disk cache shared by the pipeline scripts."""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def hash_key(*parts):
+    '''
+    Build a cache key from strings, numbers and arrays
+    '''
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            h.update(str(p.dtype).encode())
+            h.update(str(p.shape).encode())
+            h.update(np.ascontiguousarray(p).tobytes())
+        else:
+            h.update(repr(p).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def hash_file(in_file, block_size=2**20):
+    '''
+    SHA-256 of a file's contents
+    '''
+    h = hashlib.sha256()
+    with open(in_file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    '''
+    Files stored under hashed keys in a single directory
+
+    Entries are written atomically so several tasks can share the cache,
+    and the least recently used entries are evicted once the total size
+    of the cache goes over `max_bytes`.
+    '''
+
+    def __init__(self, cache_dir, max_bytes, suffix=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        '''
+        Path to a cached entry or None, a hit marks the entry as used
+        '''
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, write):
+        '''
+        Add an entry by calling `write` with a temporary path in the cache
+        directory, then evict old entries if the cache is over size
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir,
+                                   prefix='.tmp',
+                                   suffix=self.suffix)
+        os.close(fd)
+        try:
+            write(tmp)
+            # mkstemp files are private, entries are for every user
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            os.replace(tmp, self.path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+        return self.path(key)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until under the size limit
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.tmp') or not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
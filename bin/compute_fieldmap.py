@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Compute a fieldmap in rad/s from a pair of complex echoes for fieldmaps.nf
+
+Each echo holds magnitude, phase, real and imaginary volumes. Both echoes are
+loaded once, and the masking, the complex phase difference and its magnitude
+are computed on in-memory arrays as the fslsplit/fslmaths/fslcomplex chain
+did. Only brain extraction (bet) and phase unwrapping (prelude) are left to
+FSL, with their intermediates written uncompressed.
+"""
+import os
+import json
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+# Volumes of each echo
+MAGNITUDE, REAL, IMAGINARY = 0, 2, 3
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compute the magnitude and fieldmap of a pair of complex '
+        'fieldmap echoes')
+    parser.add_argument('echo1', type=str, help='First (shorter) echo')
+    parser.add_argument('echo2', type=str, help='Second (longer) echo')
+    parser.add_argument('--delta-te',
+                        type=float,
+                        default=0.002,
+                        help='Echo time difference in seconds')
+    parser.add_argument('--fieldmap',
+                        type=str,
+                        default='fieldmap.nii.gz',
+                        help='Output fieldmap in rad/s')
+    parser.add_argument('--magnitude',
+                        type=str,
+                        default='magnitude.nii.gz',
+                        help='Output magnitude of the phase difference')
+    parser.add_argument('--json',
+                        type=str,
+                        default='json',
+                        help='Output sidecar holding the fieldmap units')
+
+    args = parser.parse_args()
+
+    # A single read of each echo, every volume is taken from memory
+    echo1 = nib.load(args.echo1)
+    data1 = np.asanyarray(echo1.dataobj, dtype=np.float32)
+    data2 = np.asanyarray(nib.load(args.echo2).dataobj, dtype=np.float32)
+
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp:
+        mag1, mask1 = bet(data1[..., MAGNITUDE], echo1,
+                          os.path.join(tmp, 'echo1'))
+        _, mask2 = bet(data2[..., MAGNITUDE], echo1,
+                       os.path.join(tmp, 'echo2'))
+
+        phase, magnitude = phase_difference(data1, mask1, data2, mask2)
+        unwrapped = prelude(phase, mag1, mask1, echo1, tmp)
+
+    fieldmap = unwrapped / np.float32(args.delta_te)
+    _save(fieldmap, echo1, args.fieldmap)
+    _save(magnitude, echo1, args.magnitude)
+
+    with open(args.json, 'w') as f:
+        json.dump({'Units': 'rad/s'}, f)
+
+
+def _save(data, ref_img, out_file):
+    '''
+    Write a float32 volume with the geometry of `ref_img`
+    '''
+    header = ref_img.header.copy()
+    header.set_data_shape(data.shape)
+    header.set_data_dtype(np.float32)
+    img = nib.Nifti1Image(data.astype(np.float32), ref_img.affine, header)
+    img.set_qform(*ref_img.get_qform(coded=True))
+    img.set_sform(*ref_img.get_sform(coded=True))
+    img.to_filename(out_file)
+
+
+def _fsl_env():
+    env = dict(os.environ)
+    env['FSLOUTPUTTYPE'] = 'NIFTI'
+    return env
+
+
+def bet(magnitude, ref_img, prefix):
+    '''
+    Brain extract the magnitude volume of an echo, returns the extracted
+    magnitude and the brain mask
+    '''
+    in_file = f'{prefix}_mag_in.nii'
+    _save(magnitude, ref_img, in_file)
+    subprocess.run(['bet', in_file, f'{prefix}_mag', '-R', '-f', '0.5', '-m'],
+                   check=True,
+                   env=_fsl_env())
+    return (nib.load(f'{prefix}_mag.nii').get_fdata(dtype=np.float32),
+            nib.load(f'{prefix}_mag_mask.nii').get_fdata(dtype=np.float32))
+
+
+def phase_difference(echo1, mask1, echo2, mask2):
+    '''
+    Phase and magnitude of the product of the conjugate of the masked first
+    echo with the masked second echo, given the 4D arrays of both echoes
+    '''
+    real1 = echo1[..., REAL] * mask1
+    imag1 = echo1[..., IMAGINARY] * mask1
+    real2 = echo2[..., REAL] * mask2
+    imag2 = echo2[..., IMAGINARY] * mask2
+
+    # Adding zero turns the -0 of masked voxels into 0, for a phase of 0
+    real = real1 * real2 + imag1 * imag2 + 0.0
+    imag = real1 * imag2 - real2 * imag1 + 0.0
+    return np.arctan2(imag, real), np.hypot(real, imag)
+
+
+def prelude(phase, magnitude, mask, ref_img, tmp):
+    '''
+    Unwrap a phase volume within a mask
+    '''
+    phase_file = os.path.join(tmp, 'phase.nii')
+    mag_file = os.path.join(tmp, 'magnitude.nii')
+    mask_file = os.path.join(tmp, 'mask.nii')
+    out_file = os.path.join(tmp, 'phase_unwrapped.nii')
+    _save(phase, ref_img, phase_file)
+    _save(magnitude, ref_img, mag_file)
+    _save(mask, ref_img, mask_file)
+    cmd = [
+        'prelude', '-a', mag_file, '-p', phase_file, '-m', mask_file, '-o',
+        out_file
+    ]
+    subprocess.run(cmd, check=True, env=_fsl_env())
+    return nib.load(out_file).get_fdata(dtype=np.float32)
+
+
+if __name__ == '__main__':
+    main()
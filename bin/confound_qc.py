@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""
+Carpet plot QC of the recalculated confounds of a study
+
+Renders, for every run of an fMRIPrep directory, niworkflows' fMRIPlot of a
+decimated BOLD carpet along with the fixed white_matter, csf and aCompCor
+regressors, then writes a study-level index.html linking every plot.
+
+The carpet is drawn from a sample of at most --max-voxels voxels, drawn from
+the brain, WM and CSF rows in proportion to their size, and from every k-th
+volume so that at most --max-vols are shown. The BOLD series is read in
+blocks of those volumes (memory-mapped when uncompressed, streamed
+otherwise) and only the sampled voxels are kept. WM and CSF rows come from
+the ROI containers dump_masks publishes, resampled to BOLD space. Runs
+without one are shown as a single brain group.
+
+Runs are rendered in parallel, one per process, and plots newer than their
+inputs are kept unless --force is given.
+"""
+import os
+import sys
+import json
+import math
+import html
+import argparse
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from execution import task_resources, limit_threads
+from confound_store import read_columns
+from roi_pack import ROIPack, ROIS_SUFFIX
+from volumes import iter_volume_blocks
+
+CARPET_SUFFIX = '_carpet.png'
+INDEX_NAME = 'index.html'
+
+FIXED_SUFFIX = '_desc-confounds_fixedregressors'
+# Recalculated columns are written with a _fixed suffix by finalize
+QC_COLUMNS = [
+    'framewise_displacement', 'std_dvars', 'white_matter_fixed', 'csf_fixed'
+]
+ACOMPCOR_PREFIX = 'a_comp_cor_'
+ACOMPCOR_SUFFIX = '_fixed'
+UNITS = {'framewise_displacement': 'mm'}
+VLINES = {'framewise_displacement': [0.5]}
+
+# Carpet row groups, labelled to fall in distinct classes of niworkflows'
+# carpet lookup table so each group gets its own colour band
+SEGMENTS = [('brain', 1), ('wm', 100), ('csf', 255)]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Render decimated carpet plots of the recalculated '
+        'confounds of every run and a study-level HTML index')
+    parser.add_argument('fmriprep', type=str, help='fMRIPrep derivatives')
+    parser.add_argument('out_dir', type=str, help='Report directory')
+    parser.add_argument('--subjects',
+                        type=str,
+                        help='File listing the subjects to include')
+    parser.add_argument('--db',
+                        type=str,
+                        help='Derivatives index of index_fmriprep.py to '
+                        'reuse')
+    parser.add_argument('--masks',
+                        type=str,
+                        help='Directory of <base>_rois.npz ROI containers '
+                        '(the --dump_masks output) to group carpet rows by')
+    parser.add_argument('--resample-cache',
+                        type=str,
+                        help='Directory caching T1 to BOLD resampling maps')
+    parser.add_argument('--max-voxels',
+                        type=int,
+                        default=20000,
+                        help='Most voxels (carpet rows) sampled per run')
+    parser.add_argument('--max-vols',
+                        type=int,
+                        default=800,
+                        help='Most volumes shown per run, longer runs are '
+                        'shown every k-th volume')
+    parser.add_argument('--acompcor',
+                        type=int,
+                        default=3,
+                        help='Number of aCompCor components to plot')
+    parser.add_argument('--nprocs',
+                        type=int,
+                        help='Number of runs to render at once, defaults to '
+                        'the CPUs allocated to the task')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Render runs whose plot is up to date')
+
+    args = parser.parse_args()
+    from index_fmriprep import DerivativesIndex, INDEX_NAME as DB_NAME
+
+    fmriprep = os.path.abspath(args.fmriprep)
+    subjects = None
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            subjects = {s.strip() for s in f if s.strip()}
+
+    index = DerivativesIndex(args.db or os.path.join(fmriprep, DB_NAME))
+    runs, _ = index.runs(fmriprep, subjects)
+    index.close()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    settings = {
+        'max_voxels': args.max_voxels,
+        'max_vols': args.max_vols,
+        'acompcor': args.acompcor,
+        'resample_cache': args.resample_cache,
+        'force': args.force
+    }
+    jobs = []
+    for run in runs:
+        confounds = _fixed_confounds(run['bold'], run['base'])
+        if not os.path.exists(confounds):
+            continue
+        rois = None
+        if args.masks:
+            rois = os.path.join(args.masks, run['base'] + ROIS_SUFFIX)
+        jobs.append(
+            dict(run,
+                 fixed_confounds=confounds,
+                 rois=rois if rois and os.path.exists(rois) else None,
+                 out_file=os.path.join(args.out_dir,
+                                       run['base'] + CARPET_SUFFIX),
+                 **settings))
+
+    # Each process renders a single run at a time
+    nprocs, _ = task_resources(args.nprocs)
+    limit_threads()
+    results = []
+    if jobs:
+        with mp.get_context('fork').Pool(min(nprocs, len(jobs))) as pool:
+            for result in pool.imap_unordered(render_run, jobs):
+                if result['error']:
+                    sys.stderr.write(f'{result["base"]}: {result["error"]}\n')
+                results.append(result)
+
+    write_index(results, os.path.join(args.out_dir, INDEX_NAME))
+    return 1 if any(r['error'] for r in results) else 0
+
+
+def _fixed_confounds(bold, base):
+    return os.path.join(os.path.dirname(bold), base + FIXED_SUFFIX + '.tsv')
+
+
+def render_run(job):
+    '''
+    Render the carpet plot of a single run unless it is up to date, returns
+    a summary of the run for the index
+    '''
+    result = {
+        'sub': job['sub'],
+        'ses': job['ses'],
+        'base': job['base'],
+        'out_file': job['out_file'],
+        'rows': None,
+        'vols': None,
+        'error': None
+    }
+    inputs = [job['bold'], job['fixed_confounds']] + ([job['rois']]
+                                                     if job['rois'] else [])
+    if not job['force'] and _up_to_date(job['out_file'], inputs):
+        return result
+
+    try:
+        rows, vols = carpet_plot(job['bold'],
+                                 job['bold_mask'],
+                                 job['fixed_confounds'],
+                                 job['out_file'],
+                                 tr=_read_tr(job['bold_json']),
+                                 rois=job['rois'],
+                                 max_voxels=job['max_voxels'],
+                                 max_vols=job['max_vols'],
+                                 n_acompcor=job['acompcor'],
+                                 resample_cache=job['resample_cache'])
+        result.update(rows=rows, vols=vols)
+    except Exception:
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    return result
+
+
+def _up_to_date(out_file, inputs):
+    if not os.path.exists(out_file):
+        return False
+    mtime = os.path.getmtime(out_file)
+    return all(os.path.getmtime(f) <= mtime for f in inputs)
+
+
+def _read_tr(bold_json):
+    with open(bold_json, 'r') as f:
+        return json.load(f)['RepetitionTime']
+
+
+def carpet_plot(bold,
+                bold_mask,
+                confounds_file,
+                out_file,
+                tr,
+                rois=None,
+                max_voxels=20000,
+                max_vols=800,
+                n_acompcor=3,
+                resample_cache=None,
+                seed=0):
+    '''
+    Write the decimated carpet plot and confound traces of a run, returns
+    the number of rows and volumes shown
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from niworkflows.viz.plots import fMRIPlot
+
+    mask_img = nib.load(bold_mask)
+    labels = segment_labels(mask_img, rois, resample_cache)
+    voxels, seg = sample_voxels(labels, max_voxels, seed)
+
+    n_vols = nib.load(bold).shape[3]
+    step = time_step(n_vols, max_vols)
+    timeseries = decimated_timeseries(bold, voxels, step)
+
+    confounds = qc_confounds(confounds_file, n_acompcor).iloc[::step]
+
+    # The carpet as a (rows, 1, 1, volumes) image with the matching labels
+    carpet_img = nib.Nifti1Image(timeseries[:, None, None, :], np.eye(4))
+    carpet_img.header.set_xyzt_units('mm', 'sec')
+    carpet_img.header.set_zooms((1, 1, 1, tr * step))
+    seg_img = nib.Nifti1Image(seg[:, None, None].astype(np.int16), np.eye(4))
+
+    tmp_base = f'{out_file}.tmp{os.getpid()}'
+    try:
+        carpet_img.to_filename(f'{tmp_base}_carpet.nii')
+        seg_img.to_filename(f'{tmp_base}_seg.nii')
+        figure = fMRIPlot(f'{tmp_base}_carpet.nii',
+                          seg_file=f'{tmp_base}_seg.nii',
+                          data=confounds,
+                          tr=tr * step,
+                          units={c: UNITS[c]
+                                 for c in confounds if c in UNITS},
+                          vlines={c: VLINES[c]
+                                  for c in confounds if c in VLINES}).plot()
+        figure.savefig(f'{tmp_base}.png', dpi=100, bbox_inches='tight')
+        plt.close(figure)
+        os.replace(f'{tmp_base}.png', out_file)
+    finally:
+        for suffix in ['_carpet.nii', '_seg.nii', '.png']:
+            if os.path.exists(tmp_base + suffix):
+                os.remove(tmp_base + suffix)
+
+    return timeseries.shape
+
+
+def segment_labels(mask_img, rois=None, resample_cache=None):
+    '''
+    Label of every voxel of the BOLD mask (0 outside it), with the WM and
+    CSF ROIs of a container resampled to BOLD space when given one
+    '''
+    labels = np.zeros(mask_img.shape[:3], dtype=np.int16)
+    labels[np.asanyarray(mask_img.dataobj) > 0] = dict(SEGMENTS)['brain']
+    if rois is None:
+        return labels
+
+    from direct import bold_space_rois
+
+    pack = ROIPack(rois)
+    names = [n for n, _ in SEGMENTS if n in pack]
+    bold_rois = bold_space_rois({n: pack.to_nifti(n)
+                                 for n in names}, mask_img, resample_cache)
+    for name, label in SEGMENTS:
+        if name in bold_rois:
+            labels[bold_rois[name] > 0] = label
+    return labels
+
+
+def sample_voxels(labels, max_voxels, seed=0):
+    '''
+    Indices of at most `max_voxels` labelled voxels, sampled from each
+    label in proportion to its size and ordered by label and then by
+    position, along with the label of each sampled voxel
+    '''
+    rng = np.random.default_rng(seed)
+    flat = labels.ravel()
+    total = np.count_nonzero(flat)
+    fraction = min(1.0, max_voxels / total) if total else 1.0
+
+    picked = []
+    for _, label in SEGMENTS:
+        idx = np.flatnonzero(flat == label)
+        n = int(math.ceil(len(idx) * fraction))
+        if n < len(idx):
+            idx = np.sort(rng.choice(idx, n, replace=False))
+        picked.append(idx)
+    picked = np.concatenate(picked)
+    return np.unravel_index(picked, labels.shape), flat[picked]
+
+
+def time_step(n_vols, max_vols):
+    '''
+    Stride between the volumes shown so that at most `max_vols` are
+    '''
+    if not max_vols or n_vols <= max_vols:
+        return 1
+    return int(math.ceil(n_vols / max_vols))
+
+
+def decimated_timeseries(bold_file, voxels, step=1, chunk_mb=256):
+    '''
+    Time series of the `voxels` (index arrays) of every `step`-th volume of
+    a BOLD series, as a voxel x time float32 matrix
+
+    Volumes are read in blocks of at most `chunk_mb`, memory-mapped when the
+    file is uncompressed and decompressed once otherwise, and only the
+    requested voxels of each block are kept.
+    '''
+    vols = range(0, nib.load(bold_file).shape[3], step)
+    out = np.empty((len(voxels[0]), len(vols)), dtype=np.float32)
+
+    for i0, i1, block in iter_volume_blocks(bold_file, vols, chunk_mb):
+        out[:, i0:i1] = block[voxels]
+        del block
+    return out
+
+
+def qc_confounds(confounds_file, n_acompcor=3):
+    '''
+    Confounds to plot under the carpet, the fixed signals and the first
+    `n_acompcor` aCompCor components
+    '''
+    columns = read_columns(confounds_file)
+    acompcor = sorted(c for c in columns if c.startswith(ACOMPCOR_PREFIX)
+                      and c.endswith(ACOMPCOR_SUFFIX))
+    names = [c for c in QC_COLUMNS if c in columns] + acompcor[:n_acompcor]
+
+    # First rows of derivative confounds are n/a
+    return pd.DataFrame({c: columns[c] for c in names}).fillna(0)
+
+
+def write_index(results, out_file):
+    '''
+    Write the study-level HTML index of the rendered plots
+    '''
+    rows = []
+    for r in sorted(results, key=lambda r: (r['sub'], r['ses'], r['base'])):
+        plot = os.path.basename(r['out_file'])
+        if r['error']:
+            cell = f'<span class="error">{html.escape(r["error"])}</span>'
+        else:
+            cell = (f'<a href="{html.escape(plot)}"><img loading="lazy" '
+                    f'src="{html.escape(plot)}" width="640"></a>')
+        shown = ''
+        if r['rows'] is not None:
+            shown = f'{r["rows"]} voxels, {r["vols"]} volumes'
+        rows.append('<tr>' + ''.join(
+            f'<td>{c}</td>'
+            for c in (html.escape(r['sub']), html.escape(r['ses'] or ''),
+                      html.escape(r['base']), shown, cell)) + '</tr>')
+
+    n_failed = sum(bool(r['error']) for r in results)
+    with open(out_file, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                '<title>Confound QC</title><style>'
+                'td{padding:4px;vertical-align:top}'
+                '.error{color:#b00}</style></head><body>\n'
+                f'<h1>Confound QC</h1><p>{len(results)} runs, '
+                f'{n_failed} failed</p>\n<table>\n'
+                '<tr><th>Subject</th><th>Session</th><th>Run</th>'
+                '<th>Shown</th><th>Carpet plot</th></tr>\n')
+        f.write('\n'.join(rows))
+        f.write('\n</table></body></html>\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Columnar confounds, per run and across a study
+
+Next to every confounds TSV the confound tooling writes, a .npz sidecar
+holds one typed array per column, so a single column is read without
+parsing the table. Run as a script, consolidates the fixed confounds of all
+runs of an fMRIPrep directory into a study-level store:
+
+    STORE/index.tsv         sub, ses, base and rows [start, stop) of each run
+    STORE/columns/<c>.npy   column c of every run end to end, as float64
+
+Columns are memory-mapped when read, so pulling e.g. csf_fixed or a
+framewise displacement trace out of thousands of runs only touches that
+column's pages. Runs missing a column hold NaN over their rows.
+"""
+import os
+import sys
+import shutil
+import zipfile
+import argparse
+
+import numpy as np
+import pandas as pd
+
+COLUMNS_EXT = '.npz'
+INDEX_NAME = 'index.tsv'
+COLUMNS_DIR = 'columns'
+INDEX_COLUMNS = ['sub', 'ses', 'base', 'start', 'stop']
+
+FIXED_SUFFIX = '_desc-confounds_fixedregressors'
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Consolidate the fixed confounds of every run of an '
+        'fMRIPrep directory into a memory-mappable study store')
+    parser.add_argument('fmriprep', type=str, help='fMRIPrep derivatives')
+    parser.add_argument('store', type=str, help='Store directory to write')
+    parser.add_argument('--subjects',
+                        type=str,
+                        help='File listing the subjects to include')
+    parser.add_argument('--db',
+                        type=str,
+                        help='Derivatives index of index_fmriprep.py to '
+                        'reuse')
+
+    args = parser.parse_args()
+    from index_fmriprep import DerivativesIndex, INDEX_NAME as DB_NAME
+
+    fmriprep = os.path.abspath(args.fmriprep)
+    subjects = None
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            subjects = {s.strip() for s in f if s.strip()}
+
+    index = DerivativesIndex(args.db or os.path.join(fmriprep, DB_NAME))
+    runs, _ = index.runs(fmriprep, subjects)
+    index.close()
+
+    entries = []
+    for run in runs:
+        func_dir = os.path.dirname(run['bold'])
+        tsv = os.path.join(func_dir, run['base'] + FIXED_SUFFIX + '.tsv')
+        if os.path.exists(tsv):
+            entries.append((run['sub'], run['ses'], run['base'], tsv))
+
+    n_rows = build_store(entries, args.store)
+    print(f'Stored {n_rows} rows of {len(entries)} runs in {args.store}')
+
+
+def columns_path(tsv):
+    '''
+    Path of the columnar sidecar of a confounds TSV
+    '''
+    return os.path.splitext(tsv)[0] + COLUMNS_EXT
+
+
+def write_columns(frame, out_file):
+    '''
+    Write each column of a confounds table as its own array of an
+    uncompressed .npz, numeric columns keep their dtype and any other
+    column is stored as strings. Repeated column names are told apart the
+    way pandas reads them back from the TSV, as name.1, name.2, ...
+
+    >>> from io import BytesIO
+    >>> f = BytesIO()
+    >>> write_columns(pd.DataFrame([[1, 2, 3]], columns=['a', 'b', 'a']), f)
+    >>> _ = f.seek(0)
+    >>> sorted(np.load(f).files)
+    ['a', 'a.1', 'b']
+    '''
+    arrays = {}
+    for name, column in frame.items():
+        name = _unique_name(name, arrays)
+        if column.dtype.kind in 'biuf':
+            arrays[name] = column.to_numpy()
+        else:
+            arrays[name] = column.astype(str).to_numpy().astype(str)
+
+    if isinstance(out_file, str):
+        with open(out_file, 'wb') as f:
+            np.savez(f, **arrays)
+    else:
+        np.savez(out_file, **arrays)
+
+
+def _unique_name(name, taken):
+    unique, i = name, 0
+    while unique in taken:
+        i += 1
+        unique = f'{name}.{i}'
+    return unique
+
+
+def read_columns(in_file, columns=None):
+    '''
+    Columns of a confounds table as a dictionary of arrays, from its .npz
+    sidecar when there is one and from the TSV otherwise. Only the
+    requested columns are read from a sidecar.
+    '''
+    sidecar = in_file
+    if not in_file.endswith(COLUMNS_EXT):
+        sidecar = columns_path(in_file)
+    if os.path.exists(sidecar):
+        with np.load(sidecar, allow_pickle=False) as npz:
+            names = npz.files if columns is None else [
+                c for c in columns if c in npz.files
+            ]
+            return {c: npz[c] for c in names}
+
+    frame = pd.read_csv(in_file,
+                        sep='\t',
+                        usecols=(lambda c: c in columns) if columns else None)
+    return {c: frame[c].to_numpy() for c in frame.columns}
+
+
+def read_header(in_file):
+    '''
+    Column names of a confounds table and its number of rows, without
+    reading its values. Only the zip directory and the header of one array
+    are read from a .npz sidecar, and only the header line and the line
+    count from a TSV
+    '''
+    sidecar = in_file
+    if not in_file.endswith(COLUMNS_EXT):
+        sidecar = columns_path(in_file)
+    if not os.path.exists(sidecar):
+        names = list(pd.read_csv(in_file, sep='\t', nrows=0).columns)
+        with open(in_file, 'r') as f:
+            n_lines = sum(1 for line in f if line.rstrip('\r\n'))
+        return names, max(n_lines - 1, 0)
+
+    with zipfile.ZipFile(sidecar) as z:
+        members = z.namelist()
+        if not members:
+            return [], 0
+        with z.open(members[0]) as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return [m[:-len('.npy')] for m in members], shape[0] if shape else 0
+
+
+def build_store(entries, store_dir):
+    '''
+    Write the study store of (sub, ses, base, confounds TSV) entries to
+    `store_dir`, replacing any previous store once complete. Returns the
+    number of rows stored
+
+    Column names and row counts are gathered first, then every run is read
+    once and its rows written into all of the memory-mapped columns.
+    Columns without numeric values in any run are not stored.
+    '''
+    names, index, start = [], [], 0
+    for sub, ses, base, tsv in entries:
+        run_names, n = read_header(tsv)
+        names.extend(c for c in run_names if c not in names)
+        index.append((sub, ses, base, start, start + n))
+        start += n
+
+    tmp_dir = f'{store_dir.rstrip(os.sep)}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, COLUMNS_DIR))
+
+    index_file = os.path.join(tmp_dir, INDEX_NAME)
+    pd.DataFrame(index, columns=INDEX_COLUMNS).to_csv(index_file,
+                                                      sep='\t',
+                                                      index=False)
+
+    column_files = {
+        name: os.path.join(tmp_dir, COLUMNS_DIR, name + '.npy')
+        for name in names
+    }
+    columns = {}
+    for name, out_file in column_files.items():
+        columns[name] = np.lib.format.open_memmap(out_file,
+                                                  mode='w+',
+                                                  dtype=np.float64,
+                                                  shape=(start, ))
+        columns[name][:] = np.nan
+
+    filled = set()
+    for (_, _, _, run_start, run_stop), (_, _, _, tsv) in zip(index, entries):
+        for name, values in read_columns(tsv).items():
+            if name not in columns or values.dtype.kind not in 'biuf':
+                continue
+            if len(values) != run_stop - run_start:
+                raise ValueError(f'{tsv} has {len(values)} rows of {name}, '
+                                 f'expected {run_stop - run_start}')
+            columns[name][run_start:run_stop] = values
+            filled.add(name)
+
+    for name in names:
+        columns.pop(name).flush()
+        if name not in filled:
+            os.remove(column_files[name])
+
+    old_dir = f'{store_dir.rstrip(os.sep)}.old{os.getpid()}'
+    if os.path.exists(store_dir):
+        os.rename(store_dir, old_dir)
+    os.rename(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return start
+
+
+class ConfoundStore(object):
+    '''
+    Read access to a study store written by build_store
+
+    >>> store = ConfoundStore('confounds_store')          # doctest: +SKIP
+    >>> csf = store.per_run('csf_fixed')                   # doctest: +SKIP
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = pd.read_csv(os.path.join(store_dir, INDEX_NAME),
+                                 sep='\t',
+                                 dtype={'ses': str},
+                                 keep_default_na=False)
+
+    @property
+    def columns(self):
+        return sorted(
+            f[:-len('.npy')]
+            for f in os.listdir(os.path.join(self.store_dir, COLUMNS_DIR)))
+
+    def column(self, name):
+        '''
+        A column across all runs, memory-mapped
+        '''
+        return np.load(os.path.join(self.store_dir, COLUMNS_DIR,
+                                    name + '.npy'),
+                       mmap_mode='r')
+
+    def run_column(self, name, base):
+        '''
+        A column of a single run, by its basename
+        '''
+        row = self.index[self.index['base'] == base].iloc[0]
+        return self.column(name)[row['start']:row['stop']]
+
+    def per_run(self, name, sub=None):
+        '''
+        A column of every run (of a subject), keyed by run basename
+        '''
+        column = self.column(name)
+        index = self.index
+        if sub is not None:
+            index = index[index['sub'] == sub]
+        return {
+            r.base: column[r.start:r.stop]
+            for r in index.itertuples(index=False)
+        }
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,74 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import argparse
 import json
 
 import nibabel as nib
 
-from resample import ResampleTPM
+from resample import ResampleMaskedROIs
+from rois import AnatROIs
+from profiling import init_profiler, measure
+from execution import (add_engine_args, add_execution_args, task_resources,
+                       limit_threads, run_workflow)
 
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype.interfaces import io as nio
 
-from niworkflows.interfaces.images import SignalExtraction
-from niworkflows.interfaces.patches import (RobustACompCor as ACompCor,
-                                            RobustTCompCor as TCompCor)
-from niworkflows.interfaces.utils import (TPM2ROI, AddTPMs, AddTSVHeader)
-from niworkflows.interfaces.registration import _get_vols_to_discard
-
 from interfaces import GatherConfounds
-from niworkflows.interfaces.utils import TSV2JSON
-
 
-def main():
+# Erosion settings for the WM, CSF and combined aCompCor ROIs
+ROI_PARAMS = {
+    'wm': {
+        'erode_prop': 0.6,
+        'mask_erode_prop': 0.6**3
+    },
+    'csf': {
+        'erode_mm': 0,
+        'mask_erode_mm': 30
+    },
+    'acc': {
+        'erode_prop': 0.6,
+        'mask_erode_prop': 0.6**3
+    }
+}
+
+# Version of the confounds this code writes, recorded in the manifests so
+# outputs of older code are recalculated. Bump it whenever a change alters
+# the confounds written for the same inputs and settings
+CONFOUNDS_VERSION = 2
+
+# aCompCor settings, components are kept up to the variance threshold
+ACOMPCOR_PARAMS = {
+    'mask_names': ['combined', 'CSF', 'WM'],
+    'variance_threshold': 0.5,
+    'period_cut': 128
+}
+
+
+def main(argv=None):
+
+    # Checking an fMRIPrep directory and running as a warm worker do not
+    # take the run arguments
+    mode_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    mode_parser.add_argument('--check', type=str)
+    mode_parser.add_argument('--subjects', type=str)
+    mode_parser.add_argument('--engine', type=str, default='nipype')
+    mode_parser.add_argument('--acompcor-svd', type=str, default='full')
+    mode_parser.add_argument('--serve', type=str)
+    mode_parser.add_argument('--serve-jobs', type=int, default=1)
+    mode_args, _ = mode_parser.parse_known_args(argv)
+    if mode_args.check:
+        check(mode_args.check, mode_args.subjects, mode_args.engine,
+              mode_args.acompcor_svd)
+        return
+    if mode_args.serve:
+        from worker import serve
+        _preload()
+        serve(mode_args.serve, main, mode_args.serve_jobs)
+        return
 
     parser = argparse.ArgumentParser(
         description='Extract confounds from WM and CSF')
@@ -42,8 +88,46 @@ def main():
                         type=str,
                         help='Path to use for workdir'
                         ' this path must already exist')
-
-    args = parser.parse_args()
+    parser.add_argument('--resample-cache',
+                        type=str,
+                        help='Directory to cache T1 to BOLD grid resampling '
+                        'index maps in, can be shared across runs and '
+                        'subjects')
+    parser.add_argument('--profile-out',
+                        type=str,
+                        help='JSON file to write per-node wall time, CPU '
+                        'time, peak RSS, I/O and cache reuse records to')
+    add_engine_args(parser)
+    add_execution_args(parser)
+    parser.add_argument('--check',
+                        type=str,
+                        metavar='FMRIPREP',
+                        help='Instead of extracting confounds, list the '
+                        'subject and basename of every run under an fMRIPrep '
+                        'directory whose recalculated confounds are missing '
+                        'or were computed from other inputs, settings or '
+                        'code. Takes no other arguments than --subjects, '
+                        '--engine and --acompcor-svd')
+    parser.add_argument('--subjects',
+                        type=str,
+                        help='With --check, file listing the subjects to '
+                        'check')
+    parser.add_argument('--serve',
+                        type=str,
+                        metavar='SOCKET',
+                        help='Instead of extracting confounds, keep the '
+                        'Nipype and niworkflows modules loaded and run the '
+                        'jobs submitted on a Unix socket with worker.py '
+                        'SOCKET [arguments...] until interrupted')
+    parser.add_argument('--serve-jobs',
+                        type=int,
+                        default=1,
+                        help='With --serve, number of jobs to run at a time '
+                        '(default: 1)')
+
+    args = parser.parse_args(argv)
+    if args.acompcor_svd != 'full' and args.engine != 'direct':
+        parser.error('--acompcor-svd truncated requires --engine direct')
     t1 = args.t1
     t1_mask = args.t1_mask
     wm_tpm = args.wm_tpm
@@ -53,14 +137,28 @@ def main():
     bold_json = args.bold_json
     outbase = args.out_basename
     workdir = args.workdir
-
-    # Get TR
-    with open(bold_json, 'r') as j:
-        metadata = json.load(j)
-
-    # Extract the number of volumes to discard
-    ref_im = nib.load(bold)
-    skipvol = _get_vols_to_discard(ref_im)
+    resample_cache = args.resample_cache
+    profiler = init_profiler(args.profile_out)
+    nprocs, mem_gb = task_resources(args.nprocs, args.mem_gb)
+    limit_threads()
+
+    if args.engine == 'direct':
+        from direct import build_anat_rois, run_bold_confounds
+        with measure(profiler, 'build_anat_rois'):
+            rois = build_anat_rois(t1_mask, wm_tpm, csf_tpm, ROI_PARAMS)
+        with measure(profiler, 'run_bold_confounds'):
+            run_bold_confounds(rois,
+                               bold,
+                               bold_mask,
+                               _read_tr(bold_json),
+                               outbase,
+                               ACOMPCOR_PARAMS,
+                               resample_cache=resample_cache,
+                               svd=args.acompcor_svd)
+        return
+
+    with measure(profiler, 'read_run_info'):
+        tr, skipvol = _read_run_info(bold, bold_json)
 
     # Set up confound workflow
     confound_dir = os.path.join(workdir, 'confound_wf')
@@ -68,9 +166,15 @@ def main():
         os.makedirs(confound_dir)
     except OSError:
         pass
-    confound_wf = init_confound_wf(t1, t1_mask, wm_tpm, csf_tpm, bold,
-                                   bold_mask, metadata['RepetitionTime'],
-                                   skipvol)
+    confound_wf = init_confound_wf(t1,
+                                   t1_mask,
+                                   wm_tpm,
+                                   csf_tpm,
+                                   bold,
+                                   bold_mask,
+                                   tr,
+                                   skipvol,
+                                   resample_cache=resample_cache)
     confound_wf.base_dir = confound_dir
 
     # Node to export file to destination directory
@@ -78,14 +182,11 @@ def main():
                            name='export_confounds')
     ef_confounds.inputs.out_file = f'{outbase}_confounds.tsv'
 
-    ef_wm = pe.Node(nio.ExportFile(clobber=True), name='export_wm')
-    ef_wm.inputs.out_file = f'{outbase}_wm_roi.nii.gz'
-
-    ef_csf = pe.Node(nio.ExportFile(clobber=True), name='export_csf')
-    ef_csf.inputs.out_file = f'{outbase}_csf_roi.nii.gz'
-
-    ef_acc = pe.Node(nio.ExportFile(clobber=True), name='export_acc')
-    ef_acc.inputs.out_file = f'{outbase}_acc_roi.nii.gz'
+    # The three ROIs share a single bit-packed container
+    ef_rois = pe.Node(niu.Function(function=_export_rois,
+                                   output_names=['out_file']),
+                      name='export_rois')
+    ef_rois.inputs.out_file = os.path.abspath(f'{outbase}_rois.npz')
 
     ef_acc_met = pe.Node(nio.ExportFile(clobber=True), name='export_acc_meta')
     ef_acc_met.inputs.out_file = f'{outbase}_confounds.json'
@@ -100,22 +201,47 @@ def main():
     wf.base_dir = main_dir
     wf.connect([(confound_wf, ef_confounds, [('outputnode.confounds_file',
                                               'in_file')]),
-                (confound_wf, ef_wm, [('outputnode.wm_roi', 'in_file')]),
-                (confound_wf, ef_csf, [('outputnode.csf_roi', 'in_file')]),
-                (confound_wf, ef_acc, [('outputnode.acc_roi', 'in_file')]),
+                (confound_wf, ef_rois, [('outputnode.wm_roi', 'wm_roi'),
+                                        ('outputnode.csf_roi', 'csf_roi'),
+                                        ('outputnode.acc_roi', 'acc_roi')]),
                 (confound_wf, ef_acc_met, [('outputnode.confounds_metadata',
                                             'in_file')])])
-    wf.run()
+    run_workflow(wf, profiler, nprocs=nprocs, mem_gb=mem_gb)
 
 
-def init_confound_wf(t1, t1_mask, wm_tpm, csf_tpm, bold, bold_mask, tr,
-                     skipvols):
+def check(fmriprep_dir, subjects_file=None, engine='nipype',
+          acompcor_svd='full'):
+    '''
+    Print the subject and basename of stale runs, tab separated
+    '''
+    from manifest import find_stale_runs, confound_params
+
+    subjects = None
+    if subjects_file:
+        with open(subjects_file, 'r') as f:
+            subjects = {s.strip() for s in f if s.strip()}
+
+    params = confound_params(engine, acompcor_svd)
+    for sub, base in find_stale_runs(fmriprep_dir, params, subjects):
+        sys.stdout.write(f'{sub}\t{base}\n')
+
+
+def init_confound_wf(t1,
+                     t1_mask,
+                     wm_tpm,
+                     csf_tpm,
+                     bold,
+                     bold_mask,
+                     tr,
+                     skipvols,
+                     resample_cache=None):
     '''
     Initialize the confound extraction workflow
     '''
 
     inputnode = pe.Node(niu.IdentityInterface(fields=[
-        'bold', 'bold_mask', 't1w_mask', 't1w', 'wm_tpm', 'csf_tpm', 'tpms'
+        'bold', 'bold_mask', 't1w_mask', 't1w', 'wm_tpm', 'csf_tpm', 'tpms',
+        'tr', 'skip_vols'
     ]),
                         name='inputnode')
 
@@ -126,41 +252,183 @@ def init_confound_wf(t1, t1_mask, wm_tpm, csf_tpm, bold, bold_mask, tr,
     inputnode.inputs.wm_tpm = wm_tpm
     inputnode.inputs.csf_tpm = csf_tpm
     inputnode.inputs.tpms = [wm_tpm, csf_tpm]
+    inputnode.inputs.tr = tr
     inputnode.inputs.skip_vols = skipvols
 
-    # WM Inputs
-    wm_roi = pe.Node(TPM2ROI(erode_prop=0.6, mask_erode_prop=0.6**3),
-                     name='wm_roi')
-    wm_msk = pe.Node(niu.Function(function=_maskroi), name='wm_msk')
-    resample_wm_roi = pe.Node(ResampleTPM(), name='resampled_wm_roi')
+    anat_wf = init_anat_roi_wf()
+    bold_wf = init_bold_confound_wf(resample_cache=resample_cache)
+
+    outputnode = pe.Node(niu.IdentityInterface(fields=[
+        'signals', 'wm_roi', 'csf_roi', 'acc_roi', 'components_file',
+        'confounds_file', 'confounds_metadata'
+    ]),
+                         name='outputnode')
+
+    wf = pe.Workflow(name='confound_wf')
+    wf.config['execution']['crashfile_format'] = 'txt'
+
+    wf.connect([(inputnode, anat_wf, [('t1w_mask', 'inputnode.t1w_mask'),
+                                      ('wm_tpm', 'inputnode.wm_tpm'),
+                                      ('csf_tpm', 'inputnode.csf_tpm')]),
+                (inputnode, bold_wf, [('bold', 'inputnode.bold'),
+                                      ('bold_mask', 'inputnode.bold_mask'),
+                                      ('tr', 'inputnode.tr'),
+                                      ('skip_vols', 'inputnode.skip_vols')]),
+                (anat_wf, bold_wf, [('outputnode.wm_roi', 'inputnode.wm_roi'),
+                                    ('outputnode.csf_roi',
+                                     'inputnode.csf_roi'),
+                                    ('outputnode.acc_roi',
+                                     'inputnode.acc_roi')]),
+                (anat_wf, outputnode, [('outputnode.wm_roi', 'wm_roi'),
+                                       ('outputnode.csf_roi', 'csf_roi'),
+                                       ('outputnode.acc_roi', 'acc_roi')]),
+                (bold_wf, outputnode,
+                 [('outputnode.signals', 'signals'),
+                  ('outputnode.components_file', 'components_file'),
+                  ('outputnode.confounds_file', 'confounds_file'),
+                  ('outputnode.confounds_metadata', 'confounds_metadata')])])
+
+    return wf
+
+
+def init_batch_confound_wf(t1,
+                           t1_mask,
+                           wm_tpm,
+                           csf_tpm,
+                           runs,
+                           resample_cache=None):
+    '''
+    Initialize a subject-level confound workflow over multiple BOLD runs
+
+    The T1 space ROIs are computed once and shared by every run, only the
+    BOLD space steps are expanded per run. Each entry of `runs` is a dict
+    with keys: bold, bold_mask, tr, skip_vols, out_basename
+    '''
+
+    inputnode = pe.Node(
+        niu.IdentityInterface(fields=['t1w_mask', 't1w', 'wm_tpm', 'csf_tpm']),
+        name='inputnode')
+    inputnode.inputs.t1w_mask = t1_mask
+    inputnode.inputs.t1w = t1
+    inputnode.inputs.wm_tpm = wm_tpm
+    inputnode.inputs.csf_tpm = csf_tpm
+
+    run_fields = ['bold', 'bold_mask', 'tr', 'skip_vols', 'out_basename']
+    runnode = pe.Node(niu.IdentityInterface(fields=run_fields),
+                      name='runnode')
+    runnode.iterables = [(f, [r[f] for r in runs]) for f in run_fields]
+    runnode.synchronize = True
+
+    anat_wf = init_anat_roi_wf()
+    bold_wf = init_bold_confound_wf(resample_cache=resample_cache)
+
+    export = pe.Node(niu.Function(function=_export_outputs,
+                                  output_names=['out_files']),
+                     name='export')
+
+    wf = pe.Workflow(name='batch_confound_wf')
+    wf.config['execution']['crashfile_format'] = 'txt'
+
+    wf.connect([(inputnode, anat_wf, [('t1w_mask', 'inputnode.t1w_mask'),
+                                      ('wm_tpm', 'inputnode.wm_tpm'),
+                                      ('csf_tpm', 'inputnode.csf_tpm')]),
+                (runnode, bold_wf, [('bold', 'inputnode.bold'),
+                                    ('bold_mask', 'inputnode.bold_mask'),
+                                    ('tr', 'inputnode.tr'),
+                                    ('skip_vols', 'inputnode.skip_vols')]),
+                (anat_wf, bold_wf, [('outputnode.wm_roi', 'inputnode.wm_roi'),
+                                    ('outputnode.csf_roi',
+                                     'inputnode.csf_roi'),
+                                    ('outputnode.acc_roi',
+                                     'inputnode.acc_roi')]),
+                (runnode, export, [('out_basename', 'out_basename')]),
+                (anat_wf, export, [('outputnode.wm_roi', 'wm_roi'),
+                                   ('outputnode.csf_roi', 'csf_roi'),
+                                   ('outputnode.acc_roi', 'acc_roi')]),
+                (bold_wf, export,
+                 [('outputnode.confounds_file', 'confounds_file'),
+                  ('outputnode.confounds_metadata', 'confounds_metadata')])])
 
-    # CSF inputs
-    csf_roi = pe.Node(TPM2ROI(erode_mm=0, mask_erode_mm=30), name='csf_roi')
-    csf_msk = pe.Node(niu.Function(function=_maskroi), name='csf_msk')
-    resample_csf_roi = pe.Node(ResampleTPM(), name='resampled_csf_roi')
+    return wf
+
+
+def init_anat_roi_wf(name='anat_roi_wf'):
+    '''
+    Build the eroded WM, CSF and combined aCompCor ROIs in T1 space
+
+    These only depend on the subject's anatomical inputs and can be shared
+    across all BOLD runs of a subject
+    '''
 
-    # Nodes for aCompCor
-    merge_label = pe.Node(niu.Merge(2),
-                          name='merge_rois',
-                          run_without_submitting=True)
+    inputnode = pe.Node(
+        niu.IdentityInterface(fields=['t1w_mask', 'wm_tpm', 'csf_tpm']),
+        name='inputnode')
+
+    # WM, CSF and combined ROIs, sharing a single brain mask distance map
+    anat_rois = pe.Node(AnatROIs(roi_params=ROI_PARAMS), name='anat_rois')
+
+    outputnode = pe.Node(
+        niu.IdentityInterface(fields=['wm_roi', 'csf_roi', 'acc_roi']),
+        name='outputnode')
+
+    wf = pe.Workflow(name=name)
+    wf.connect([(inputnode, anat_rois, [('t1w_mask', 't1w_mask'),
+                                        ('wm_tpm', 'wm_tpm'),
+                                        ('csf_tpm', 'csf_tpm')]),
+                (anat_rois, outputnode, [('wm_roi', 'wm_roi'),
+                                         ('csf_roi', 'csf_roi'),
+                                         ('acc_roi', 'acc_roi')])])
+
+    return wf
+
+
+def init_bold_confound_wf(name='bold_confound_wf', resample_cache=None):
+    '''
+    Project T1 space ROIs into BOLD space and extract the WM/CSF signals
+    and aCompCor components for a single BOLD run
+
+    When `resample_cache` is given the T1 to BOLD nearest-neighbour index
+    maps are cached in that directory and reused by later runs
+    '''
+
+    from niworkflows.interfaces.images import SignalExtraction
+    from niworkflows.interfaces.patches import RobustACompCor as ACompCor
+    from niworkflows.interfaces.utils import TSV2JSON
+
+    resample_args = {}
+    if resample_cache:
+        resample_args['cache_dir'] = resample_cache
+
+    inputnode = pe.Node(niu.IdentityInterface(fields=[
+        'bold', 'bold_mask', 'tr', 'skip_vols', 'wm_roi', 'csf_roi', 'acc_roi'
+    ]),
+                        name='inputnode')
+
+    # Combined, CSF and WM ROIs resampled and masked in BOLD space at once,
+    # in the order aCompCor takes them
+    merge_rois = pe.Node(niu.Merge(3),
+                         name='merge_rois',
+                         run_without_submitting=True)
+    bold_rois = pe.Node(ResampleMaskedROIs(**resample_args),
+                        name='bold_rois')
+
+    # WM and CSF for signal extraction
+    select_labels = pe.Node(niu.Select(index=[2, 1]),
+                            name='select_labels',
+                            run_without_submitting=True)
 
     # Set up aCompCor
-    acc_tpm = pe.Node(AddTPMs(indices=[0, 1]), name='tpms_add_csf_wm')
-    acc_roi = pe.Node(TPM2ROI(erode_prop=0.6, mask_erode_prop=0.6**3),
-                      name='acc_roi')
-    resample_acc_roi = pe.Node(ResampleTPM(), name='resampled_acc_roi')
-    acc_msk = pe.Node(niu.Function(function=_maskroi), name='acc_msk')
     acompcor = pe.Node(ACompCor(components_file='acompcor.tsv',
                                 header_prefix='a_comp_cor_',
                                 pre_filter='cosine',
-                                repetition_time=tr,
                                 save_pre_filter=True,
                                 save_metadata=True,
                                 merge_method='none',
-                                mask_names=["combined", "CSF", "WM"],
+                                mask_names=ACOMPCOR_PARAMS['mask_names'],
+                                high_pass_cutoff=ACOMPCOR_PARAMS['period_cut'],
                                 failure_mode="NaN"),
                        name='acompcor')
-    acompcor.inputs.variance_threshold = 0.5
+    acompcor.inputs.variance_threshold = ACOMPCOR_PARAMS['variance_threshold']
 
     # aCompCor metadata extraction
     acc_metadata_fmt = pe.Node(TSV2JSON(
@@ -173,8 +441,6 @@ def init_confound_wf(t1, t1_mask, wm_tpm, csf_tpm, bold, bold_mask, tr,
     acc_meta2json = pe.Node(niu.Function(function=_dict2json,
                                          output_names=['out_meta']),
                             name='acc_meta2json')
-    mrg_lbl_cc = pe.Node(niu.Merge(3), name='merge_rois_acc')
-
     signals_class_labels = ["white_matter", "csf"]
     signals = pe.Node(SignalExtraction(class_labels=signals_class_labels),
                       name="signals")
@@ -182,55 +448,31 @@ def init_confound_wf(t1, t1_mask, wm_tpm, csf_tpm, bold, bold_mask, tr,
     # Nodes to join signal extraction and aCompCor components
 
     outputnode = pe.Node(niu.IdentityInterface(fields=[
-        'signals', 'wm_roi', 'csf_roi', 'acc_roi', 'components_file',
-        'confounds_file', 'confounds_metadata'
+        'signals', 'components_file', 'confounds_file', 'confounds_metadata'
     ]),
                          name='outputnode')
 
-    wf = pe.Workflow(name='confound_wf')
-    wf.config['execution']['crashfile_format'] = 'txt'
+    wf = pe.Workflow(name=name)
 
-    # WM workflow
-    wf.connect([(inputnode, wm_roi, [('wm_tpm', 'in_tpm'),
-                                     ('t1w_mask', 'in_mask')]),
-                (inputnode, resample_wm_roi, [('bold_mask', 'fixed_file')]),
-                (wm_roi, resample_wm_roi, [('roi_file', 'moving_file')]),
-                (inputnode, wm_msk, [('bold_mask', 'in_mask')]),
-                (resample_wm_roi, wm_msk, [('out_file', 'roi_file')])])
-
-    # CSF workflow
-    wf.connect([(inputnode, csf_roi, [('csf_tpm', 'in_tpm'),
-                                      ('t1w_mask', 'in_mask')]),
-                (inputnode, resample_csf_roi, [('bold_mask', 'fixed_file')]),
-                (csf_roi, resample_csf_roi, [('roi_file', 'moving_file')]),
-                (inputnode, csf_msk, [('bold_mask', 'in_mask')]),
-                (resample_csf_roi, csf_msk, [('out_file', 'roi_file')])])
+    # BOLD space ROIs
+    wf.connect([(inputnode, merge_rois, [('acc_roi', 'in1'),
+                                         ('csf_roi', 'in2'),
+                                         ('wm_roi', 'in3')]),
+                (inputnode, bold_rois, [('bold_mask', 'mask_file')]),
+                (merge_rois, bold_rois, [('out', 'roi_files')])])
 
     # Signal extraction workflow
-    wf.connect([(wm_msk, merge_label, [('out', 'in1')]),
-                (csf_msk, merge_label, [('out', 'in2')]),
+    wf.connect([(bold_rois, select_labels, [('out_files', 'inlist')]),
                 (inputnode, signals, [('bold', 'in_file')]),
-                (merge_label, signals, [('out', 'label_files')]),
-                (signals, outputnode, [('out_file', 'signals')]),
-                (wm_roi, outputnode, [('roi_file', 'wm_roi')]),
-                (csf_roi, outputnode, [('roi_file', 'csf_roi')])])
+                (select_labels, signals, [('out', 'label_files')]),
+                (signals, outputnode, [('out_file', 'signals')])])
 
     # ACC workflow
     wf.connect([
-        (inputnode, acc_tpm, [('tpms', 'in_files')]),
-        (inputnode, acc_roi, [('t1w_mask', 'in_mask')]),
-        (acc_tpm, acc_roi, [('out_file', 'in_tpm')]),
-        (inputnode, resample_acc_roi, [('bold_mask', 'fixed_file')]),
-        (acc_roi, resample_acc_roi, [('roi_file', 'moving_file')]),
-        (inputnode, acc_msk, [('bold_mask', 'in_mask')]),
-        (resample_acc_roi, acc_msk, [('out_file', 'roi_file')]),
-        (acc_msk, mrg_lbl_cc, [('out', 'in1')]),
-        (csf_msk, mrg_lbl_cc, [('out', 'in2')]),
-        (wm_msk, mrg_lbl_cc, [('out', 'in3')]),
-        (mrg_lbl_cc, acompcor, [('out', 'mask_files')]),
-        (inputnode, acompcor, [('bold', 'realigned_file')]),
-        (inputnode, acompcor, [('skip_vols', 'ignore_initial_volumes')]),
-        (acc_roi, outputnode, [('roi_file', 'acc_roi')]),
+        (bold_rois, acompcor, [('out_files', 'mask_files')]),
+        (inputnode, acompcor, [('bold', 'realigned_file'),
+                               ('tr', 'repetition_time'),
+                               ('skip_vols', 'ignore_initial_volumes')]),
         (acompcor, outputnode, [('components_file', 'components_file')]),
         (acompcor, acc_metadata_fmt, [('metadata_file', 'in_file')]),
         (acc_metadata_fmt, acc_meta2json, [('output', 'in_dict')]),
@@ -250,6 +492,40 @@ def init_confound_wf(t1, t1_mask, wm_tpm, csf_tpm, bold, bold_mask, tr,
     return wf
 
 
+def _read_tr(bold_json):
+    '''
+    Pull the repetition time of a run from its JSON sidecar
+    '''
+
+    with open(bold_json, 'r') as j:
+        metadata = json.load(j)
+    return metadata['RepetitionTime']
+
+
+def _read_run_info(bold, bold_json):
+    '''
+    Pull the repetition time and number of non-steady state volumes of a run
+    '''
+
+    from niworkflows.interfaces.registration import _get_vols_to_discard
+
+    ref_im = nib.load(bold)
+    skipvol = _get_vols_to_discard(ref_im)
+
+    return _read_tr(bold_json), skipvol
+
+
+def _preload():
+    '''
+    Import the modules of both engines ahead of the jobs of a warm worker
+    '''
+    import direct  # noqa: F401
+    import niworkflows.interfaces.images  # noqa: F401
+    import niworkflows.interfaces.patches  # noqa: F401
+    import niworkflows.interfaces.registration  # noqa: F401
+    import niworkflows.interfaces.utils  # noqa: F401
+
+
 def _dict2json(in_dict):
     '''
     Write a python dictionary into a json file
@@ -266,20 +542,37 @@ def _dict2json(in_dict):
     return out_meta
 
 
-def _maskroi(in_mask, roi_file):
-    import nibabel as nib
-    from nipype.utils.filemanip import fname_presuffix
-    import numpy as np
+def _export_outputs(out_basename, confounds_file, confounds_metadata, wm_roi,
+                    csf_roi, acc_roi):
+    '''
+    Copy the outputs of a single run to their final destination
+    '''
+    import shutil
+    from roi_pack import pack_roi_files, ROIS_SUFFIX
+
+    outputs = [(confounds_file, '_confounds.tsv'),
+               (confounds_metadata, '_confounds.json')]
+
+    out_files = []
+    for in_file, suffix in outputs:
+        out_file = f'{out_basename}{suffix}'
+        shutil.copyfile(in_file, out_file)
+        out_files.append(out_file)
+
+    out_file = f'{out_basename}{ROIS_SUFFIX}'
+    pack_roi_files(out_file, {'wm': wm_roi, 'csf': csf_roi, 'acc': acc_roi})
+    out_files.append(out_file)
+    return out_files
 
-    roi = nib.load(roi_file)
-    roidata = roi.get_data().astype(np.uint8)
-    msk = nib.load(in_mask).get_data().astype(bool)
-    roidata[~msk] = 0
-    roi.set_data_dtype(np.uint8)
 
-    out = fname_presuffix(roi_file, suffix='_boldmsk')
-    roi.__class__(roidata, roi.affine, roi.header).to_filename(out)
-    return out
+def _export_rois(out_file, wm_roi, csf_roi, acc_roi):
+    '''
+    Pack the ROIs of a single run into one container at `out_file`
+    '''
+    from roi_pack import pack_roi_files
+
+    pack_roi_files(out_file, {'wm': wm_roi, 'csf': csf_roi, 'acc': acc_roi})
+    return out_file
 
 
 if __name__ == '__main__':
@@ -0,0 +1,293 @@
+"""
+In-process confound extraction
+
+Runs the operations of the Nipype confound workflow in confounds.py as
+plain functions on in-memory arrays, writing only the final outputs.
+"""
+import json
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from rois import build_rois
+from resample import _resample_masked_rois
+from interfaces import _concat_confounds
+from confound_store import write_columns
+from roi_pack import write_rois, ROIS_SUFFIX
+from volumes import iter_volume_blocks
+
+
+def read_roi_timeseries(bold_file, rois, n_global=50, chunk_mb=256):
+    '''
+    Gather the voxel x time matrix of every ROI in a single pass over the
+    BOLD series
+
+    The BOLD file is memory-mapped (or decompressed once, in order, when
+    compressed) in blocks of whole volumes, so peak memory is bounded by the
+    ROI voxel count and not by the size of the 4D image. The global signal
+    over the first `n_global` volumes is gathered along the way to find
+    non-steady state volumes without a second read.
+
+    Returns the list of ROI matrices and the global signal
+    '''
+
+    n_vols = nib.load(bold_file).shape[3]
+
+    union = np.logical_or.reduce([roi > 0 for roi in rois])
+    union_ts = np.empty((int(union.sum()), n_vols), dtype=np.float32)
+    global_signal = np.empty(min(n_global, n_vols))
+
+    for t0, t1, block in iter_volume_blocks(bold_file, chunk_mb=chunk_mb):
+        union_ts[:, t0:t1] = block[union]
+        if t0 < len(global_signal):
+            n = min(t1, len(global_signal)) - t0
+            global_signal[t0:t0 + n] = block[..., :n].mean(axis=(0, 1, 2))
+        del block
+
+    return [union_ts[(roi > 0)[union]] for roi in rois], global_signal
+
+
+def vols_to_discard(global_signal):
+    '''
+    Number of non-steady state volumes, as niworkflows'
+    _get_vols_to_discard computes from the first volumes' global signal
+    '''
+    from nipype.algorithms.confounds import is_outlier
+    return is_outlier(global_signal)
+
+
+def extract_signals(timeseries, class_labels):
+    '''
+    Average BOLD signal within each ROI at every time point
+    '''
+    return pd.DataFrame(OrderedDict(
+        (label, ts.mean(axis=0, dtype=np.float64))
+        for label, ts in zip(class_labels, timeseries)))
+
+
+def truncated_svd(M, variance_threshold):
+    '''
+    Singular values of a time x voxel matrix, and its left singular vectors
+    up to the one passing `variance_threshold` of the explained variance
+
+    The singular values come from the eigenvalues of the smaller of M M^T
+    and M^T M, found by a tridiagonal reduction without forming any vector.
+    Only the eigenvectors of the retained components are then computed, and
+    the right singular vectors a full SVD also yields are never formed.
+
+    Squared singular values are accurate to about machine precision times
+    the largest one. Retained components match a full SVD to ~1e-14 up to
+    their sign. The trailing singular values lose relative precision once
+    they are orders of magnitude below the largest one. This only shows in
+    the metadata of dropped components, where the values are rounded to 0.
+
+    Components whose singular value is zero, to the precision of the
+    eigenvalues, have no defined singular vector and are never returned, so
+    fewer vectors than the threshold asks for may come back (none for an
+    all-zero matrix).
+    '''
+    from scipy import linalg
+
+    n_times, n_voxels = M.shape
+    gram = M.dot(M.T) if n_times <= n_voxels else M.T.dot(M)
+    n = gram.shape[0]
+
+    evals = np.clip(linalg.eigvalsh(gram)[::-1], 0, None)
+    s = np.sqrt(evals)
+
+    cumulative_variance_explained = np.cumsum(s**2 / np.sum(s**2))
+    num_components = min(
+        int(np.searchsorted(cumulative_variance_explained,
+                            variance_threshold) + 1), n)
+    nonzero = evals > evals[0] * n * np.finfo(evals.dtype).eps
+    num_components = min(num_components, int(np.sum(nonzero)))
+    if num_components == 0:
+        return np.zeros((n_times, 0)), s
+
+    _, vecs = linalg.eigh(gram, subset_by_index=[n - num_components, n - 1])
+    vecs = vecs[:, ::-1]
+
+    if n_times <= n_voxels:
+        return vecs, s
+    return M.dot(vecs) / s[:num_components], s
+
+
+def compute_noise_components(timeseries, mask_names, tr,
+                             variance_threshold=0.5, period_cut=128,
+                             svd='full'):
+    '''
+    aCompCor components for the voxel x time matrix of each mask, following
+    nipype's compute_noise_components with a cosine pre-filter
+
+    With `svd` set to truncated, only the retained components are computed
+    (see truncated_svd) instead of a full SVD of every mask
+    '''
+
+    from nipype.algorithms.confounds import cosine_filter, _compute_tSTD
+
+    components = []
+    metadata = OrderedDict([('mask', []), ('singular_value', []),
+                            ('variance_explained', []),
+                            ('cumulative_variance_explained', []),
+                            ('retained', [])])
+
+    for name, ts in zip(mask_names, timeseries):
+        voxel_timecourses = ts.astype(np.float64)
+        voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
+
+        voxel_timecourses, _ = cosine_filter(voxel_timecourses, tr,
+                                             period_cut)
+        M = voxel_timecourses.T
+        M = M / _compute_tSTD(M, 1.)
+
+        try:
+            if svd == 'truncated':
+                u, s = truncated_svd(M, variance_threshold)
+            else:
+                u, s, _ = np.linalg.svd(M, full_matrices=False)
+        except (np.linalg.LinAlgError, ValueError):
+            s = np.full(M.shape[0], np.nan)
+            u = np.full((M.shape[0], 1), np.nan)
+
+        variance_explained = (s**2) / np.sum(s**2)
+        cumulative_variance_explained = np.cumsum(variance_explained)
+        num_components = min(
+            int(
+                np.searchsorted(cumulative_variance_explained,
+                                variance_threshold) + 1), u.shape[1])
+
+        components.append(u[:, :num_components])
+        metadata['mask'].extend([name] * len(s))
+        metadata['singular_value'].extend(s)
+        metadata['variance_explained'].extend(variance_explained)
+        metadata['cumulative_variance_explained'].extend(
+            cumulative_variance_explained)
+        metadata['retained'].extend(i < num_components
+                                    for i in range(len(s)))
+
+    return np.hstack(components), metadata
+
+
+def acompcor(timeseries, tr, skip_vols, mask_names, variance_threshold=0.5,
+             period_cut=128, header_prefix='a_comp_cor_', svd='full'):
+    '''
+    Compute aCompCor components and their metadata
+
+    Returns the components table, padded with zeros over the non-steady
+    state volumes, and the metadata dictionary as written by TSV2JSON
+    '''
+
+    components, metadata = compute_noise_components(
+        [ts[:, skip_vols:] for ts in timeseries], mask_names, tr,
+        variance_threshold, period_cut, svd)
+    if skip_vols:
+        padded = np.zeros((components.shape[0] + skip_vols,
+                           components.shape[1]))
+        padded[skip_vols:, :] = components
+        components = padded
+
+    header = [f'{header_prefix}{i:02d}' for i in range(components.shape[1])]
+
+    # Values are rounded as they would be through nipype's text outputs
+    components_df = pd.DataFrame(np.round(components, 10), columns=header)
+
+    out_meta = OrderedDict()
+    n_dropped = 0
+    retained = iter(header)
+    for mask, sv, var, cumvar, keep in zip(*metadata.values()):
+        if keep:
+            name = next(retained)
+        else:
+            name = f'dropped_{n_dropped}'
+            n_dropped += 1
+        out_meta[name] = OrderedDict([
+            ('Mask', mask), ('SingularValue', round(float(sv), 10)),
+            ('VarianceExplained', round(float(var), 10)),
+            ('CumulativeVarianceExplained', round(float(cumvar), 10)),
+            ('Retained', bool(keep)), ('Method', 'aCompCor')
+        ])
+
+    return components_df, out_meta
+
+
+def _load(in_file, dtype=None):
+    img = nib.load(in_file)
+    data = np.asanyarray(img.dataobj)
+    if dtype is not None:
+        data = data.astype(dtype)
+    return img, data
+
+
+def build_anat_rois(t1_mask, wm_tpm, csf_tpm, roi_params):
+    '''
+    Build the T1 space WM, CSF and combined aCompCor ROIs in memory
+
+    Returns a dictionary of ROI images keyed by wm, csf and acc
+    '''
+
+    mask_img, mask = _load(t1_mask)
+    wm_img = nib.load(wm_tpm)
+    zooms = mask_img.header.get_zooms()[:3]
+
+    rois = {}
+    for name, roi in build_rois(mask, wm_img.get_fdata(),
+                                nib.load(csf_tpm).get_fdata(), zooms,
+                                roi_params).items():
+        roi_img = nib.Nifti1Image(roi, wm_img.affine, wm_img.header)
+        roi_img.set_data_dtype(np.uint8)
+        rois[name] = roi_img
+    return rois
+
+
+def bold_space_rois(rois, mask_img, resample_cache=None):
+    '''
+    Resample T1 space ROI images to BOLD space and mask them with the BOLD
+    mask, returns uint8 arrays keyed like `rois`
+    '''
+    names = list(rois)
+    resampled = _resample_masked_rois([rois[n] for n in names],
+                                      mask_img,
+                                      cache_dir=resample_cache)
+    return {n: np.asanyarray(img.dataobj) for n, img in zip(names, resampled)}
+
+
+def run_bold_confounds(rois,
+                       bold,
+                       bold_mask,
+                       tr,
+                       outbase,
+                       acompcor_params,
+                       resample_cache=None,
+                       svd='full'):
+    '''
+    Project the T1 space ROIs into BOLD space, extract signals and aCompCor
+    components and write the outputs of a single run
+    '''
+
+    bold_rois = bold_space_rois(rois, nib.load(bold_mask), resample_cache)
+
+    # Single read of the BOLD series for signals, aCompCor and dummy scans
+    (acc_ts, csf_ts, wm_ts), global_signal = read_roi_timeseries(
+        bold, [bold_rois['acc'], bold_rois['csf'], bold_rois['wm']])
+    skip_vols = vols_to_discard(global_signal)
+
+    signals = extract_signals([wm_ts, csf_ts], ['white_matter', 'csf'])
+    components, metadata = acompcor([acc_ts, csf_ts, wm_ts], tr, skip_vols,
+                                    svd=svd, **acompcor_params)
+    del acc_ts, csf_ts, wm_ts
+
+    confounds = _concat_confounds([signals, components])
+    confounds.to_csv(f'{outbase}_confounds.tsv',
+                     sep='\t',
+                     index=False,
+                     na_rep='n/a')
+    write_columns(confounds, f'{outbase}_confounds.npz')
+
+    with open(f'{outbase}_confounds.json', 'w') as f:
+        json.dump(metadata, f, indent=3)
+
+    write_rois(f'{outbase}{ROIS_SUFFIX}',
+               {n: img.dataobj for n, img in rois.items()},
+               next(iter(rois.values())))
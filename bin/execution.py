@@ -0,0 +1,114 @@
+"""Nipype plugin selection and thread limits sized to the task's resources."""
+import os
+
+# Thread pools of ANTs/ITK, OpenMP and the BLAS backends numpy may use
+THREAD_VARS = [
+    'OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+    'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'
+]
+
+
+def add_execution_args(parser):
+    '''
+    Add the --nprocs and --mem-gb options to a script's argument parser
+    '''
+    parser.add_argument('--nprocs',
+                        type=int,
+                        help='Number of processes to run workflow nodes '
+                        'on, defaults to the CPUs allocated to the task')
+    parser.add_argument('--mem-gb',
+                        type=float,
+                        help='Memory available to the workflow in GB, '
+                        'defaults to the memory allocated by SLURM if any')
+
+
+def add_engine_args(parser):
+    '''
+    Add the --engine and --acompcor-svd options selecting how confounds are
+    computed to a script's argument parser
+    '''
+    parser.add_argument('--engine',
+                        choices=['nipype', 'direct'],
+                        default='nipype',
+                        help='Run through the Nipype workflow engine or '
+                        'in-process on in-memory arrays, only writing '
+                        'the final outputs (default: nipype)')
+    parser.add_argument('--acompcor-svd',
+                        choices=['full', 'truncated'],
+                        default='full',
+                        help='Decompose each aCompCor mask with a full SVD, '
+                        'or only compute the components up to the variance '
+                        'threshold, which is faster on long runs and large '
+                        'masks. Components match up to their sign. Only '
+                        'with --engine direct (default: full)')
+
+
+def task_resources(nprocs=None, mem_gb=None):
+    '''
+    Number of processes and memory in GB to run a workflow with, falling
+    back to the CPUs this process may run on and the SLURM allocation
+    '''
+    if nprocs is None:
+        nprocs = _allocated_cpus()
+    if mem_gb is None:
+        mem_gb = _allocated_mem_gb(nprocs)
+    return max(int(nprocs), 1), mem_gb
+
+
+def limit_threads(nthreads=1):
+    '''
+    Cap the threads of every pool a node may start, so nodes running side
+    by side do not oversubscribe the cores. Interfaces with their own
+    thread setting (e.g. ANTs num_threads) still override it per command.
+
+    Variables already set in the environment are left alone.
+    '''
+    for var in THREAD_VARS:
+        os.environ.setdefault(var, str(nthreads))
+
+    # BLAS pools already loaded in this process ignore the environment
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(int(os.environ['OMP_NUM_THREADS']))
+    except ImportError:
+        pass
+
+
+def run_workflow(wf, profiler=None, nprocs=1, mem_gb=None):
+    '''
+    Run a workflow, on a MultiProc pool of `nprocs` processes and `mem_gb`
+    of memory when more than one process is available, recording every
+    node with `profiler` if given
+    '''
+    plugin, plugin_args = 'Linear', {}
+    if nprocs > 1:
+        plugin, plugin_args = 'MultiProc', {'n_procs': nprocs}
+        if mem_gb:
+            plugin_args['memory_gb'] = mem_gb
+    if profiler is not None:
+        profiler.concurrent = plugin != 'Linear'
+        plugin_args['status_callback'] = profiler
+    return wf.run(plugin=plugin, plugin_args=plugin_args)
+
+
+def _allocated_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    slurm_cpus = os.environ.get('SLURM_CPUS_PER_TASK')
+    if slurm_cpus:
+        cpus = min(cpus, int(slurm_cpus))
+    return cpus
+
+
+def _allocated_mem_gb(nprocs):
+    '''
+    SLURM memory allocation in GB, None outside of a SLURM job
+    '''
+    if os.environ.get('SLURM_MEM_PER_NODE'):
+        return int(os.environ['SLURM_MEM_PER_NODE']) / 1024
+    if os.environ.get('SLURM_MEM_PER_CPU'):
+        return int(os.environ['SLURM_MEM_PER_CPU']) * nprocs / 1024
+    return None
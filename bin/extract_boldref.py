@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Extract the first volume of every BOLD series of a subject for
+generate_pepolar.nf
+
+Replaces one fslroi task per series with a single call per subject. Only the
+first volume of each series is read: it sits at the start of the image data,
+so a compressed series is decompressed up to the end of that volume and no
+further. The reference volumes are written as <sub>_<series>_boldref.nii.gz
+along with a copy of each series' JSON sidecar, across files on a bounded
+pool of workers. Series without a sidecar are skipped with a warning.
+"""
+import os
+import sys
+import shutil
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import nibabel as nib
+
+from execution import task_resources
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Write the first volume of BOLD series as boldref '
+        'images with their JSON sidecars')
+    parser.add_argument('sub', type=str, help='Subject, prefix of outputs')
+    parser.add_argument('series',
+                        nargs='+',
+                        type=_series_arg,
+                        help='SERIES=BOLD pairs of series numbers and BOLD '
+                        'files')
+    parser.add_argument('--nprocs',
+                        type=int,
+                        help='Number of files to extract at once, defaults '
+                        'to the CPUs allocated to the task')
+
+    args = parser.parse_args()
+    nprocs, _ = task_resources(args.nprocs)
+
+    jobs = [(bold, f'{args.sub}_{ser}_boldref') for ser, bold in args.series]
+    with mp.get_context('fork').Pool(min(nprocs, len(jobs))) as pool:
+        results = pool.starmap(write_boldref, jobs)
+
+    skipped = [bold for (bold, _), ok in zip(jobs, results) if not ok]
+    for bold in skipped:
+        sys.stderr.write(f'WARNING: no JSON sidecar found for {bold}, '
+                         'skipping it\n')
+    return 0
+
+
+def _series_arg(value):
+    ser, sep, bold = value.partition('=')
+    if not sep or not ser or not bold:
+        raise argparse.ArgumentTypeError(f'Expected SERIES=BOLD, got {value}')
+    return ser, bold
+
+
+def first_volume(bold_file):
+    '''
+    First volume of a 4D series as a single volume 4D image, reading only
+    the bytes of that volume
+    '''
+    img = nib.load(bold_file)
+    data = np.asanyarray(img.dataobj[..., :1])
+
+    header = img.header.copy()
+    header.set_data_shape(data.shape)
+    out_img = nib.Nifti1Image(data, img.affine, header)
+    out_img.set_data_dtype(img.get_data_dtype())
+    return out_img
+
+
+def write_boldref(bold_file, out_base):
+    '''
+    Write the first volume of `bold_file` to `out_base`.nii.gz and copy its
+    JSON sidecar, found next to the file it links to, to `out_base`.json.
+    Nothing is written when there is no sidecar. Returns whether the
+    sidecar was found
+    '''
+    sidecar = _sidecar(os.path.realpath(bold_file))
+    if not os.path.exists(sidecar):
+        sidecar = _sidecar(bold_file)
+    if not os.path.exists(sidecar):
+        return False
+
+    first_volume(bold_file).to_filename(f'{out_base}.nii.gz')
+    shutil.copyfile(sidecar, f'{out_base}.json')
+    return True
+
+
+def _sidecar(nifti):
+    return nifti[:-len('.nii.gz')] + '.json' if nifti.endswith(
+        '.nii.gz') else os.path.splitext(nifti)[0] + '.json'
+
+
+if __name__ == '__main__':
+    sys.exit(main())
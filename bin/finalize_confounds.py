@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Merge recalculated confounds into the fMRIPrep confounds of every run of a
+subject and write the desc-confounds_fixedregressors files in place
+"""
+import os
+import json
+import argparse
+import tempfile
+
+import pandas as pd
+
+from manifest import write_manifest, confound_params
+from execution import add_engine_args
+from confound_store import write_columns, columns_path
+
+# Signals expanded with their derivative and powers
+EXPANDED_SIGNALS = ['white_matter', 'csf']
+
+IN_SUFFIX = '_desc-confounds_regressors'
+OUT_SUFFIX = '_desc-confounds_fixedregressors'
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Merge recalculated confounds into the fMRIPrep '
+        'confounds of all BOLD runs of a subject')
+    parser.add_argument('--run',
+                        nargs=4,
+                        action='append',
+                        required=True,
+                        metavar=('NEW_TSV', 'NEW_JSON', 'TSV', 'JSON'),
+                        help='Recalculated confounds and metadata of a run, '
+                        'and the fMRIPrep confounds and metadata they '
+                        'replace. Outputs are written next to the fMRIPrep '
+                        'files. Can be repeated')
+    parser.add_argument('--no-manifest',
+                        action='store_true',
+                        help='Do not record the inputs and settings of each '
+                        'run next to its outputs')
+    add_engine_args(parser)
+
+    args = parser.parse_args()
+    params = confound_params(args.engine, args.acompcor_svd)
+
+    for new_tsv, new_json, tsv, json_file in args.run:
+        out_tsv, _ = finalize_run(new_tsv, new_json, tsv, json_file)
+        if not args.no_manifest:
+            base = os.path.basename(out_tsv)[:-len(OUT_SUFFIX + '.tsv')]
+            write_manifest(os.path.dirname(out_tsv), base, params)
+
+
+def finalize_run(new_tsv, new_json, tsv, json_file):
+    '''
+    Write the merged confounds, their columnar sidecar and metadata of a
+    single run next to the fMRIPrep confounds, following symlinks to the
+    original files
+    '''
+
+    out_tsv = _output_path(tsv, '.tsv')
+    out_json = _output_path(json_file, '.json')
+
+    confounds = merge_confounds(pd.read_csv(tsv, delimiter='\t'),
+                                pd.read_csv(new_tsv, delimiter='\t'))
+
+    with open(json_file, 'r') as f:
+        meta = json.load(f)
+    with open(new_json, 'r') as f:
+        new_meta = json.load(f)
+    metadata = merge_metadata(meta, new_meta)
+
+    _atomic_write(out_tsv,
+                  lambda f: confounds.to_csv(f, sep='\t', index=False))
+    _atomic_write(columns_path(out_tsv),
+                  lambda f: write_columns(confounds, f),
+                  mode='wb')
+    _atomic_write(out_json, lambda f: json.dump(metadata, f, indent=2))
+    return out_tsv, out_json
+
+
+def merge_confounds(old_tsv, new_tsv):
+    '''
+    Replace the WM, CSF and aCompCor confounds of fMRIPrep with the
+    recalculated ones, suffixed with _fixed, adding the derivative and
+    power expansions of the WM and CSF signals
+    '''
+
+    # Calculate derivates and powers
+    for d in EXPANDED_SIGNALS:
+        deriv_name = d + '_derivative1'
+        new_tsv[deriv_name] = new_tsv[d].diff()
+        new_tsv[d + '_power2'] = new_tsv[d]**2
+        new_tsv[deriv_name + '_power2'] = new_tsv[deriv_name]**2
+
+    # Rename heads in
+    cols = new_tsv.columns
+    new_tsv.columns = ['{}_fixed'.format(c) for c in cols]
+
+    # Drop component based columns and replaced columns in old TSV
+    drop_cols = [c for c in old_tsv.columns if 'a_comp_cor' in c.lower()]
+    old_tsv = old_tsv.drop(columns=drop_cols)
+    old_tsv = old_tsv.drop(columns=cols, errors='ignore')
+
+    return old_tsv.merge(new_tsv, left_index=True, right_index=True)
+
+
+def merge_metadata(meta, new_meta):
+    '''
+    Replace the aCompCor entries of fMRIPrep's metadata with the
+    recalculated ones
+    '''
+    cleaned_meta = {
+        k: v
+        for k, v in meta.items() if not (('a_comp' in k) or ('dropped' in k))
+    }
+    return {**cleaned_meta, **new_meta}
+
+
+def _output_path(in_file, ext):
+    real = os.path.realpath(in_file)
+    base = os.path.basename(real)
+    if not base.endswith(IN_SUFFIX + ext):
+        raise ValueError(f'{in_file} is not an fMRIPrep confounds file '
+                         f'(*{IN_SUFFIX}{ext})')
+    out_name = base[:-len(IN_SUFFIX + ext)] + OUT_SUFFIX + ext
+    return os.path.join(os.path.dirname(real), out_name)
+
+
+def _atomic_write(out_file, write, mode='w'):
+    '''
+    Write a file through a temporary file in the same directory, renamed
+    over the destination once complete
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(out_file),
+                               prefix='.tmp',
+                               suffix=os.path.basename(out_file))
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, out_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Index the runs of an fMRIPrep derivatives directory for
+recalculate_confounds.nf
+
+Walks the derivatives tree once and keeps the listing of every directory in
+an SQLite database, along with the BIDS entities parsed from each file name.
+On later calls a directory is only listed again when its modification time
+changed, so only new or modified subjects and sessions are rescanned. Runs
+are printed as a tab separated work list with the T1w, BOLD, mask, JSON and
+confound files they need. Runs that miss any of them are reported and left
+out instead of being silently dropped downstream.
+"""
+import os
+import sys
+import sqlite3
+import argparse
+
+from manifest import run_basename
+from execution import add_engine_args
+
+INDEX_NAME = '.confounds_index.sqlite'
+
+COLUMNS = [
+    'sub', 'ses', 'base', 't1w', 't1w_mask', 'bold', 'bold_mask', 'bold_json',
+    'confounds', 'confounds_json'
+]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    base TEXT,
+    space TEXT,
+    desc TEXT,
+    suffix TEXT,
+    ext TEXT,
+    PRIMARY KEY (dir, name)
+);
+'''
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Print the work list of BOLD runs of an fMRIPrep '
+        'directory, refreshing a persistent index of its files')
+    parser.add_argument('fmriprep', type=str, help='fMRIPrep derivatives')
+    parser.add_argument('--db',
+                        type=str,
+                        help='SQLite index to reuse and update, :memory: '
+                        'to not keep one (default: FMRIPREP/' + INDEX_NAME +
+                        ')')
+    parser.add_argument('--subjects',
+                        type=str,
+                        help='File listing the subjects to index')
+    parser.add_argument('--stale',
+                        action='store_true',
+                        help='Only list runs whose recalculated confounds '
+                        'are missing or out of date')
+    add_engine_args(parser)
+
+    args = parser.parse_args()
+    fmriprep = os.path.abspath(args.fmriprep)
+
+    subjects = None
+    if args.subjects:
+        with open(args.subjects, 'r') as f:
+            subjects = {s.strip() for s in f if s.strip()}
+
+    index = DerivativesIndex(args.db or os.path.join(fmriprep, INDEX_NAME))
+    runs, incomplete = index.runs(fmriprep, subjects)
+    index.close()
+
+    for run, missing in incomplete:
+        sys.stderr.write(f'Skipping {run["base"]}, missing '
+                         f'{", ".join(missing)}\n')
+
+    if args.stale:
+        from manifest import is_stale, confound_params
+        params = confound_params(args.engine, args.acompcor_svd)
+        runs = [
+            r for r in runs
+            if is_stale(os.path.dirname(r['bold']), r['base'], params)
+        ]
+
+    sys.stdout.write('\t'.join(COLUMNS) + '\n')
+    for run in runs:
+        sys.stdout.write('\t'.join(run[c] for c in COLUMNS) + '\n')
+
+
+class DerivativesIndex(object):
+    '''
+    Directory listings of an fMRIPrep tree, persisted in SQLite and
+    refreshed by directory modification time
+    '''
+
+    def __init__(self, db_path=':memory:'):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def runs(self, fmriprep_dir, subjects=None):
+        '''
+        Complete runs as dictionaries of the work list columns, and the
+        incomplete ones along with the files they miss. Directories whose
+        modification time changed are rescanned along the way.
+        '''
+        runs, incomplete = [], []
+        with self.conn:
+            for sub in self._subjects(fmriprep_dir, subjects):
+                anat_dir = os.path.join(fmriprep_dir, sub, 'anat')
+                anat = {
+                    't1w': f'{sub}_desc-preproc_T1w.nii.gz',
+                    't1w_mask': f'{sub}_desc-brain_mask.nii.gz'
+                }
+                _, anat_files = self.listdir(anat_dir)
+                anat_missing = [f for f in anat.values() if f not in anat_files]
+
+                for ses, func_dir in self._func_dirs(fmriprep_dir, sub):
+                    _, files = self.listdir(func_dir)
+                    for base in self._bold_runs(func_dir):
+                        run = _run_files(base)
+                        missing = anat_missing + [
+                            f for f in run.values() if f not in files
+                        ]
+                        run = {k: os.path.join(func_dir, f)
+                               for k, f in run.items()}
+                        run.update({k: os.path.join(anat_dir, f)
+                                    for k, f in anat.items()})
+                        run.update({'sub': sub, 'ses': ses, 'base': base})
+                        if missing:
+                            incomplete.append((run, missing))
+                        else:
+                            runs.append(run)
+        return runs, incomplete
+
+    def listdir(self, path):
+        '''
+        Subdirectories and files of a directory, from the index unless its
+        modification time changed
+        '''
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+
+        row = self.conn.execute('SELECT mtime_ns FROM dirs WHERE path = ?',
+                                (path, )).fetchone()
+        if mtime_ns is None or row is None or row[0] != mtime_ns:
+            self._rescan(path, mtime_ns)
+
+        subdirs, files = [], []
+        for name, is_dir in self.conn.execute(
+                'SELECT name, is_dir FROM entries WHERE dir = ? '
+                'ORDER BY name', (path, )):
+            (subdirs if is_dir else files).append(name)
+        return subdirs, files
+
+    def _subjects(self, fmriprep_dir, subjects=None):
+        subdirs, _ = self.listdir(fmriprep_dir)
+        return [
+            s for s in subdirs
+            if s.startswith('sub-') and (subjects is None or s in subjects)
+        ]
+
+    def _func_dirs(self, fmriprep_dir, sub):
+        '''
+        (session, directory) of the func directories of a subject, the
+        session is empty for a subject without sessions
+        '''
+        sub_dir = os.path.join(fmriprep_dir, sub)
+        subdirs, _ = self.listdir(sub_dir)
+        func_dirs = [('', os.path.join(sub_dir, 'func'))
+                     ] if 'func' in subdirs else []
+        for ses in subdirs:
+            ses_dir = os.path.join(sub_dir, ses)
+            if ses.startswith('ses-') and 'func' in self.listdir(ses_dir)[0]:
+                func_dirs.append((ses, os.path.join(ses_dir, 'func')))
+        return func_dirs
+
+    def _bold_runs(self, func_dir):
+        return [
+            base for base, in self.conn.execute(
+                'SELECT base FROM entries WHERE dir = ? AND space = ? '
+                'AND desc = ? AND suffix = ? AND ext = ? ORDER BY base',
+                (func_dir, 'T1w', 'preproc', 'bold', '.nii.gz'))
+        ]
+
+    def _rescan(self, path, mtime_ns):
+        self.conn.execute('DELETE FROM entries WHERE dir = ?', (path, ))
+        self.conn.execute('DELETE FROM dirs WHERE path = ?', (path, ))
+        if mtime_ns is None:
+            return
+
+        rows = []
+        with os.scandir(path) as it:
+            for entry in it:
+                is_dir = entry.is_dir()
+                entities = {} if is_dir else parse_entities(entry.name)
+                rows.append((path, entry.name, is_dir, entities.get('base'),
+                             entities.get('space'), entities.get('desc'),
+                             entities.get('suffix'), entities.get('ext')))
+        self.conn.executemany(
+            'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.execute('INSERT INTO dirs VALUES (?, ?)', (path, mtime_ns))
+
+
+def _run_files(base):
+    '''
+    fMRIPrep func files of a run, keyed by work list column
+    '''
+    bold = f'{base}_space-T1w_desc-preproc_bold'
+    return {
+        'bold': f'{bold}.nii.gz',
+        'bold_json': f'{bold}.json',
+        'bold_mask': f'{base}_space-T1w_desc-brain_mask.nii.gz',
+        'confounds': f'{base}_desc-confounds_regressors.tsv',
+        'confounds_json': f'{base}_desc-confounds_regressors.json'
+    }
+
+
+def parse_entities(filename):
+    '''
+    BIDS entities, suffix and extension of a file name, along with the run
+    basename recalculate_confounds.nf derives from it
+
+    >>> e = parse_entities('sub-A_ses-1_task-rest_space-T1w_desc-preproc_bold.nii.gz')
+    >>> e['sub'], e['space'], e['desc'], e['suffix'], e['ext'], e['base']
+    ('A', 'T1w', 'preproc', 'bold', '.nii.gz', 'sub-A_ses-1_task-rest')
+    '''
+    stem, dot, ext = filename.partition('.')
+    parts = stem.split('_')
+    entities = {'ext': dot + ext, 'base': run_basename(filename)}
+    if parts and '-' not in parts[-1]:
+        entities['suffix'] = parts.pop()
+    for part in parts:
+        key, sep, value = part.partition('-')
+        if sep:
+            entities[key] = value
+    return entities
+
+
+if __name__ == '__main__':
+    main()
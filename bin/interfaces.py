@@ -19,7 +19,8 @@ from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces.base import (traits, TraitedSpec,
                                     BaseInterfaceInputSpec, File, Directory,
                                     isdefined, SimpleInterface)
-from niworkflows.viz.plots import fMRIPlot
+
+from confound_store import write_columns, columns_path
 
 LOGGER = logging.getLogger('nipype.interface')
 
@@ -38,6 +39,8 @@ class GatherConfoundsInputSpec(BaseInterfaceInputSpec):
 
 class GatherConfoundsOutputSpec(TraitedSpec):
     confounds_file = File(exists=True, desc='output confounds file')
+    columns_file = File(exists=True,
+                        desc='columnar .npz sidecar of the confounds file')
     confounds_list = traits.List(traits.Str, desc='list of headers')
 
 
@@ -90,6 +93,7 @@ class GatherConfounds(SimpleInterface):
             newpath=runtime.cwd,
         )
         self._results['confounds_file'] = combined_out
+        self._results['columns_file'] = columns_path(combined_out)
         self._results['confounds_list'] = confounds_list
         return runtime
 
@@ -106,7 +110,7 @@ def _gather_confounds(signals=None,
                       newpath=None):
     """
     Load confounds from the filenames, concatenate together horizontally
-    and save new file.
+    and save new file, along with its columnar sidecar.
 
     >>> from tempfile import TemporaryDirectory
     >>> tmpdir = TemporaryDirectory()
@@ -121,30 +125,21 @@ def _gather_confounds(signals=None,
     ...             engine='python')  # doctest: +NORMALIZE_WHITESPACE
        global_signal  std_dvars
     0            0.1        0.2
+
+    Shorter sources are padded with missing values at the top, whichever
+    source is the longest. Earlier versions reordered the rows of a source
+    longer than the ones before it, putting the padding at the bottom.
+
+    >>> pd.DataFrame({'aCompCor': [0.3, 0.4]}).to_csv('acompcor.tsv', sep='\\t', index=False)
+    >>> out_file, _ = _gather_confounds('signals.tsv', acompcor='acompcor.tsv')
+    >>> pd.read_csv(out_file, sep='\\t')  # doctest: +NORMALIZE_WHITESPACE
+       global_signal  a_comp_cor
+    0            NaN         0.3
+    1            0.1         0.4
     >>> tmpdir.cleanup()
 
 
     """
-    def less_breakable(a_string):
-        ''' hardens the string to different envs (i.e. case insensitive, no whitespace, '#' '''
-        return ''.join(a_string.split()).strip('#')
-
-    # Taken from https://stackoverflow.com/questions/1175208/
-    # If we end up using it more than just here, probably worth pulling in a well-tested package
-    def camel_to_snake(name):
-        s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
-        return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
-
-    def _adjust_indices(left_df, right_df):
-        # This forces missing values to appear at the beggining of the DataFrame
-        # instead of the end
-        index_diff = len(left_df.index) - len(right_df.index)
-        if index_diff > 0:
-            right_df.index = range(index_diff,
-                                   len(right_df.index) + index_diff)
-        elif index_diff < 0:
-            left_df.index = range(-index_diff, len(left_df.index) - index_diff)
-
     all_files = []
     confounds_list = []
     for confound, name in ((signals, 'Global signals'), (std_dvars,
@@ -159,22 +154,132 @@ def _gather_confounds(signals=None,
             if os.path.exists(confound) and os.stat(confound).st_size > 0:
                 all_files.append(confound)
 
-    confounds_data = pd.DataFrame()
-    for file_name in all_files:  # assumes they all have headings already
-        new = pd.read_csv(file_name, sep="\t")
-        for column_name in new.columns:
-            new.rename(columns={
-                column_name: camel_to_snake(less_breakable(column_name))
-            },
-                       inplace=True)
-
-        _adjust_indices(confounds_data, new)
-        confounds_data = pd.concat((confounds_data, new), axis=1)
+    # assumes they all have headings already, only the headers and row
+    # counts are read before the output is laid out
+    layout = _confounds_layout(_read_header(f) for f in all_files)
+    confounds_data = _fill_confounds(
+        layout, (pd.read_csv(file_name, sep="\t") for file_name in all_files))
 
     if newpath is None:
         newpath = os.getcwd()
 
     combined_out = os.path.join(newpath, 'confounds.tsv')
     confounds_data.to_csv(combined_out, sep='\t', index=False, na_rep='n/a')
+    write_columns(confounds_data, columns_path(combined_out))
 
     return combined_out, confounds_list
+
+
+def _concat_confounds(frames):
+    """
+    Concatenate confound tables horizontally, normalizing column names to
+    snake_case and padding shorter tables with missing values at the top.
+
+    >>> _concat_confounds([pd.DataFrame({'CSF': [0.1, 0.2]}),
+    ...                    pd.DataFrame({'aCompCor': [0.3]})])
+       csf  a_comp_cor
+    0  0.1         NaN
+    1  0.2         0.3
+
+    """
+    frames = list(frames)
+    layout = _confounds_layout((f.columns, len(f.index)) for f in frames)
+    return _fill_confounds(layout, frames)
+
+
+def _less_breakable(a_string):
+    ''' hardens the string to different envs (i.e. case insensitive, no whitespace, '#' '''
+    return ''.join(a_string.split()).strip('#')
+
+
+# Taken from https://stackoverflow.com/questions/1175208/
+# If we end up using it more than just here, probably worth pulling in a well-tested package
+def _camel_to_snake(name):
+    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
+    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+
+
+def _read_header(in_file):
+    """
+    Column names and number of rows of a TSV file, without parsing its values
+
+    >>> from tempfile import TemporaryDirectory
+    >>> tmpdir = TemporaryDirectory()
+    >>> os.chdir(tmpdir.name)
+    >>> pd.DataFrame({'a': [0.1, 0.2], 'b': [1, 2]}).to_csv(
+    ...     'conf.tsv', sep='\\t', index=False)
+    >>> _read_header('conf.tsv')
+    (['a', 'b'], 2)
+    >>> tmpdir.cleanup()
+
+    """
+    columns = list(pd.read_csv(in_file, sep="\t", nrows=0).columns)
+    with open(in_file, 'r') as f:
+        n_lines = sum(1 for line in f if line.rstrip('\r\n'))
+    return columns, max(n_lines - 1, 0)
+
+
+def _confounds_layout(headers):
+    """
+    Lay out the combined confounds table from the (columns, number of rows)
+    of each source
+
+    Returns the snake_case column names, the number of rows and, for each
+    source, its first column and the row offset aligning it to the bottom
+    of the table
+
+    >>> _confounds_layout([(['CSF', 'WhiteMatter'], 3), (['aCompCor'], 2)])
+    (['csf', 'white_matter', 'a_comp_cor'], 3, [(0, 0), (2, 1)])
+
+    """
+    headers = list(headers)
+    n_rows = max((n for _, n in headers), default=0)
+
+    names = []
+    sources = []
+    for columns, n in headers:
+        sources.append((len(names), n_rows - n))
+        names.extend(_camel_to_snake(_less_breakable(c)) for c in columns)
+
+    return names, n_rows, sources
+
+
+def _fill_confounds(layout, frames):
+    """
+    Fill the table laid out by _confounds_layout from the source frames
+
+    Float columns, and integer columns that get padded, are written into a
+    single preallocated array. Any other column keeps the dtype it would
+    get from a pandas concatenation so the written table is unchanged.
+    """
+    names, n_rows, sources = layout
+    if not names:
+        return pd.DataFrame()
+
+    data = np.full((n_rows, len(names)), np.nan)
+    others = {}
+    for (start, offset), frame in zip(sources, frames):
+        if len(frame.index) != n_rows - offset:
+            raise ValueError('Confounds source has {} rows, expected '
+                             '{}'.format(len(frame.index), n_rows - offset))
+        for j in range(frame.shape[1]):
+            column = frame.iloc[:, j]
+            kind = column.dtype.kind
+            if column.dtype == np.float64 or (offset and kind in 'iu'):
+                data[offset:, start + j] = column.values
+            else:
+                column = pd.Series(column.values,
+                                   index=range(offset, n_rows))
+                others[start + j] = column.reindex(range(n_rows))
+
+    confounds_data = pd.DataFrame(data, columns=names)
+    if others:
+        confounds_data = pd.concat([
+            others.get(i, confounds_data.iloc[:, i])
+            for i in range(len(names))
+        ],
+                                   axis=1,
+                                   keys=range(len(names)))
+        confounds_data.columns = names
+
+    return confounds_data
@@ -0,0 +1,159 @@
+"""
+Manifests of the inputs and settings behind each recalculated confounds
+file, used to find the runs of an fMRIPrep directory that need a rerun
+"""
+import os
+import re
+import json
+
+from cache import hash_file
+
+MANIFEST_SUFFIX = '_desc-confounds_fixedregressors_manifest.json'
+OUTPUT_SUFFIX = '_desc-confounds_fixedregressors.tsv'
+
+
+def run_basename(bold_file):
+    '''
+    Run basename of a BOLD file, as recalculate_confounds.nf derives it
+
+    >>> run_basename('sub-A_ses-1_task-rest_space-T1w_desc-preproc_bold.nii.gz')
+    'sub-A_ses-1_task-rest'
+    '''
+    base = re.sub(r'_desc.*', '', os.path.basename(bold_file))
+    return re.sub(r'_space-[A-Za-z0-9]+_?', '', base, count=1)
+
+
+def run_inputs(func_dir, base):
+    '''
+    fMRIPrep files a run's recalculated confounds are computed from
+    '''
+    func_dir = os.path.realpath(func_dir)
+    sub = base.split('_')[0]
+    anat_dir = os.path.join(_subject_dir(func_dir, sub), 'anat')
+    bold = os.path.join(func_dir, f'{base}_space-T1w_desc-preproc_bold')
+    return {
+        't1w': os.path.join(anat_dir, f'{sub}_desc-preproc_T1w.nii.gz'),
+        't1w_mask': os.path.join(anat_dir, f'{sub}_desc-brain_mask.nii.gz'),
+        'bold': f'{bold}.nii.gz',
+        'bold_json': f'{bold}.json',
+        'bold_mask': os.path.join(func_dir,
+                                  f'{base}_space-T1w_desc-brain_mask.nii.gz'),
+        'confounds': os.path.join(func_dir,
+                                  f'{base}_desc-confounds_regressors.tsv'),
+        'confounds_json': os.path.join(
+            func_dir, f'{base}_desc-confounds_regressors.json')
+    }
+
+
+def _subject_dir(func_dir, sub):
+    '''
+    Subject directory of a func directory, with or without sessions
+
+    >>> _subject_dir('/fmriprep/sub-A/ses-1/func', 'sub-A')
+    '/fmriprep/sub-A'
+    >>> _subject_dir('/fmriprep/sub-A/func', 'sub-A')
+    '/fmriprep/sub-A'
+    '''
+    parent = os.path.dirname(func_dir)
+    if os.path.basename(parent) == sub:
+        return parent
+    return os.path.dirname(parent)
+
+
+def build_manifest(inputs, params, previous=None):
+    '''
+    Record the size, modification time and SHA-256 of every input along
+    with the settings used. Hashes are reused from a previous manifest for
+    files whose size and modification time did not change.
+    '''
+    previous = (previous or {}).get('inputs', {})
+    files = {}
+    for name, in_file in sorted(inputs.items()):
+        st = os.stat(in_file)
+        entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        prev = previous.get(name, {})
+        if all(prev.get(k) == v for k, v in entry.items()):
+            entry['sha256'] = prev['sha256']
+        else:
+            entry['sha256'] = hash_file(in_file)
+        files[name] = entry
+    return {'inputs': files, 'params': json.loads(json.dumps(params))}
+
+
+def confound_params(engine='nipype', acompcor_svd='full'):
+    '''
+    ROI and aCompCor settings of the confound workflow, along with the
+    engine and SVD the confounds are computed with and the version of the
+    code computing them
+    '''
+    from confounds import ROI_PARAMS, ACOMPCOR_PARAMS, CONFOUNDS_VERSION
+    return {
+        'roi': ROI_PARAMS,
+        'acompcor': ACOMPCOR_PARAMS,
+        'engine': engine,
+        'acompcor_svd': acompcor_svd,
+        'version': CONFOUNDS_VERSION
+    }
+
+
+def _read_manifest(manifest_file):
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(func_dir, base, params):
+    '''
+    Write the manifest of a run next to its recalculated confounds
+    '''
+    out_file = os.path.join(os.path.realpath(func_dir),
+                            base + MANIFEST_SUFFIX)
+    manifest = build_manifest(run_inputs(func_dir, base),
+                              params,
+                              previous=_read_manifest(out_file))
+    tmp = out_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, out_file)
+    return out_file
+
+
+def is_stale(func_dir, base, params):
+    '''
+    Whether a run has no recalculated confounds, or had them computed from
+    other inputs or settings than the current ones
+    '''
+    if not os.path.exists(os.path.join(func_dir, base + OUTPUT_SUFFIX)):
+        return True
+    manifest = _read_manifest(os.path.join(func_dir, base + MANIFEST_SUFFIX))
+    if manifest is None:
+        return True
+
+    try:
+        current = build_manifest(run_inputs(func_dir, base), params,
+                                 previous=manifest)
+    except OSError:
+        return True
+
+    def _hashes(m):
+        return {k: v['sha256'] for k, v in m['inputs'].items()}
+
+    return (_hashes(current) != _hashes(manifest)
+            or current['params'] != manifest.get('params'))
+
+
+def find_stale_runs(fmriprep_dir, params, subjects=None, db=':memory:'):
+    '''
+    (subject, run basename) of every complete run under an fMRIPrep
+    directory whose recalculated confounds are missing or out of date, as
+    listed by the derivatives index in `db`
+    '''
+    from index_fmriprep import DerivativesIndex
+
+    index = DerivativesIndex(db)
+    runs, _ = index.runs(os.path.abspath(fmriprep_dir), subjects)
+    index.close()
+    return [(r['sub'], r['base']) for r in runs
+            if is_stale(os.path.dirname(r['bold']), r['base'], params)]
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+Plan the run_bids jobs of bids.nf from the runtime history of past runs
+
+Writes the invocation JSON of every subject in one pass, predicts how long
+and how much memory each subject needs, and packs subjects into batches that
+run one after the other within a single job of the right size.
+
+Predictions are fit on subjects that completed before, with their number of
+sessions, BOLD runs and NIfTI bytes as features. Runtimes come from the
+runtime history run_bids appends to in the pipeline logs, peak memory and
+failed attempts from the Nextflow traces kept there. Subjects are only
+packed together when their prediction comes from history. The others keep
+their configured walltime and run alone, as do subjects too long to share a
+batch.
+"""
+import os
+import re
+import csv
+import glob
+import json
+import math
+import argparse
+
+import numpy as np
+
+HISTORY_NAME = 'runtime_history.tsv'
+HISTORY_COLUMNS = ['sub', 'seconds', 'exit', 'finished']
+TRACE_PATTERN = 'trace*.txt'
+
+FEATURES = ['sessions', 'runs', 'nifti_gb']
+MIN_MINUTES = 30
+
+PLAN_COLUMNS = ['batch', 'subjects', 'minutes', 'mem_mb', 'source']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Write per-subject invocations and pack subjects into '
+        'run_bids batches sized from past runtimes')
+    parser.add_argument('bids', type=str, help='BIDS dataset')
+    parser.add_argument('invocation', type=str, help='Boutiques invocation')
+    parser.add_argument('fallback',
+                        type=str,
+                        help='TSV of subjects to run and the walltime '
+                        '(H:MM:SS) to give them without history')
+    parser.add_argument('--logs',
+                        type=str,
+                        help='Pipeline log directory holding the runtime '
+                        'history and Nextflow traces of past runs')
+    parser.add_argument('--batch-time',
+                        type=str,
+                        default='12:00:00',
+                        help='Longest walltime (H:MM:SS) of a batch of '
+                        'several subjects')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=8,
+                        help='Most subjects in a single batch')
+    parser.add_argument('--default-mem-mb',
+                        type=int,
+                        required=True,
+                        help='Memory of a job without history')
+    parser.add_argument('--margin',
+                        type=float,
+                        default=1.5,
+                        help='Factor applied to predicted time and memory')
+    parser.add_argument('--out-dir',
+                        type=str,
+                        default='invocations',
+                        help='Directory to write the invocations in')
+    parser.add_argument('--plan',
+                        type=str,
+                        default='plan.tsv',
+                        help='Output TSV of batches')
+
+    args = parser.parse_args()
+
+    with open(args.fallback, 'r') as f:
+        fallback = {
+            sub: parse_walltime(t)
+            for sub, t in csv.reader(f, delimiter='\t') if sub
+        }
+    subjects = sorted(fallback)
+
+    write_invocations(args.invocation, subjects, args.out_dir)
+
+    history = read_history(args.logs) if args.logs else {}
+    features = {
+        sub: subject_features(args.bids, sub)
+        for sub in set(subjects) | set(history)
+        if os.path.isdir(os.path.join(args.bids, sub))
+    }
+
+    predictions = predict(subjects, features, history, fallback,
+                          args.default_mem_mb, args.margin)
+    batches = pack(predictions, parse_walltime(args.batch_time),
+                   args.batch_size)
+
+    with open(args.plan, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(PLAN_COLUMNS)
+        for i, batch in enumerate(batches):
+            writer.writerow([
+                f'batch-{i:03d}', ','.join(batch),
+                sum(predictions[s]['minutes'] for s in batch),
+                max(predictions[s]['mem_mb'] for s in batch), ','.join(
+                    sorted({predictions[s]['source']
+                            for s in batch}))
+            ])
+
+
+def write_invocations(invocation, subjects, out_dir):
+    '''
+    Write the invocation of each subject, restricted to its participant
+    label, as <out_dir>/<sub>.json
+    '''
+    with open(invocation, 'r') as f:
+        j_dict = json.load(f)
+
+    os.makedirs(out_dir, exist_ok=True)
+    for sub in subjects:
+        j_dict.update({'participant_label': [sub.replace('sub-', '')]})
+        with open(os.path.join(out_dir, f'{sub}.json'), 'w') as f:
+            json.dump(j_dict, f, indent=4)
+
+
+def subject_features(bids_dir, sub):
+    '''
+    Number of sessions, BOLD runs and GB of NIfTI data of a subject
+    '''
+    sub_dir = os.path.join(bids_dir, sub)
+    sessions = runs = n_bytes = 0
+    for root, dirs, files in os.walk(sub_dir):
+        sessions += sum(d.startswith('ses-') for d in dirs)
+        for name in files:
+            if name.endswith(('.nii.gz', '.nii')):
+                n_bytes += os.path.getsize(os.path.join(root, name))
+                runs += name.endswith(('_bold.nii.gz', '_bold.nii'))
+    return {
+        'sessions': max(sessions, 1),
+        'runs': runs,
+        'nifti_gb': n_bytes / 2**30
+    }
+
+
+def read_history(log_dir):
+    '''
+    Runtime history of each subject from the pipeline logs, a dictionary of
+    the seconds and peak memory (MB) of its last completed run, and the
+    longest walltime of the attempts that did not complete since
+    '''
+    history = {}
+
+    history_file = os.path.join(log_dir, HISTORY_NAME)
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as f:
+            for row in csv.reader(f, delimiter='\t'):
+                if len(row) != len(HISTORY_COLUMNS):
+                    continue
+                sub, seconds, exit_code, _ = row
+                entry = history.setdefault(sub, {})
+                if exit_code == '0':
+                    entry['seconds'] = float(seconds)
+                    entry.pop('failed_seconds', None)
+                else:
+                    entry['failed_seconds'] = max(
+                        entry.get('failed_seconds', 0), float(seconds))
+
+    for trace in sorted(glob.glob(os.path.join(log_dir, TRACE_PATTERN))):
+        for row in _read_trace(trace):
+            subs = row['subjects']
+            for sub in subs:
+                entry = history.setdefault(sub, {})
+
+                # Sequential subjects of a batch each stay under its peak
+                if row['peak_rss_mb'] is not None:
+                    entry['rss_mb'] = row['peak_rss_mb']
+
+                # Jobs killed at their walltime never wrote their history
+                if (row['status'] != 'COMPLETED' and len(subs) == 1
+                        and row['seconds'] is not None
+                        and 'seconds' not in entry):
+                    entry['failed_seconds'] = max(
+                        entry.get('failed_seconds', 0), row['seconds'])
+
+    return history
+
+
+def _read_trace(trace_file):
+    '''
+    run_bids rows of a Nextflow trace, with the subjects of their tag
+    '''
+    with open(trace_file, 'r') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            match = re.match(r'run_bids \((.*)\)$', row.get('name', ''))
+            if not match:
+                continue
+            subjects = [s for s in match.group(1).split(',')
+                        if s.startswith('sub-')]
+            if not subjects:
+                continue
+            yield {
+                'subjects': subjects,
+                'status': row.get('status'),
+                'seconds': _parse_duration(row.get('realtime')),
+                'peak_rss_mb': _parse_memory(row.get('peak_rss'))
+            }
+
+
+def _parse_duration(value):
+    '''
+    Seconds of a trace duration, raw milliseconds or e.g. 1h 2m 3s
+    '''
+    if value is None or value in ('', '-'):
+        return None
+    if re.match(r'^\d+$', value):
+        return int(value) / 1000
+    units = {'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    parts = re.findall(r'([\d.]+)(ms|s|m|h|d)', value)
+    if not parts:
+        return None
+    return sum(float(n) * units[u] for n, u in parts)
+
+
+def _parse_memory(value):
+    '''
+    MB of a trace memory value, raw bytes or e.g. 1.5 GB
+    '''
+    if value is None or value in ('', '-'):
+        return None
+    if re.match(r'^\d+$', value):
+        return int(value) / 2**20
+    match = re.match(r'^([\d.]+)\s*(B|KB|MB|GB|TB)$', value)
+    if not match:
+        return None
+    power = ['B', 'KB', 'MB', 'GB', 'TB'].index(match.group(2))
+    return float(match.group(1)) * 2**(10 * power) / 2**20
+
+
+def parse_walltime(value):
+    '''
+    Minutes of an [D:]H:MM:SS walltime
+    '''
+    parts = [int(p) for p in value.strip().split(':')]
+    seconds = 0
+    for p, scale in zip(parts[::-1], [1, 60, 3600, 86400]):
+        seconds += p * scale
+    return int(math.ceil(seconds / 60))
+
+
+def fit(samples, features):
+    '''
+    Least squares fit of a target on subject features, falling back to a
+    rate per GB of data with fewer samples than a linear fit needs.
+    Returns a function predicting the target from features, or None
+    without samples
+    '''
+    samples = [(features[s], y) for s, y in samples.items() if s in features]
+    if not samples:
+        return None
+
+    X = np.array([[1.0] + [f[k] for k in FEATURES] for f, _ in samples])
+    y = np.array([y for _, y in samples])
+    if len(samples) >= len(FEATURES) + 2:
+        coef = np.linalg.lstsq(X, y, rcond=None)[0]
+        resid = y - X.dot(coef)
+        floor = y.min()
+
+        def _predict(f):
+            x = np.array([1.0] + [f[k] for k in FEATURES])
+            return max(float(x.dot(coef) + resid.std()), floor)
+
+        return _predict
+
+    gb = np.maximum(X[:, -1], 1e-3)
+    rate = float(np.max(y / gb))
+    return lambda f: rate * max(f['nifti_gb'], 1e-3)
+
+
+def predict(subjects, features, history, fallback, default_mem_mb, margin):
+    '''
+    Minutes, memory (MB) and source (history or fallback) of each subject
+    '''
+    time_model = fit(
+        {s: h['seconds']
+         for s, h in history.items() if 'seconds' in h}, features)
+    mem_model = fit(
+        {s: h['rss_mb']
+         for s, h in history.items() if 'rss_mb' in h}, features)
+
+    predictions = {}
+    for sub in subjects:
+        entry = history.get(sub, {})
+        if time_model is None or sub not in features:
+            minutes, source = fallback[sub], 'fallback'
+        else:
+            seconds = time_model(features[sub]) * margin
+            minutes, source = max(int(math.ceil(seconds / 60)),
+                                  MIN_MINUTES), 'history'
+
+        # Attempts that did not complete ran out of time
+        if 'failed_seconds' in entry:
+            minutes = max(minutes,
+                          int(math.ceil(2 * entry['failed_seconds'] / 60)))
+
+        if mem_model is None or sub not in features:
+            mem_mb = default_mem_mb
+        else:
+            mem_mb = int(math.ceil(mem_model(features[sub]) * margin))
+
+        predictions[sub] = {
+            'minutes': minutes,
+            'mem_mb': mem_mb,
+            'source': source
+        }
+    return predictions
+
+
+def pack(predictions, batch_minutes, batch_size):
+    '''
+    First-fit decreasing packing of subjects predicted from history into
+    batches of at most `batch_minutes` and `batch_size` subjects, all other
+    subjects are batches of their own
+    '''
+    order = sorted(predictions,
+                   key=lambda s: (-predictions[s]['minutes'], s))
+
+    batches, loads = [], []
+    for sub in order:
+        minutes = predictions[sub]['minutes']
+        if predictions[sub]['source'] != 'history' or minutes > batch_minutes:
+            batches.append([sub])
+            loads.append(None)
+            continue
+        for i, load in enumerate(loads):
+            if (load is not None and load + minutes <= batch_minutes
+                    and len(batches[i]) < batch_size):
+                batches[i].append(sub)
+                loads[i] += minutes
+                break
+        else:
+            batches.append([sub])
+            loads.append(minutes)
+    return batches
+
+
+if __name__ == '__main__':
+    main()
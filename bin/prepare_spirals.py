@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Reorient and compress the raw spirals of a subject for feenics.nf
+
+Each spiral is read once. When the first one is stored PRS (as reported by
+mri_info --orientation), every spiral gets the fix reorient_bad applied with
+fslorient -deleteorient, fslswapdim -x -y z and fslorient -setqformcode 1.
+The data is flipped along its first two axes, the orientation it was stored
+with is dropped, and the qform becomes the scaled voxel grid, flipped the
+same way, with a qform code of 1. The flip is a view of the loaded array,
+and each output is written once as <input>.gz. It is compressed in blocks
+over several threads, as pigz does, rather than by a gzip pass per step.
+"""
+import os
+import zlib
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+
+from execution import task_resources
+
+BAD_ORIENTATION = ('P', 'R', 'S')
+
+# Uncompressed bytes per independently compressed block
+BLOCK_SIZE = 2**20
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Fix the orientation of PRS spirals and gzip them')
+    parser.add_argument('spirals',
+                        nargs='+',
+                        type=str,
+                        help='Uncompressed spirals of a subject, the first '
+                        'one decides whether all are reoriented')
+    parser.add_argument('--subject',
+                        type=str,
+                        help='Subject to record in the reorientation log')
+    parser.add_argument('--reorient-log',
+                        type=str,
+                        help='File to append reoriented subjects to')
+    parser.add_argument('--threads',
+                        type=int,
+                        help='Compression threads, defaults to the CPUs '
+                        'allocated to the task')
+    parser.add_argument('--level',
+                        type=int,
+                        default=6,
+                        help='gzip compression level')
+
+    args = parser.parse_args()
+    threads, _ = task_resources(args.threads)
+
+    imgs = [nib.load(s) for s in args.spirals]
+    reorient = orientation(imgs[0]) == BAD_ORIENTATION
+
+    with ThreadPoolExecutor(threads) as pool:
+        for in_file, img in zip(args.spirals, imgs):
+            if reorient:
+                img = swap_xy(img)
+            out_file = os.path.basename(in_file) + '.gz'
+            write_gzip(img.to_bytes(), out_file, pool, args.level)
+
+    if reorient and args.reorient_log:
+        os.makedirs(os.path.dirname(os.path.abspath(args.reorient_log)),
+                    exist_ok=True)
+        with open(args.reorient_log, 'a') as f:
+            f.write(f'{args.subject}\n')
+
+
+def orientation(img):
+    '''
+    Directions the voxel axes point towards, as mri_info --orientation
+    spells them
+    '''
+    return nib.aff2axcodes(img.affine)
+
+
+def swap_xy(img):
+    '''
+    Flip the first two voxel axes of an image whose orientation is not
+    trusted, giving it the scaled voxel grid flipped the same way as qform
+    '''
+    data = np.asanyarray(img.dataobj)[::-1, ::-1]
+
+    zooms = img.header.get_zooms()[:3]
+    shape = img.shape[:3]
+    affine = np.diag(list(zooms) + [1.0])
+    affine[0, 0] *= -1
+    affine[1, 1] *= -1
+    affine[0, 3] = (shape[0] - 1) * zooms[0]
+    affine[1, 3] = (shape[1] - 1) * zooms[1]
+
+    header = img.header.copy()
+    out_img = nib.Nifti1Image(data, None, header)
+    out_img.set_sform(None, code=0)
+    out_img.set_qform(affine, code=1)
+    out_img.set_data_dtype(img.get_data_dtype())
+    return out_img
+
+
+def write_gzip(data, out_file, pool, level=6):
+    '''
+    Write `data` as a gzip file, compressing blocks of it in parallel on
+    `pool`. Every block but the last ends on a sync flush, so the blocks
+    join into a single deflate stream any gzip reader decompresses.
+    '''
+    view = memoryview(data)
+    starts = range(0, len(data), BLOCK_SIZE)
+    last = starts[-1] if len(data) else 0
+
+    def _compress(start):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        block = compressor.compress(view[start:start + BLOCK_SIZE])
+        return block + compressor.flush(
+            zlib.Z_FINISH if start == last else zlib.Z_SYNC_FLUSH)
+
+    with open(out_file, 'wb') as f:
+        f.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff')
+        if len(data):
+            for block in pool.map(_compress, starts):
+                f.write(block)
+        else:
+            f.write(zlib.compressobj(level, zlib.DEFLATED,
+                                     -zlib.MAX_WBITS).flush())
+        f.write(
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                        len(data) & 0xffffffff))
+
+
+if __name__ == '__main__':
+    main()
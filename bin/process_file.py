@@ -1,4 +1,5 @@
 import os
+import shutil
 import argparse
 from nipype import Workflow
 from nipype.interfaces.io import DataSink
@@ -10,17 +11,49 @@ from nipype.interfaces.fsl.maths import ApplyMask
 from niworkflows.anat.ants import init_brain_extraction_wf
 from niworkflows.interfaces import SimpleBeforeAfter
 
+from cache import DiskCache, hash_file, hash_key
+from profiling import init_profiler
+from execution import (add_execution_args, task_resources, limit_threads,
+                       run_workflow)
+
+# Brain extraction settings, part of the brain mask cache key
+BRAIN_EXTRACTION = {
+    'in_template': 'OASIS30ANTs',
+    'atropos_use_random_seed': False,
+    'normalization_quality': 'precise'
+}
+
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("t1", help="Input T1 file", type=str)
-    parser.add_argument("bspline", help="Bspline distance for N4", type=int)
+    parser.add_argument("bspline",
+                        help="Comma separated Bspline distances for N4, "
+                        "every combination of distances and iterations is "
+                        "run on a single brain extraction",
+                        type=_int_list)
     parser.add_argument("niter",
-                        help="Number of iterations, will be multipled"
-                        "by [niter]*5",
-                        type=int)
+                        help="Comma separated numbers of iterations, will "
+                        "be multipled by [niter]*5",
+                        type=_int_list)
+    parser.add_argument("--mask-cache",
+                        help="Directory to cache brain masks in, keyed on "
+                        "the T1 contents and brain extraction settings",
+                        type=str)
+    parser.add_argument("--mask-cache-mb",
+                        help="Size limit of the brain mask cache",
+                        type=int,
+                        default=1024)
+    parser.add_argument("--profile-out",
+                        help="JSON file to write per-node wall time, CPU "
+                        "time, peak RSS, I/O and cache reuse records to",
+                        type=str)
+    add_execution_args(parser)
     args = parser.parse_args()
+    profiler = init_profiler(args.profile_out)
+    nprocs, mem_gb = task_resources(args.nprocs, args.mem_gb)
+    limit_threads()
 
     t1 = args.t1
     bspline = args.bspline
@@ -44,24 +77,59 @@ def main():
                               name='inputfile')
     single_file_buf.inputs.input_file = t1
 
-    # Initial skullstrip
-    ants_wf = init_brain_extraction_wf(in_template='OASIS30ANTs',
-                                       atropos_use_random_seed=False,
-                                       normalization_quality='precise')
+    # Initial skullstrip, skipped when the mask of an identical T1 is cached
+    mask_node = pe.Node(niu.IdentityInterface(fields=['out_mask']),
+                        name='brain_mask')
+
+    cache = None
+    cached_mask = None
+    if args.mask_cache:
+        cache = DiskCache(args.mask_cache,
+                          args.mask_cache_mb * 2**20,
+                          suffix='_mask.nii.gz')
+        cache_key = hash_key(hash_file(t1), sorted(BRAIN_EXTRACTION.items()))
+        cached_mask = _fetch_mask(cache, cache_key, workdir)
+
+    if cached_mask:
+        mask_node.inputs.out_mask = cached_mask
+    else:
+        ants_wf = init_brain_extraction_wf(omp_nthreads=nprocs,
+                                           **BRAIN_EXTRACTION)
+        wf.connect([
+            [input_node, ants_wf, [('in_files', 'inputnode.in_files')]],
+            [ants_wf, mask_node, [('outputnode.out_mask', 'out_mask')]]
+        ])
+
+        if cache is not None:
+            store_mask = pe.Node(niu.Function(function=_store_mask),
+                                 name='store_mask')
+            store_mask.inputs.cache_dir = cache.cache_dir
+            store_mask.inputs.max_bytes = cache.max_bytes
+            store_mask.inputs.key = cache_key
+            wf.connect(mask_node, 'out_mask', store_mask, 'in_mask')
 
     # Apply N4 bias field correction
     # Iterate over:
     # bspline fitting distances
     # number of iterations
+    sweep = pe.Node(niu.IdentityInterface(
+        fields=['bspline_fitting_distance', 'n_iterations']),
+                    name='sweep')
+    sweep.iterables = [('bspline_fitting_distance', bspline),
+                       ('n_iterations', niter)]
+
     n4 = pe.Node(N4BiasFieldCorrection(dimension=3,
                                        save_bias=True,
                                        copy_header=True,
                                        convergence_threshold=1e-7,
-                                       shrink_factor=4,
-                                       bspline_fitting_distance=bspline,
-                                       n_iterations=[niter] * 5),
+                                       shrink_factor=4),
                  name='n4')
 
+    # Share the cores between the N4 settings running side by side
+    n4_threads = max(nprocs // (len(bspline) * len(niter)), 1)
+    n4.inputs.num_threads = n4_threads
+    n4.n_procs = n4_threads
+
     outputnode = pe.Node(
         niu.IdentityInterface(fields=['corrected_t1', 'orig_t1']), name='out')
 
@@ -71,9 +139,13 @@ def main():
     datasink.inputs.substitutions = [('_bspline_fitting_distance_',
                                       'bspline-'), ('n_iterations_', 'niter-')]
 
-    wf.connect([[input_node, ants_wf, [('in_files', 'inputnode.in_files')]],
-                [single_file_buf, n4, [('input_file', 'input_image')]],
-                [ants_wf, n4, [('outputnode.out_mask', 'mask_image')]],
+    wf.connect([[single_file_buf, n4, [('input_file', 'input_image')]],
+                [
+                    sweep, n4,
+                    [('bspline_fitting_distance', 'bspline_fitting_distance'),
+                     (('n_iterations', _n4_iterations), 'n_iterations')]
+                ],
+                [mask_node, n4, [('out_mask', 'mask_image')]],
                 [n4, outputnode, [('output_image', 'corrected_t1')]],
                 [single_file_buf, outputnode, [('input_file', 'orig_t1')]],
                 [
@@ -81,7 +153,43 @@ def main():
                     [('corrected_t1', 'corrected_img.@corrected'),
                      ('orig_t1', 'corrected_img.@orig')]
                 ]])
-    wf.run()
+    run_workflow(wf, profiler, nprocs=nprocs, mem_gb=mem_gb)
+
+
+def _fetch_mask(cache, key, workdir):
+    '''
+    Copy a cached brain mask into the working directory, None on a miss
+    '''
+    cached = cache.get(key)
+    if cached is None:
+        return None
+
+    out_mask = os.path.join(workdir, 'cached_brain_mask.nii.gz')
+    try:
+        shutil.copyfile(cached, out_mask)
+    except OSError:
+        # Evicted by another task in the meantime
+        return None
+    return out_mask
+
+
+def _store_mask(in_mask, cache_dir, max_bytes, key):
+    '''
+    Add a brain mask to the cache
+    '''
+    import shutil
+    from cache import DiskCache
+
+    cache = DiskCache(cache_dir, max_bytes, suffix='_mask.nii.gz')
+    return cache.store(key, lambda p: shutil.copyfile(in_mask, p))
+
+
+def _int_list(arg):
+    return [int(a) for a in arg.split(',')]
+
+
+def _n4_iterations(niter):
+    return [niter] * 5
 
 
 if __name__ == '__main__':
@@ -0,0 +1,201 @@
+"""Per-node timing and resource records for pipeline script runs."""
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+def init_profiler(profile_out):
+    '''
+    NodeProfiler that writes its records to `profile_out` when the script
+    exits, failed runs included, or None when no output is requested
+    '''
+    if not profile_out:
+        return None
+    profiler = NodeProfiler()
+    atexit.register(profiler.write, os.path.abspath(profile_out))
+    return profiler
+
+
+def measure(profiler, name):
+    '''
+    Context recording a block of in-process work, a no-op without profiler
+    '''
+    if profiler is None:
+        return nullcontext()
+    return profiler.measure(name)
+
+
+class NodeProfiler(object):
+    '''
+    Nipype status callback recording the wall time, CPU time, peak RSS,
+    bytes read and written and cache reuse of every node that runs
+
+    Pass it as the `status_callback` plugin argument of Workflow.run. CPU
+    time and I/O are counted for this process and the commands it runs, so
+    they are only attributed to single nodes under the Linear plugin. When
+    `concurrent` is set (run_workflow sets it for MultiProc), nodes run side
+    by side in worker processes: CPU time and peak RSS then only come from
+    Nipype's resource monitor, which measures each node in its worker, and
+    I/O is not recorded. The monitor is enabled on construction when psutil
+    is available, otherwise peak RSS falls back to the process high-water
+    mark under Linear. In-process steps that are not Nipype nodes can be
+    recorded with `measure`.
+    '''
+
+    def __init__(self):
+        from nipype import config
+        try:
+            import psutil  # noqa: F401
+            config.enable_resource_monitor()
+        except ImportError:
+            pass
+        self.monitored = bool(config.resource_monitor)
+        self.concurrent = False
+        self.records = []
+        self._started = {}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            usage = None if self.concurrent else _usage()
+            self._started[id(node)] = (time.time(), usage, _cached(node))
+            return
+
+        start = self._started.pop(id(node), None)
+        if start is None:
+            return
+        wall_start, usage, cached = start
+
+        runtime = _runtime(node)
+        peak_gb = getattr(runtime, 'mem_peak_gb', None)
+        record = self._record(node.fullname, wall_start, usage, cached)
+        record['status'] = 'ok' if status == 'end' else 'error'
+        if peak_gb is not None:
+            record['peak_rss_mb'] = peak_gb * 1024
+            record['rss_source'] = 'monitor'
+        if self.concurrent:
+            cpu_percent = getattr(runtime, 'cpu_percent', None)
+            duration = getattr(runtime, 'duration', None)
+            if cpu_percent is not None and duration is not None:
+                record['cpu_seconds'] = cpu_percent / 100 * duration
+        self.records.append(record)
+
+    @contextmanager
+    def measure(self, name):
+        '''
+        Record a block of in-process work as if it were a node
+        '''
+        wall_start, usage = time.time(), _usage()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            record = self._record(name, wall_start, usage, None)
+            record['status'] = status
+            self.records.append(record)
+
+    def _record(self, name, wall_start, usage, cached):
+        '''
+        Record of a node, with only its wall time without process `usage`
+        '''
+        cpu_seconds = peak_rss_mb = read_bytes = write_bytes = None
+        rss_source = None
+        if usage is not None:
+            end_usage = _usage()
+            cpu_seconds = end_usage['cpu_seconds'] - usage['cpu_seconds']
+            peak_rss_mb, rss_source = end_usage['maxrss_mb'], 'high_water'
+            read_bytes = _delta(usage['read_bytes'], end_usage['read_bytes'])
+            write_bytes = _delta(usage['write_bytes'],
+                                 end_usage['write_bytes'])
+        return OrderedDict([
+            ('name', name),
+            ('start', datetime.fromtimestamp(wall_start).isoformat()),
+            ('wall_seconds', time.time() - wall_start),
+            ('cpu_seconds', cpu_seconds),
+            ('peak_rss_mb', peak_rss_mb),
+            ('rss_source', rss_source),
+            ('read_bytes', read_bytes),
+            ('write_bytes', write_bytes),
+            ('cached', cached),
+        ])
+
+    def write(self, out_file):
+        '''
+        Write the node records and totals to a JSON file
+        '''
+        summary = OrderedDict([
+            ('nodes', len(self.records)),
+            ('wall_seconds', sum(r['wall_seconds'] for r in self.records)),
+            ('cpu_seconds',
+             sum(r['cpu_seconds'] for r in self.records
+                 if r['cpu_seconds'] is not None)),
+            ('peak_rss_mb',
+             max((r['peak_rss_mb'] for r in self.records
+                  if r['peak_rss_mb'] is not None),
+                 default=None)),
+            ('cache_hits', sum(r['cached'] is True for r in self.records)),
+            ('cache_misses', sum(r['cached'] is False
+                                 for r in self.records)),
+        ])
+        profile = OrderedDict([('argv', sys.argv),
+                               ('host', os.uname().nodename),
+                               ('resource_monitor', self.monitored),
+                               ('summary', summary),
+                               ('records', self.records)])
+        with open(out_file, 'w') as f:
+            json.dump(profile, f, indent=3)
+
+
+def _usage():
+    '''
+    CPU time, peak RSS and I/O of this process and its finished children
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {
+        'cpu_seconds': (own.ru_utime + own.ru_stime + children.ru_utime +
+                        children.ru_stime),
+        'maxrss_mb': max(own.ru_maxrss, children.ru_maxrss) / 1024,
+        'read_bytes': None,
+        'write_bytes': None
+    }
+
+    # Linux only, includes the I/O of children once they have exited
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in ('read_bytes', 'write_bytes'):
+                    usage[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return usage
+
+
+def _delta(start, end):
+    if start is None or end is None:
+        return None
+    return end - start
+
+
+def _cached(node):
+    '''
+    Whether the node's results will be reused from its working directory
+    '''
+    try:
+        return bool(node.is_cached()[0])
+    except Exception:
+        return None
+
+
+def _runtime(node):
+    try:
+        return node.result.runtime
+    except Exception:
+        return None
@@ -1,15 +1,23 @@
 """Image tools interfaces."""
-from nilearn.image import resample_to_img
 import numpy as np
 import nibabel as nb
 from nipype.utils.filemanip import fname_presuffix
 from nipype import logging
 from nipype.interfaces.base import (traits, TraitedSpec,
                                     BaseInterfaceInputSpec, SimpleInterface,
-                                    File)
+                                    File, Directory, InputMultiObject,
+                                    OutputMultiObject, isdefined)
+
+from cache import DiskCache, hash_key
 
 LOGGER = logging.getLogger('nipype.interface')
 
+# Index maps already computed by this process keyed on the grid pair
+_INDEX_MAPS = {}
+
+# Part of the cache key, to be bumped whenever the index maps change
+INDEX_MAP_VERSION = 2
+
 
 class _ResampleTPMInputSpec(BaseInterfaceInputSpec):
     moving_file = File(exists=True,
@@ -18,6 +26,11 @@ class _ResampleTPMInputSpec(BaseInterfaceInputSpec):
     fixed_file = File(exists=True,
                       mandatory=True,
                       desc=' timeseries mask in BOLD space')
+    cache_dir = Directory(desc='Directory to cache nearest-neighbour index '
+                          'maps in, shared across runs and subjects')
+    cache_max_mb = traits.Int(512,
+                              usedefault=True,
+                              desc='Size limit of the index map cache')
 
 
 class _ResampleTPMOutputSpec(TraitedSpec):
@@ -40,26 +53,189 @@ class ResampleTPM(SimpleInterface):
     #     return runtime
     def _run_interface(self, runtime):
 
+        cache_dir = self.inputs.cache_dir
         out_file = _TPM_2_BOLD(
             self.inputs.moving_file,
             self.inputs.fixed_file,
             newpath=runtime.cwd,
+            cache_dir=cache_dir if isdefined(cache_dir) else None,
+            cache_max_mb=self.inputs.cache_max_mb,
         )
         self._results['out_file'] = out_file
         return runtime
 
 
-def _TPM_2_BOLD(moving_file, fixed_file, newpath=None):
+class _ResampleMaskedROIsInputSpec(BaseInterfaceInputSpec):
+    roi_files = InputMultiObject(File(exists=True),
+                                 mandatory=True,
+                                 desc='ROIs in T1 space, on the same grid')
+    mask_file = File(exists=True, mandatory=True, desc='BOLD mask')
+    cache_dir = Directory(desc='Directory to cache nearest-neighbour index '
+                          'maps in, shared across runs and subjects')
+    cache_max_mb = traits.Int(512,
+                              usedefault=True,
+                              desc='Size limit of the index map cache')
+
+
+class _ResampleMaskedROIsOutputSpec(TraitedSpec):
+    out_files = OutputMultiObject(File(exists=True),
+                                  desc='uint8 ROIs in BOLD space, zeroed '
+                                  'outside of the BOLD mask, in input order')
+
+
+class ResampleMaskedROIs(SimpleInterface):
+    """
+    Resample ROIs to BOLD space and mask them with the BOLD mask in a single
+    pass, as ResampleTPM followed by masking does for each ROI
+    """
+    input_spec = _ResampleMaskedROIsInputSpec
+    output_spec = _ResampleMaskedROIsOutputSpec
+
+    def _run_interface(self, runtime):
+
+        cache_dir = self.inputs.cache_dir
+        roi_imgs = [nb.load(f) for f in self.inputs.roi_files]
+        rois = _resample_masked_rois(
+            roi_imgs,
+            nb.load(self.inputs.mask_file),
+            cache_dir=cache_dir if isdefined(cache_dir) else None,
+            cache_max_mb=self.inputs.cache_max_mb)
+
+        self._results['out_files'] = []
+        for in_file, roi_img in zip(self.inputs.roi_files, rois):
+            out_file = fname_presuffix(in_file,
+                                       suffix='_resampled_boldmsk',
+                                       newpath=runtime.cwd)
+            roi_img.to_filename(out_file)
+            self._results['out_files'].append(out_file)
+        return runtime
+
+
+def _TPM_2_BOLD(moving_file,
+                fixed_file,
+                newpath=None,
+                cache_dir=None,
+                cache_max_mb=512):
     """
-    Resample the input white matter tissues probability using resample_to_img from nilearn.
+    Resample the input white matter tissues probability to BOLD space with
+    nearest-neighbour interpolation.
     """
 
     out_file = fname_presuffix(moving_file,
                                suffix='_resampled',
                                newpath=newpath)
 
-    resample_wm = resample_to_img(source_img=moving_file,
-                                  target_img=fixed_file,
-                                  interpolation='nearest')
+    resample_wm = _resample_roi(moving_file, fixed_file, cache_dir,
+                                cache_max_mb)
     resample_wm.to_filename(out_file)
     return out_file
+
+
+def _resample_roi(moving_img, fixed_img, cache_dir=None, cache_max_mb=512):
+    """
+    Nearest-neighbour resampling of an ROI onto the grid of a BOLD space
+    image, as nilearn's resample_to_img does, through a plain integer gather
+    with a cached index map. Accepts either filenames or in-memory images.
+    """
+    if isinstance(moving_img, str):
+        moving_img = nb.load(moving_img)
+    if isinstance(fixed_img, str):
+        fixed_img = nb.load(fixed_img)
+
+    index = _index_map(moving_img, fixed_img, cache_dir, cache_max_mb)
+    inside = index >= 0
+
+    src = np.asanyarray(moving_img.dataobj).ravel(order='F')
+    out = np.zeros(index.shape, dtype=src.dtype)
+    out[inside] = src[index[inside]]
+
+    out = out.reshape(fixed_img.shape[:3], order='F')
+    return moving_img.__class__(out, fixed_img.affine, moving_img.header)
+
+
+def _resample_masked_rois(moving_imgs,
+                          mask_img,
+                          cache_dir=None,
+                          cache_max_mb=512):
+    """
+    Nearest-neighbour resampling of ROIs onto the grid of a BOLD mask,
+    keeping only the voxels inside the mask. Only masked voxels are
+    gathered, and the index math is shared by all ROIs on the same grid.
+    Returns uint8 images, as resampling then masking each ROI would.
+    """
+    mask = np.asanyarray(mask_img.dataobj).ravel(order='F').astype(bool)
+
+    targets = {}
+    out_imgs = []
+    for moving_img in moving_imgs:
+        grid = (moving_img.affine.tobytes(), moving_img.shape[:3])
+        if grid not in targets:
+            index = _index_map(moving_img, mask_img, cache_dir, cache_max_mb)
+            voxels = np.flatnonzero(mask & (index >= 0))
+            targets[grid] = (voxels, index[voxels])
+        voxels, src_index = targets[grid]
+
+        src = np.asanyarray(moving_img.dataobj).ravel(order='F')
+        out = np.zeros(mask.shape, dtype=np.uint8)
+        out[voxels] = src[src_index]
+
+        out_img = moving_img.__class__(
+            out.reshape(mask_img.shape[:3], order='F'), mask_img.affine,
+            moving_img.header)
+        out_img.set_data_dtype(np.uint8)
+        out_imgs.append(out_img)
+    return out_imgs
+
+
+def _index_map(moving_img, fixed_img, cache_dir=None, cache_max_mb=512):
+    """
+    Nearest-neighbour index map between two grids, looked up in this
+    process first, then in the on-disk cache before being computed
+    """
+    grids = (moving_img.affine, moving_img.shape[:3], fixed_img.affine,
+             fixed_img.shape[:3])
+    key = hash_key(INDEX_MAP_VERSION, *grids)
+
+    index = _INDEX_MAPS.get(key)
+    if index is not None:
+        return index
+
+    cache = None
+    if cache_dir is not None:
+        cache = DiskCache(cache_dir, cache_max_mb * 2**20, suffix='.npy')
+        cached = cache.get(key)
+        if cached is not None:
+            try:
+                index = np.load(cached)
+            except (OSError, ValueError):
+                index = None
+
+    if index is None:
+        index = _nn_index_map(*grids)
+        if cache is not None:
+            cache.store(key, lambda p: np.save(p, index))
+
+    _INDEX_MAPS[key] = index
+    return index
+
+
+def _nn_index_map(src_affine, src_shape, tgt_affine, tgt_shape):
+    """
+    Flat (Fortran order) source voxel index of every target voxel, -1 where
+    the target voxel falls outside of the source grid.
+    """
+    A = np.linalg.inv(src_affine).dot(tgt_affine)
+    ijk = np.indices(tgt_shape).reshape(3, -1, order='F')
+    coords = A[:3, :3].dot(ijk) + A[:3, 3:]
+
+    # As scipy's constant mode, which nilearn uses, coordinates past the
+    # centres of the edge voxels are outside even if they round inside
+    shape = np.asarray(src_shape)[:, None]
+    inside = np.all((coords >= 0) & (coords <= shape - 1), axis=0)
+    coords = np.floor(coords + 0.5).astype(np.int64)
+
+    index = np.full(ijk.shape[1], -1, dtype=np.int64)
+    index[inside] = np.ravel_multi_index(coords[:, inside],
+                                         src_shape,
+                                         order='F')
+    return index
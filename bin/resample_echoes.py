@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Bring a pair of fieldmap echoes onto the same grid for fieldmaps.nf
+
+Whether resampling is needed is decided from the NIfTI headers alone, so
+echoes that already match are neither read nor copied. Otherwise the echo
+with the smaller voxels is resampled onto the grid of the other one: FLIRT
+registers their first volumes only, and the resulting transform is applied
+to every volume at once with trilinear interpolation, as flirt -applyxfm
+does. The resampled echo replaces the staged input in the working directory,
+the original file is left untouched.
+"""
+import os
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Resample the finer of two fieldmap echoes onto the '
+        'grid of the other when their voxel volumes differ')
+    parser.add_argument('echo1', type=str, help='First echo')
+    parser.add_argument('echo2', type=str, help='Second echo')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.0001,
+                        help='Voxel volume difference (mm^3) above which '
+                        'the echoes are resampled')
+
+    args = parser.parse_args()
+
+    img1 = nib.load(args.echo1)
+    img2 = nib.load(args.echo2)
+    diff = voxel_volume(img1) - voxel_volume(img2)
+    if diff > args.threshold:
+        in_file, in_img, ref_img = args.echo2, img2, img1
+    elif diff < -args.threshold:
+        in_file, in_img, ref_img = args.echo1, img1, img2
+    else:
+        print('Echo voxel volumes match, nothing to resample')
+        return
+
+    print(f'Resampling {in_file} onto the grid of the other echo')
+    xfm = flirt_first_volumes(in_img, ref_img)
+    out_img = apply_fsl_xfm(in_img, ref_img, xfm)
+
+    # Replace the staged link rather than writing through it
+    tmp = f'{in_file}.tmp.nii.gz'
+    out_img.to_filename(tmp)
+    os.replace(tmp, in_file)
+
+
+def voxel_volume(img):
+    '''
+    Volume of a voxel in mm^3, from the header only
+    '''
+    return float(np.prod(img.header.get_zooms()[:3]))
+
+
+def first_volume(img):
+    '''
+    First volume of a 3D or 4D image, reading no further into the file
+    '''
+    if len(img.shape) < 4:
+        data = np.asanyarray(img.dataobj)
+    else:
+        data = np.asanyarray(img.dataobj[..., 0])
+    out = nib.Nifti1Image(data, img.affine, img.header)
+    out.header.set_data_shape(data.shape)
+    return out
+
+
+def flirt_first_volumes(in_img, ref_img):
+    '''
+    FLIRT transform registering the first volume of `in_img` to the first
+    volume of `ref_img`, in FSL scaled voxel coordinates
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        in_file = os.path.join(tmp, 'in.nii.gz')
+        ref_file = os.path.join(tmp, 'ref.nii.gz')
+        mat_file = os.path.join(tmp, 'resamp_mat')
+        first_volume(in_img).to_filename(in_file)
+        first_volume(ref_img).to_filename(ref_file)
+        subprocess.run(
+            ['flirt', '-in', in_file, '-ref', ref_file, '-omat', mat_file],
+            check=True)
+        return np.loadtxt(mat_file)
+
+
+def fsl_scaling(img):
+    '''
+    Voxel to FSL scaled voxel coordinates, with the x axis flipped when the
+    voxel to world transform has a positive determinant
+    '''
+    shape = img.shape[:3]
+    scaling = np.diag(list(img.header.get_zooms()[:3]) + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        scaling = scaling.dot(flip)
+    return scaling
+
+
+def apply_fsl_xfm(in_img, ref_img, xfm):
+    '''
+    Resample every volume of `in_img` onto the grid of `ref_img` through an
+    FSL transform, with trilinear interpolation and zeros outside of the
+    field of view of `in_img`
+
+    The interpolation weights are computed once for the reference grid and
+    applied to all volumes in a single pass
+    '''
+
+    ref_shape = ref_img.shape[:3]
+    in_shape = np.array(in_img.shape[:3])
+    vox2vox = np.linalg.inv(fsl_scaling(in_img)).dot(np.linalg.inv(xfm)).dot(
+        fsl_scaling(ref_img))
+
+    ijk = np.indices(ref_shape).reshape(3, -1)
+    coords = vox2vox[:3, :3].dot(ijk) + vox2vox[:3, 3:]
+
+    # Within half a percent of a voxel of the edge counts as inside
+    inside = np.all((coords > -0.005) & (coords < (in_shape - 1)[:, None] +
+                                         0.005), axis=0)
+    coords = np.clip(coords[:, inside], 0, (in_shape - 1)[:, None])
+    base = np.minimum(np.floor(coords).astype(int), (in_shape - 2)[:, None])
+    base = np.maximum(base, 0)
+    frac = coords - base
+
+    data = np.asanyarray(in_img.dataobj)
+    n_vols = data.shape[3] if data.ndim > 3 else 1
+    data = data.reshape(-1, n_vols, order='F')
+
+    out = np.zeros((inside.sum(), n_vols))
+    for corner in np.ndindex(2, 2, 2):
+        offset = np.array(corner)[:, None]
+        idx = np.minimum(base + offset, (in_shape - 1)[:, None])
+        weight = np.prod(np.where(offset, frac, 1 - frac), axis=0)
+        flat = np.ravel_multi_index(idx, in_shape, order='F')
+        out += weight[:, None] * data[flat]
+
+    resampled = np.zeros((np.prod(ref_shape), n_vols))
+    resampled[inside] = out
+    resampled = resampled.reshape(tuple(ref_shape) + (n_vols, ))
+    if len(in_img.shape) < 4:
+        resampled = resampled[..., 0]
+    if np.issubdtype(in_img.get_data_dtype(), np.integer):
+        resampled = np.round(resampled)
+
+    header = ref_img.header.copy()
+    header.set_data_shape(resampled.shape)
+    header.set_data_dtype(in_img.get_data_dtype())
+    if len(in_img.shape) > 3:
+        zooms = ref_img.header.get_zooms()[:3] + in_img.header.get_zooms()[3:4]
+        header.set_zooms(zooms)
+    out_img = nib.Nifti1Image(resampled, ref_img.affine, header)
+    out_img.set_qform(*ref_img.get_qform(coded=True))
+    out_img.set_sform(*ref_img.get_sform(coded=True))
+    return out_img
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Bit-packed ROI containers of the confound tooling
+
+The WM, CSF and combined aCompCor ROIs of a run are binary masks on the
+anatomical grid. Rather than a gzip NIfTI per ROI, they are written to a
+single <outbase>_rois.npz holding:
+
+    header      NIfTI header bytes of the ROIs, shared by all of them
+    affine      4x4 voxel to world affine, shared by all of them
+    names       ROI names, in the order they were written
+    roi-<name>  np.packbits of the flattened (C order) mask, 1 bit a voxel
+
+Masks are read back on demand, as boolean arrays or as uint8 NIfTIs equal to
+the ones that used to be exported. Run as a script, expands containers back
+into <outbase>_<name>_roi.nii.gz files.
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+import nibabel as nib
+
+ROIS_SUFFIX = '_rois.npz'
+ROI_KEY = 'roi-{}'
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Write the ROIs of bit-packed containers as NIfTIs')
+    parser.add_argument('containers',
+                        nargs='+',
+                        type=str,
+                        help=f'ROI containers (*{ROIS_SUFFIX})')
+    parser.add_argument('--rois',
+                        nargs='+',
+                        type=str,
+                        help='ROIs to write, defaults to all of them')
+    parser.add_argument('--out-dir',
+                        type=str,
+                        default='.',
+                        help='Directory to write the NIfTIs in')
+
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for in_file in args.containers:
+        rois = ROIPack(in_file)
+        outbase = os.path.join(args.out_dir,
+                               os.path.basename(in_file)[:-len(ROIS_SUFFIX)])
+        for name in args.rois or rois.names:
+            rois.to_nifti(name).to_filename(f'{outbase}_{name}_roi.nii.gz')
+
+
+def write_rois(out_file, rois, ref_img):
+    '''
+    Write masks of the grid of `ref_img` to a container, `rois` maps ROI
+    names to arrays in which nonzero voxels belong to the ROI
+    '''
+    header = ref_img.header.copy()
+    header.set_data_dtype(np.uint8)
+
+    arrays = {
+        'header': np.frombuffer(header.binaryblock, dtype=np.uint8),
+        'affine': np.asarray(ref_img.affine, dtype=np.float64),
+        'names': np.array(list(rois), dtype=str)
+    }
+    shape = tuple(header.get_data_shape())
+    for name, roi in rois.items():
+        roi = np.asanyarray(roi)
+        if roi.shape != shape:
+            raise ValueError(f'ROI {name} of shape {roi.shape} does not '
+                             f'match its header shape {shape}')
+        arrays[ROI_KEY.format(name)] = np.packbits(roi.ravel() != 0)
+
+    # Written in place of any previous container once complete
+    tmp_file = f'{out_file}.tmp{os.getpid()}'
+    with open(tmp_file, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_file, out_file)
+
+
+def pack_roi_files(out_file, roi_files):
+    '''
+    Write ROI NIfTIs, keyed by name, to a single container. They share the
+    header and affine of the first one
+    '''
+    imgs = {name: nib.load(f) for name, f in roi_files.items()}
+    rois = {name: np.asanyarray(img.dataobj) for name, img in imgs.items()}
+    write_rois(out_file, rois, next(iter(imgs.values())))
+
+
+class ROIPack(object):
+    '''
+    Read access to an ROI container written by write_rois, masks are
+    only unpacked when asked for
+
+    >>> rois = ROIPack('sub-01_task-rest_rois.npz')        # doctest: +SKIP
+    >>> wm = rois.mask('wm')                                # doctest: +SKIP
+    >>> rois.to_nifti('csf').to_filename('csf.nii.gz')      # doctest: +SKIP
+    '''
+
+    def __init__(self, in_file):
+        self.in_file = in_file
+        with np.load(in_file, allow_pickle=False) as npz:
+            self.header = nib.Nifti1Header(npz['header'].tobytes())
+            self.affine = npz['affine']
+            self.names = [str(n) for n in npz['names']]
+        self.shape = tuple(self.header.get_data_shape())
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def mask(self, name):
+        '''
+        An ROI as a read-only boolean array of the grid shape
+        '''
+        if name not in self.names:
+            raise KeyError(f'No ROI {name} in {self.in_file}')
+        with np.load(self.in_file, allow_pickle=False) as npz:
+            packed = npz[ROI_KEY.format(name)]
+        mask = np.unpackbits(packed, count=int(np.prod(self.shape)))
+        mask = mask.view(bool).reshape(self.shape)
+        mask.flags.writeable = False
+        return mask
+
+    def masks(self, names=None):
+        '''
+        ROIs (all of them by default) as boolean arrays keyed by name
+        '''
+        return {n: self.mask(n) for n in (names or self.names)}
+
+    def to_nifti(self, name):
+        '''
+        An ROI as a uint8 NIfTI, as the ROI interfaces write them
+        '''
+        img = nib.Nifti1Image(self.mask(name).astype(np.uint8), self.affine,
+                              self.header)
+        img.set_data_dtype(np.uint8)
+        return img
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+WM, CSF and combined aCompCor ROIs from tissue probability maps
+
+Builds the same ROIs as niworkflows' TPM2ROI and AddTPMs. Repeated binary
+erosion with the default 6-connected structuring element removes, after k
+iterations, every voxel within a city-block distance of k from the
+background. Eroding a mask therefore amounts to thresholding its city-block
+distance map, which takes two passes over the image whatever the number of
+iterations. The distance map of the brain mask is computed once and shared
+by the three ROIs.
+"""
+import numpy as np
+import nibabel as nb
+from scipy import ndimage as nd
+from nipype.utils.filemanip import fname_presuffix
+from nipype.interfaces.base import (traits, TraitedSpec,
+                                    BaseInterfaceInputSpec, SimpleInterface,
+                                    File)
+
+ROI_NAMES = ('wm', 'csf', 'acc')
+
+
+class _AnatROIsInputSpec(BaseInterfaceInputSpec):
+    t1w_mask = File(exists=True, mandatory=True, desc='T1w brain mask')
+    wm_tpm = File(exists=True, mandatory=True, desc='WM probability map')
+    csf_tpm = File(exists=True, mandatory=True, desc='CSF probability map')
+    roi_params = traits.Dict(mandatory=True,
+                             desc='TPM2ROI erosion settings of the wm, csf '
+                             'and acc ROIs')
+
+
+class _AnatROIsOutputSpec(TraitedSpec):
+    wm_roi = File(exists=True, desc='eroded WM ROI')
+    csf_roi = File(exists=True, desc='eroded CSF ROI')
+    acc_roi = File(exists=True, desc='eroded combined WM and CSF ROI')
+
+
+class AnatROIs(SimpleInterface):
+    """
+    Threshold and erode the WM, CSF and combined WM + CSF probability maps
+    within the brain mask, as TPM2ROI does for each of them
+    """
+    input_spec = _AnatROIsInputSpec
+    output_spec = _AnatROIsOutputSpec
+
+    def _run_interface(self, runtime):
+        out_files = _anat_rois(self.inputs.t1w_mask,
+                               self.inputs.wm_tpm,
+                               self.inputs.csf_tpm,
+                               self.inputs.roi_params,
+                               newpath=runtime.cwd)
+        for name, out_file in out_files.items():
+            self._results[f'{name}_roi'] = out_file
+        return runtime
+
+
+def _anat_rois(t1w_mask, wm_tpm, csf_tpm, roi_params, newpath=None):
+    '''
+    Write the WM, CSF and combined ROIs, named after the TPMs as TPM2ROI
+    names them
+    '''
+
+    mask_img = nb.load(t1w_mask)
+    wm_img = nb.load(wm_tpm)
+    rois = build_rois(np.asanyarray(mask_img.dataobj), wm_img.get_fdata(),
+                      nb.load(csf_tpm).get_fdata(),
+                      mask_img.header.get_zooms()[:3], roi_params)
+
+    suffixes = {'wm': '_roi', 'csf': '_roi', 'acc': '_tpmsum_roi'}
+    in_files = {'wm': wm_tpm, 'csf': csf_tpm, 'acc': wm_tpm}
+    out_files = {}
+    for name in ROI_NAMES:
+        roi_img = nb.Nifti1Image(rois[name], wm_img.affine, wm_img.header)
+        roi_img.set_data_dtype(np.uint8)
+        out_files[name] = fname_presuffix(in_files[name],
+                                          suffix=suffixes[name],
+                                          newpath=newpath)
+        roi_img.to_filename(out_files[name])
+    return out_files
+
+
+def build_rois(mask, wm, csf, zooms, roi_params):
+    '''
+    WM, CSF and combined ROIs as uint8 arrays, keyed by wm, csf and acc
+
+    `mask` is the brain mask, `wm` and `csf` the probability maps as floats
+    and `roi_params` the TPM2ROI settings of each ROI
+    '''
+
+    # Sum as AddTPMs does, stored as float32 in between
+    acc = np.clip(wm + csf, 0.0, 1.0).astype(np.float32)
+    tpms = {'wm': wm, 'csf': csf, 'acc': acc}
+
+    mask_depth = erosion_depth(mask.astype(np.uint8) > 0)
+    return {
+        name: tpm2roi(tpms[name], mask_depth, zooms, **roi_params[name])
+        for name in ROI_NAMES
+    }
+
+
+def tpm2roi(tpm,
+            mask_depth,
+            zooms,
+            erode_mm=None,
+            erode_prop=None,
+            mask_erode_mm=None,
+            mask_erode_prop=None,
+            prob_thresh=0.95):
+    '''
+    Threshold a tissue probability map and erode it along with the brain
+    mask, given the erosion depth map of the brain mask
+    '''
+
+    roi = tpm >= prob_thresh
+
+    erode_in = (mask_erode_mm is not None and mask_erode_mm > 0
+                or mask_erode_prop is not None and mask_erode_prop < 1)
+    if erode_in:
+        if mask_erode_mm:
+            iter_n = max(int(mask_erode_mm / max(zooms)), 1)
+        else:
+            iter_n = _prop_iterations(mask_depth, mask_erode_prop)
+        roi &= mask_depth > iter_n
+
+    erode_out = (erode_mm is not None and erode_mm > 0
+                 or erode_prop is not None and erode_prop < 1)
+    if erode_out:
+        roi_depth = erosion_depth(roi)
+        if erode_mm:
+            iter_n = max(int(erode_mm / max(zooms)), 1)
+        else:
+            iter_n = _prop_iterations(roi_depth, erode_prop)
+        roi = roi_depth > iter_n
+
+    return roi.astype(np.uint8)
+
+
+def erosion_depth(mask):
+    '''
+    Number of binary erosions each voxel of a mask survives, plus one
+
+    The city-block distance to the nearest background voxel, where voxels
+    outside of the array count as background like binary_erosion's border
+    '''
+    padded = np.pad(mask.astype(bool), 1)
+    depth = nd.distance_transform_cdt(padded, metric='taxicab')
+    return depth[1:-1, 1:-1, 1:-1]
+
+
+def _prop_iterations(depth, prop):
+    '''
+    Number of erosions after which at most `prop` of the mask remains,
+    counted the way TPM2ROI's erosion loop stops
+    '''
+    counts = np.bincount(depth.ravel())
+    counts[0] = 0
+    orig_vol = counts.sum()
+    if orig_vol == 0:
+        return 0
+
+    # Voxels left after k erosions
+    remaining = orig_vol - np.cumsum(counts)
+    return int(np.argmax(remaining / orig_vol <= prop))
@@ -0,0 +1,63 @@
+"""
+Block-wise reading of 4D series
+
+Volumes of a BOLD series are read a block at a time so that only the voxels
+needed from each block are kept. Uncompressed series are memory-mapped.
+Compressed series are streamed: without a seek index, every read of a gzip
+file from a given offset decompresses it from the start, so volumes are read
+in order from a single open file and the series is decompressed once.
+"""
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import array_from_file, apply_read_scaling
+
+COMPRESSED_EXTS = ('.gz', '.bz2', '.zst')
+
+
+def iter_volume_blocks(bold_file, vols=None, chunk_mb=256):
+    '''
+    Blocks of the volumes `vols` (a range, all of them by default) of a 4D
+    series as float32 arrays of at most `chunk_mb`
+
+    Yields (start, stop, block), block holding volumes vols[start:stop]
+    '''
+    img = nib.load(bold_file, mmap=True)
+    shape = img.shape[:3]
+    vols = range(img.shape[3]) if vols is None else vols
+
+    vol_bytes = int(np.prod(shape)) * 4
+    chunk = max(1, int(chunk_mb * 2**20 // vol_bytes))
+    starts = range(0, len(vols), chunk)
+
+    image_file = img.file_map['image'].filename
+    if not image_file.endswith(COMPRESSED_EXTS):
+        for i0 in starts:
+            i1 = min(i0 + chunk, len(vols))
+            block = img.dataobj[..., vols[i0]:vols[i1 - 1] + 1:vols.step]
+            yield i0, i1, np.asarray(block, dtype=np.float32)
+        return
+
+    dtype = img.header.get_data_dtype()
+    offset = img.dataobj.offset
+    file_vol_bytes = int(np.prod(shape)) * dtype.itemsize
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+
+    def read(f, t, n):
+        data = array_from_file(shape + (n, ),
+                               dtype,
+                               f,
+                               offset=offset + t * file_vol_bytes,
+                               order='F')
+        return apply_read_scaling(data, slope, inter)
+
+    with ImageOpener(image_file, 'rb') as f:
+        for i0 in starts:
+            i1 = min(i0 + chunk, len(vols))
+            if vols.step == 1:
+                block = read(f, vols[i0], i1 - i0)
+            else:
+                block = np.empty(shape + (i1 - i0, ), dtype=np.float32)
+                for j, t in enumerate(vols[i0:i1]):
+                    block[..., j] = read(f, t, 1)[..., 0]
+            yield i0, i1, np.asarray(block, dtype=np.float32)
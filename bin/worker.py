@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Warm worker serving jobs over a local Unix socket
+
+A worker imports the heavy modules of a script once, then forks a child for
+every job it receives, so jobs start with everything already loaded. A job is
+the command line arguments of the script along with the working directory
+and environment of the submitting process. The output of the job and its
+exit status are sent back to the submitter once it completes.
+
+Run as a script, submits a job to a worker. This only imports the standard
+library, so that submitting does not pay the import cost the worker saves.
+"""
+import os
+import sys
+import argparse
+import json
+import atexit
+import signal
+import socket
+import tempfile
+import traceback
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Submit a job to a warm worker, such as the one of '
+        'confounds.py --serve, and exit with its status')
+    parser.add_argument('socket', type=str, help='Socket of the worker')
+    parser.add_argument('args',
+                        nargs=argparse.REMAINDER,
+                        help='Arguments of the job')
+
+    args = parser.parse_args()
+    sys.exit(submit(args.socket, args.args))
+
+
+def serve(socket_path, run, max_jobs=1):
+    '''
+    Accept jobs on `socket_path` until interrupted, running up to
+    `max_jobs` of them at a time. `run` is called with the arguments of each
+    job in a forked child, and its return value or SystemExit code is the
+    exit status of the job
+    '''
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(max(max_jobs, 1) * 4)
+
+    def _stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _stop)
+
+    children = set()
+    try:
+        while True:
+            while len(children) >= max_jobs:
+                children.discard(os.wait()[0])
+            children -= _reap()
+
+            conn, _ = server.accept()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os._exit(_handle(conn, run))
+            conn.close()
+            children.add(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+def submit(socket_path, argv):
+    '''
+    Run a job on the worker listening on `socket_path` from the current
+    directory and environment, print its output and return its exit status
+    '''
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client, client.makefile('rwb') as f:
+        _send(f, {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)})
+        try:
+            result = _recv(f)
+        except ValueError:
+            sys.stderr.write('Worker exited before completing the job\n')
+            return 1
+
+    sys.stdout.write(result['output'])
+    sys.stdout.flush()
+    return result['returncode']
+
+
+def _reap():
+    done = set()
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return done
+        if pid == 0:
+            return done
+        done.add(pid)
+
+
+def _handle(conn, run):
+    '''
+    Run a single job in the forked child, with its output captured to be
+    sent back along with its exit status. Exit handlers registered by the
+    job run when it completes, those of the worker are left to the worker.
+    '''
+
+    atexit._clear()
+    with conn, conn.makefile('rwb') as f:
+        job = _recv(f)
+        os.environ.clear()
+        os.environ.update(job['env'])
+        os.chdir(job['cwd'])
+        sys.argv = sys.argv[:1] + job['argv']
+
+        with tempfile.TemporaryFile() as log:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            try:
+                returncode = run(job['argv']) or 0
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else int(
+                    e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            log.seek(0)
+            output = log.read().decode(errors='replace')
+
+        _send(f, {'returncode': returncode, 'output': output})
+    return 0
+
+
+def _send(f, message):
+    f.write(json.dumps(message).encode() + b'\n')
+    f.flush()
+
+
+def _recv(f):
+    return json.loads(f.readline())
+
+
+if __name__ == '__main__':
+    main()
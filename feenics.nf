@@ -166,8 +166,6 @@ if (params.preartifact) {
     //Process non-artifacted SPRLS need to corrct PRS
     process transfer_preartifact {
 
-        stageInMode "copy"
-        module 'freesurfer'
         publishDir "$params.out/${params.application}", \
                     mode: 'move',
                     saveAs: { "$sub" }
@@ -182,26 +180,9 @@ if (params.preartifact) {
         '''
         #!/bin/bash
 
-        #GZIP the nii file
-        gzip sprl.nii
-
-        #Fix orientation issue if exists
-        orientation=$(mri_info --orientation sprl.nii.gz)
-
-        if [ "$orientation" = "PRS" ]; then
-
-            fslorient -deleteorient sprl.nii.gz
-
-            fslswapdim sprl.nii.gz -x -y z  sprl.nii.gz
-
-            fslorient -setqformcode 1 sprl.nii.gz
-
-            #Save list of reoriented scans
-            mkdir -p !{params.out}/feenics/
-            reorient_list=!{params.out}/feenics/reoriented.log
-            echo !{sub} >> $reorient_list
-
-        fi
+        #GZIP the nii file, fixing its orientation if stored PRS
+        prepare_spirals.py sprl.nii --threads !{task.cpus} \
+            --subject !{sub} --reorient-log !{params.out}/feenics/reoriented.log
 
         #Set up output directory
         mkdir !{sub}
@@ -233,61 +214,21 @@ sub_channel = input_subs
                          }
 
 /// ARTIFACT STREAM
-//GZIP files
-process gzip_nii {
-
-    stageInMode 'copy'
+//Reorient spirals stored PRS and gzip them, in a single pass over each file
+process prepare_spirals {
 
     input:
     set val(sub), file(sprlIN), file(sprlOUT) from sub_channel
 
     output:
-    set val(sub), file("${sprlIN}.gz"), file("${sprlOUT}.gz") into gzipped_channel
-
-    shell:
-    '''
-    gzip !{sprlIN}
-    gzip !{sprlOUT}
-    '''
-
-}
-
-//Pre-process components with PRS orientation indicating they need to be reoriented
-process reorient_bad {
-
-    module 'freesurfer'
-    module 'FSL/5.0.11'
-    stageInMode 'copy'
-
-    input:
-    set val(sub), file(sprlIN), file(sprlOUT) from gzipped_channel
-
-    output:
-    set val(sub), file(sprlIN), file(sprlOUT) into oriented_subs
+    set val(sub), file("${sprlIN}.gz"), file("${sprlOUT}.gz") into oriented_subs
 
     shell:
     '''
     #!/bin/bash
 
-    orientation=$(mri_info --orientation !{sprlIN})
-
-    if [ "$orientation" = "PRS" ]; then
-
-        fslorient -deleteorient !{sprlIN}
-        fslorient -deleteorient !{sprlOUT}
-
-        fslswapdim !{sprlIN} -x -y z  !{sprlIN}
-        fslswapdim !{sprlOUT} -x -y z !{sprlOUT}
-
-        fslorient -setqformcode 1 !{sprlIN}
-        fslorient -setqformcode 1 !{sprlOUT}
-
-        #Save list of reoriented scans
-        mkdir -p !{params.out}/feenics/
-        reorient_list=!{params.out}/feenics/reoriented.log
-        echo !{sub} >> $reorient_list
-
-    fi
+    prepare_spirals.py !{sprlIN} !{sprlOUT} --threads !{task.cpus} \
+        --subject !{sub} --reorient-log !{params.out}/feenics/reoriented.log
     '''
 
 
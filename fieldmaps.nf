@@ -136,10 +136,9 @@ fieldmap_input = input_subs
                                     ] }
 
 
-// Resample if needed
+// Resample if needed, echoes whose voxel volumes match are left as they are
 process resample {
 
-    stageInMode 'copy'
     module "FSL/5.0.11"
 
     input:
@@ -152,46 +151,7 @@ process resample {
     '''
     #!/bin/bash
 
-    THRES=0.0001
-
-    # Grab info from image 1
-    img1_x=$(fslinfo !{echo1} | grep pixdim1 | awk '{print $2}')
-    img1_y=$(fslinfo !{echo1} | grep pixdim2 | awk '{print $2}')
-    img1_z=$(fslinfo !{echo1} | grep pixdim3 | awk '{print $2}')
-    img1_voxarea=$(echo "$img1_x*$img1_y*$img1_z" | bc -l)
-
-    # Grab info from image 1
-    img2_x=$(fslinfo !{echo2} | grep pixdim1 | awk '{print $2}')
-    img2_y=$(fslinfo !{echo2} | grep pixdim2 | awk '{print $2}')
-    img2_z=$(fslinfo !{echo2} | grep pixdim3 | awk '{print $2}')
-    img2_voxarea=$(echo "$img2_x*$img2_y*$img2_z" | bc -l)
-
-    #Calculate difference
-    diff=$(echo "$img1_voxarea - $img2_voxarea" | bc -l)
-
-    #Check image areas then downsample if needed
-    if (( $(echo "$diff > $THRES" | bc -l) )); then
-        in=!{echo2}
-        ref=!{echo1}
-    elif (( $(echo "$diff < -1*$THRES" | bc -l) )); then
-        in=!{echo1}
-        ref=!{echo2}
-    else
-        exit 0
-    fi
-
-    #Split images then generate transforms
-    fslsplit $in image1_ -t
-    fslsplit $ref image2_ -t
-
-    #Resample image
-    flirt -in image1_0000.nii.gz -ref image2_0000.nii.gz -omat resamp_mat
-
-    #Apply transformation
-    flirt -in $in -ref image2_0000.nii.gz -applyxfm -init resamp_mat -out transformed.nii.gz
-
-    #Replace
-    mv transformed.nii.gz $in
+    resample_echoes.py !{echo1} !{echo2} --threshold 0.0001
     '''
 
 }
@@ -248,44 +208,10 @@ process fieldmaps {
     echo "Using ECHO1 $FM65" >> ${log_out}
     echo "Using ECHO2 $FM85" >> ${log_out}
 
-    ####split (pre) fieldmap files and log
-    (
-    fslsplit ${FM65} split65 -t
-    bet split650000 65mag -R -f 0.5 -m
-    fslmaths split650002 -mas 65mag_mask 65realm
-    fslmaths split650003 -mas 65mag_mask 65imagm
-
-    fslsplit ${FM85} split85 -t
-    bet split850000 85mag -R -f 0.5 -m
-    fslmaths split850002 -mas 85mag_mask 85realm
-    fslmaths split850003 -mas 85mag_mask 85imagm
-
-    ####calc phase difference
-    fslmaths 65realm -mul 85realm realeq1
-    fslmaths 65imagm -mul 85imagm realeq2
-    fslmaths 65realm -mul 85imagm imageq1
-    fslmaths 85realm -mul 65imagm imageq2
-    fslmaths realeq1 -add realeq2 realvol
-    fslmaths imageq1 -sub imageq2 imagvol
-
-    ####create complex image and extract phase and magnitude
-    fslcomplex -complex realvol imagvol calcomplex
-    fslcomplex -realphase calcomplex phasevolume 0 1
-    fslcomplex -realabs calcomplex magnitude 0 1
-
-    ####unwrap phase
-    prelude -a 65mag -p phasevolume -m 65mag_mask -o phasevolume_maskUW
-
-    ####divide by TE diff in seconds -> radians/sec
-    fslmaths phasevolume_maskUW -div 0.002 fieldmap
-
-    ####copy in geometry information
-    fslcpgeom ${FM65} fieldmap.nii.gz -d
-    fslcpgeom ${FM65} magnitude.nii.gz -d
-    ) 2>> ${log_err} 1>> ${log_out}
-
-    ####make a JSON file containing the units
-    echo ' { "Units": "rad/s" } ' > json
+    ####compute phase difference, unwrap and convert to rad/s
+    compute_fieldmap.py ${FM65} ${FM85} --delta-te 0.002 \
+        --fieldmap fieldmap.nii.gz --magnitude magnitude.nii.gz --json json \
+        2>> ${log_err} 1>> ${log_out}
 
     '''
 }
@@ -59,25 +59,33 @@ process publish_pepolar{
     '''
 }
 
+// Staged inputs are a single path when only one file is given
+def as_list(x){
+    return (x instanceof java.nio.file.Path) ? [x] : x.collect{ it }
+}
+
 process gen_pepolar{
 
     /*
-    Extract first volume from BOLD to derived scan for PEPOLAR
+    Extract first volume from all of a subject's BOLD to derived scans for
+    PEPOLAR
     */
 
-    label 'FSL'
-
     input:
-    tuple val(sub), val(ser), path(bold)
+    tuple val(sub), val(series), path(bolds)
 
+    // Series without a JSON sidecar are skipped, so a subject may have none
     output:
-    tuple val(sub), val(ser), path("${sub}_${ser}_boldref.nii.gz"),\
-    emit: boldref
+    tuple val(sub), path("${sub}_*_boldref.nii.gz"),\
+    path("${sub}_*_boldref.json"), optional: true, emit: boldref
 
     shell:
+    pairs = [series, as_list(bolds)].transpose()
+                                    .collect{ser, b -> "${ser}=${b}"}
+                                    .join(" ")
     '''
     #!/bin/bash
-    fslroi !{bold} !{sub}_!{ser}_boldref.nii.gz 0 1
+    extract_boldref.py !{sub} !{pairs} --nprocs !{task.cpus}
     '''
 }
 
@@ -155,23 +163,29 @@ workflow{
 
     main:
     // Generate PEPOLAR from dummy BOLD
+    // One task per subject extracts the first volume of all its BOLD
     i_gen_pepolar = bold_sbref.filter{it[-1].isEmpty()}
                         .map{i,s,ser,d,pe,f ->[i,ser,s]}
+                        .groupTuple(by: 0)
     gen_pepolar(i_gen_pepolar)
+    boldrefs = gen_pepolar.out.boldref
+                    .flatMap{i,refs,jsons ->
+                        [as_list(refs), as_list(jsons)].transpose()
+                            .collect{ref,js -> [
+                                i,
+                                (ref.getName() - "${i}_" - "_boldref.nii.gz")
+                                    .toInteger(),
+                                ref,js
+                            ]}
+                    }
     bold2map = bold_sbref.filter{it[-1].isEmpty()}
                     .map{i,s,ser,d,pe,f ->[
                         i,ser,
                         "${i}_${ser.toString().padLeft(2,'0')}_BOLD2FMAP-${pe}"
                     ]}
-                    .join(gen_pepolar.out.boldref, by: [0,1])
-                    .map{i,ser,n,ref->[
-                        i,ser,ref,n
-                    ]}
-                    .join(i_gen_pepolar, by:[0, 1])
-                    .map{i,ser,ref,n,bold->[
-                        i,ref,
-                        bold.toString().replace(".nii.gz",".json"),
-                        n
+                    .join(boldrefs, by: [0,1])
+                    .map{i,ser,n,ref,js->[
+                        i,ref,js,n
                     ]}
 
 
@@ -4,7 +4,8 @@ usage = file("${workflow.scriptFile.getParent()}/usage/n4_usage")
 bindings = [ "rewrite":"$params.rewrite",
              "bspline":"$params.bspline",
              "niter":"$params.niter",
-             "subjects": "$params.subjects"]
+             "subjects": "$params.subjects",
+             "mask_cache": "$params.mask_cache"]
 engine = new groovy.text.SimpleTemplateEngine()
 toprint = engine.createTemplate(usage.text).make(bindings)
 printhelp = params.help
@@ -32,6 +33,9 @@ process apply_n4{
                 mode: 'copy', \
                 pattern: "${sub}*_corrected.nii.gz", \
                 saveAs: { it.replace("_corrected.nii.gz", "_n4.nii.gz") }
+    publishDir "$params.out/$params.application/$sub", \
+                mode: 'copy', \
+                pattern: "${sub}*_profile.json"
 
 
     input:
@@ -39,13 +43,30 @@ process apply_n4{
 
     output:
     tuple val(sub), path("${sub}*_corrected.nii.gz"), emit: n4
+    tuple val(sub), path("${sub}*_profile.json"), emit: profile
 
     shell:
+    mask_cache = params.mask_cache ? "--mask-cache ${params.mask_cache}" : ""
+    mem = task.memory ? "--mem-gb ${task.memory.toGiga()}" : ""
     '''
     t1=$(basename !{t1})
     sub_w_desc=${t1%.nii.gz}
-    python /scripts/process_file.py !{t1} !{params.bspline} !{params.niter}
-    mv n4_wf/corrected_img/${sub_w_desc}_corrected.nii.gz .
+    python /scripts/process_file.py !{t1} !{params.bspline} !{params.niter} \
+                                    --nprocs !{task.cpus} !{mem} !{mask_cache} \
+                                    --profile-out ${sub_w_desc}_profile.json
+
+    # One output per bspline-<distance>_niter-<iterations> setting, a single
+    # setting keeps the plain name
+    settings=(n4_wf/corrected_img/*/)
+    if [ ${#settings[@]} -eq 1 ]; then
+        mv ${settings[0]}/${sub_w_desc}_corrected.nii.gz .
+    else
+        for d in "${settings[@]}"; do
+            setting=$(basename ${d})
+            mv ${d}/${sub_w_desc}_corrected.nii.gz \
+               ${sub_w_desc}_${setting}_corrected.nii.gz
+        done
+    fi
     '''
 
 }
@@ -8,7 +8,14 @@ bindings = ["fmriprep": params.fmriprep,
             "subjects": params.subjects,
             "rewrite": params.rewrite,
             "fmriprep_img":params.fmriprep_img,
-            "dump_masks":params.dump_masks
+            "dump_masks":params.dump_masks,
+            "resample_cache":params.resample_cache,
+            "index_db":params.index_db,
+            "confound_store":params.confound_store,
+            "qc":params.qc,
+            "profiles":params.profiles,
+            "engine":params.engine,
+            "acompcor_svd":params.acompcor_svd
             ]
 
 toprint = engine.createTemplate(usage.text).make(bindings)
@@ -26,6 +33,31 @@ if (printhelp){
     System.exit(0)
 }
 
+// How confounds are computed, also recorded with each run's outputs so
+// runs computed otherwise are found stale
+confound_settings = "--engine ${params.engine ?: 'nipype'}" +
+                    " --acompcor-svd ${params.acompcor_svd ?: 'full'}"
+
+process index_fmriprep{
+
+    label 'fmriprep'
+
+    input:
+    val(fmriprep)
+
+    output:
+    stdout
+
+    shell:
+    subjects = params.subjects ? "--subjects ${params.subjects}" : ""
+    db = params.index_db ? "--db ${params.index_db}" : ""
+    stale = params.rewrite ? "" : "--stale"
+    '''
+    /scripts/index_fmriprep.py !{fmriprep} !{db} !{subjects} !{stale} \
+                               !{confound_settings}
+    '''
+}
+
 process denoise_image{
 
     label 'fmriprep'
@@ -84,182 +116,168 @@ process gen_confounds{
     label 'fmriprep'
 
     input:
-    tuple val(sub), val(ses),\
+    tuple val(sub),\
     path(t1), path(t1_bm),\
     path(wm), path(csf),\
     path(func), path(func_bm), path(func_json),\
     val(base)
 
     output:
-    tuple val(sub), val(base),  path("${base}_new_confounds.tsv"), emit: confounds
-    tuple val(sub), val(base),  path("${base}_new_confounds.json"), emit: confounds_metadata
-    tuple val(sub), val(base),  path("${base}_wm_roi.nii.gz"), emit: wm
-    tuple val(sub), val(base),  path("${base}_csf_roi.nii.gz"), emit: csf
-    tuple val(sub), val(base),  path("${base}_acc_roi.nii.gz"), emit: acc
+    tuple val(sub), path("*_new_confounds.tsv"), emit: confounds
+    tuple val(sub), path("*_new_confounds.json"), emit: confounds_metadata
+    tuple val(sub), path("*_rois.npz"), emit: rois
+    tuple val(sub), path("${sub}_gen_profile.json"), emit: profile
 
     shell:
+    runs = [as_list(func), as_list(func_bm), as_list(func_json), base]
+                .transpose()
+                .collect{ f,fbm,js,b ->
+                    "--run \$(pwd)/${f} \$(pwd)/${fbm} \$(pwd)/${js} \$(pwd)/${b}"
+                }
+                .join(" ")
+    cache = params.resample_cache ? "--resample-cache ${params.resample_cache}" : ""
+    mem = task.memory ? "--mem-gb ${task.memory.toGiga()}" : ""
     '''
     PYTHONPATH=/scripts
-    /scripts/confounds.py $(pwd)/!{t1} $(pwd)/!{t1_bm} $(pwd)/!{wm} $(pwd)/!{csf} \
-                         $(pwd)/!{func} $(pwd)/!{func_bm} $(pwd)/!{func_json} \
-                         --workdir $(pwd) $(pwd)/!{base}
+    /scripts/batch_confounds.py $(pwd)/!{t1} $(pwd)/!{t1_bm} $(pwd)/!{wm} $(pwd)/!{csf} \
+                                !{runs} --workdir $(pwd) !{cache} \
+                                --nprocs !{task.cpus} !{mem} \
+                                !{confound_settings} \
+                                --profile-out !{sub}_gen_profile.json
     rename 's/_confounds/_new_confounds/g' *confounds*
     '''
 
 }
 
-process update_confounds{
+process finalize_confounds{
 
     label 'fmriprep'
 
     input:
-    tuple val(sub), val(base), val(ses),\
-    path(new_confounds), path(confounds)
+    tuple val(sub),\
+    path(new_confounds), path(new_metadata),\
+    path(confounds), path(metadata)
 
     output:
-    tuple val(sub), val(base), val(ses),\
-    path("${base}_merged_confounds.tsv"), emit: confounds
+    val(sub), emit: done
 
     shell:
+    runs = [as_list(new_confounds), as_list(new_metadata),
+            as_list(confounds), as_list(metadata)]
+                .transpose()
+                .collect{ nc,nm,c,m -> "--run ${nc} ${nm} ${c} ${m}" }
+                .join(" ")
     '''
-    #!/usr/bin/env python
-    import numpy as np
-    import pandas as pd
-
-    # Load in TSV files
-    old_tsv = pd.read_csv("!{confounds}", delimiter="\t")
-    new_tsv = pd.read_csv("!{new_confounds}", delimiter="\t")
-
-    # Calculate derivates and powers
-    deriv_cols = ["white_matter", "csf"]
-    for d in deriv_cols:
-        deriv_name = d + "_derivative1"
-        sq_name = d + "_power2"
-        deriv_sq_name = d + "_derivative1_power2"
-        new_tsv[deriv_name] = new_tsv[d].diff()
-        new_tsv[sq_name] = new_tsv[d] ** 2
-        new_tsv[deriv_sq_name] = new_tsv[deriv_name]**2
-
-    # Rename heads in
-    cols = new_tsv.columns
-    new_tsv.columns = ["{}_fixed".format(c) for c in cols]
-
-    # Drop component based columns in old CSV
-    drop_cols = [c for c in old_tsv.columns if "a_comp_cor" in c.lower()]
-    old_tsv.drop(columns = drop_cols, inplace=True)
-
-    # Drop columns in old tsv
-    old_tsv.drop(columns = cols, inplace=True, errors="ignore")
-    out = old_tsv.merge(new_tsv, left_index=True, right_index=True)
-    out.to_csv("!{base}_merged_confounds.tsv", sep="\\t", index=False)
-
+    /scripts/finalize_confounds.py !{runs} !{confound_settings}
     '''
 }
 
-process dump_masks{
-
-    publishDir path: "$params.dump_masks",\
-               pattern: "*.nii.gz",\
-               mode: 'copy'
+process build_confound_store{
 
+    label 'fmriprep'
 
     input:
-    tuple val(sub), val(base),\
-    path(csf), path(wm), path(acc)
-
-    output:
-    tuple path(csf), path(wm), path(acc)
+    val(subs)
 
     shell:
+    db = params.index_db ? "--db ${params.index_db}" : ""
     '''
-    echo "Dumping !{base} ROIs into !{params.dump_masks}"
+    /scripts/confound_store.py !{params.fmriprep} !{params.confound_store} !{db}
     '''
 }
 
-process update_metadata{
+process confound_qc{
 
     label 'fmriprep'
 
     input:
-    tuple val(sub), val(base), val(ses),\
-    path(new_meta), path(meta)
-
-    output:
-    tuple val(sub), val(base), val(ses),\
-    path("${base}_merged_confounds.json"), emit: metadata
+    val(done)
+    path(rois)
 
     shell:
+    db = params.index_db ? "--db ${params.index_db}" : ""
+    masks = params.dump_masks ? "--masks \$(pwd)" : ""
+    cache = params.resample_cache ? "--resample-cache ${params.resample_cache}" : ""
+    '''
+    /scripts/confound_qc.py !{params.fmriprep} !{params.qc} !{db} !{masks} \
+                            !{cache} --nprocs !{task.cpus}
     '''
-    #!/usr/bin/env python
+}
 
-    import json
+process dump_masks{
 
-    with open("!{meta}", "r") as f:
-        meta = json.load(f)
+    publishDir path: "$params.dump_masks",\
+               pattern: "*_rois.npz",\
+               mode: 'copy'
 
-    with open("!{new_meta}", "r") as f:
-        new_meta = json.load(f)
 
-    # Remove columns being replaced
-    cleaned_meta = {k: v for k,v in meta.items() if not (("a_comp" in k) or ("dropped" in k))}
-    out_meta = {**cleaned_meta, **new_meta}
+    input:
+    tuple val(sub), val(base), path(rois)
+
+    output:
+    path(rois)
 
-    with open("!{base}_merged_confounds.json", "w") as f:
-        json.dump(out_meta, f, indent=2)
+    shell:
+    '''
+    echo "Dumping !{base} ROIs into !{params.dump_masks}"
     '''
 }
 
-process write_to_fmriprep{
-
-    label 'fmriprep'
-    stageInMode 'copy'
-
-    publishDir path: "$params.fmriprep/$sub/$ses/func",\
-               pattern: "*tsv",\
-               saveAs: { f -> "${base}_desc-confounds_fixedregressors.tsv" },\
-               mode: 'copy'
+process dump_profiles{
 
-    publishDir path: "$params.fmriprep/$sub/$ses/func",\
-               pattern: "*json",\
-               saveAs: { f -> "${base}_desc-confounds_fixedregressors.json" },\
+    publishDir path: "$params.profiles",\
+               pattern: "*_profile.json",\
                mode: 'copy'
 
     input:
-    tuple val(sub), val(base), val(ses),\
-    path(confounds), path(metadata)
+    tuple val(sub), path(profile)
 
     output:
-    tuple path(confounds), path(metadata)
+    path(profile)
 
     shell:
     '''
-    echo "Writing confounds to !{params.fmriprep}/!{sub}/!{ses}/func/!{base}_desc-confound_fixedregressors.tsv"
-    echo "Writing confounds to !{params.fmriprep}/!{sub}/!{ses}/func/!{base}_desc-confound_fixedregressors.json"
+    echo "Dumping !{sub} node profile into !{params.profiles}"
     '''
 }
 
+// Staged inputs are a single path when only one file is given
+def as_list(x){
+    return (x instanceof java.nio.file.Path) ? [x] : x.collect{ it }
+}
 
-// Implement logic to filter subjects
-input_channel = Channel.fromPath("$params.fmriprep/sub-*", type: "dir")
-                    .map{ i -> [i.getBaseName(), i] }
-
-// Filter subjects
-if (params.subjects){
-
-    subjects_channel = Channel.fromPath(params.subjects)
-                            .splitText(){it.strip()}
-    input_channel = input_channel.join(subjects_channel)
+// Split a subject-level output back into one item per run
+def per_run(ch, suffix){
+    return ch.flatMap{ sub, fs ->
+        as_list(fs).collect{ f -> [sub, f.getName() - suffix, f] }
+    }
 }
 
+// Group the per-run items of each subject (keyed by subject, with the
+// subject's number of runs in `run_counts`), releasing a subject as soon as
+// all of its runs are in rather than once every subject is done
+def group_runs(ch, run_counts){
+    return ch.combine(run_counts, by: 0)
+             .map{ it -> [groupKey(it[0], it[-1])] + it[1..-2] }
+             .groupTuple(by: 0)
+             .map{ it -> [it[0].getGroupTarget()] + it[1..-1] }
+}
 
-def remove_desc = ~/_desc.*/
-def remove_space = ~/_space-\p{Alnum}+_?/
-def ses_from_bids = ~/(?<=_)ses-.*?(?=_)/
 workflow {
 
+    // Work list of complete runs of the selected subjects, only the ones
+    // whose inputs or settings changed since their confounds were last
+    // written unless everything is to be rewritten
+    index_fmriprep(file(params.fmriprep).toString())
+    runs = index_fmriprep.out.splitCsv(sep: "\t", header: true)
+    run_counts = runs.map{r -> [r.sub, r.base]}
+                     .groupTuple()
+                     .map{sub, bases -> [sub, bases.size()]}
+
     // Structural inputs
-    t1_channel = input_channel.map{i,f -> [i,"$f/anat/${i}_desc-preproc_T1w.nii.gz"]}
-    mask_channel = input_channel.map{i,f -> [i,"$f/anat/${i}_desc-brain_mask.nii.gz"]}
+    anat_channel = runs.map{r -> [r.sub, r.t1w, r.t1w_mask]}.unique()
+    t1_channel = anat_channel.map{sub,t1w,t1w_mask -> [sub,t1w]}
+    mask_channel = anat_channel.map{sub,t1w,t1w_mask -> [sub,t1w_mask]}
 
     // Denoise the image, yielding a denoised T1 unmasked
     i_denoise_image = t1_channel.join(mask_channel)
@@ -272,69 +290,54 @@ workflow {
     // Run fast
     fast(apply_mask.out.masked)
 
-    // There's probably a better way to gather inputs for the confounds file
-
-    // Put together inputs for running confound calculation
-    i_gen_confounds = input_channel
-                        .join(denoise_image.out.denoised)
+    // Put together inputs for running confound calculation, with the
+    // subject-level T1 space work shared across all runs of a subject
+    i_gen_confounds_runs = denoise_image.out.denoised
                         .join(mask_channel)
                         .join(fast.out.tpm)
-                        .map{s,f,t,tbm,wm,csf ->
-                            [ s,f,t,tbm,wm,csf,
-                            file("${f}/ses-*/func/${s}_*space-T1w*{preproc,mask}*.nii.gz")]}
-                        .transpose()
-                        .map{s,f,t,tbm,wm,csf,fmri ->
-                            [s,t,tbm,wm,csf,fmri.getName() - remove_desc, fmri]
-                            }
-                        .groupTuple(by: [0,1,2,3,4,5], size: 2)
-                        .map{sub,t,tbm,wm,csf,k,fmri->
-                            [sub,
-                            (k =~ ses_from_bids)[0],
-                            t,tbm,wm,csf,
-                            fmri.sort{a,b -> b.getBaseName()<=>a.getBaseName()},
-                            k - remove_space].flatten()
-                            }
-                        .map{sub,ses,t,tbm,wm,csf,fmri,fbm,base ->
-                            [
-                                sub,ses,t,tbm,wm,csf,fmri,fbm,
-                                fmri.toString().replaceFirst(/nii.gz/, "json"),
-                                base
-                            ]}
-
-    gen_confounds(i_gen_confounds)
-
-    // Operations to pull off:
-    // 1 - A tag identification mark
-
-    // Next extract the confounds file
-    basenames = i_gen_confounds.map{sub,ses,t,tbm,wm,csf,fmri,fbm,js,base ->
-                                            [sub,base,ses,
-                                            "${params.fmriprep}/${sub}/${ses}/func/"]
-                                   }
-
-    i_update_confounds = basenames.join(gen_confounds.out.confounds, by: [0,1])
-                                  .map{sub,base,ses,funcp,conf ->
-                                  [sub,base,ses,conf,
-                                  "${funcp}/${base}_desc-confounds_regressors.tsv"
-                                  ]}
-    update_confounds(i_update_confounds)
-
-    i_update_metadata = basenames.join(gen_confounds.out.confounds_metadata, by: [0,1])
-                                  .map{sub,base,ses,funcp,meta ->
-                                  [sub,base,ses,meta,
-                                  "${funcp}/${base}_desc-confounds_regressors.json"
-                                  ]}
-    update_metadata(i_update_metadata)
-
-    i_write_to_fmriprep = update_confounds.out.confounds
-                            .join(update_metadata.out.metadata, by: [0,1,2])
-    write_to_fmriprep(i_write_to_fmriprep)
+                        .combine(runs.map{r ->
+                                    [r.sub, file(r.bold), file(r.bold_mask),
+                                    file(r.bold_json), r.base]
+                                 }, by: 0)
+    i_gen_confounds_batch = group_runs(i_gen_confounds_runs, run_counts)
+                        .map{sub,t1,bm,wm,csf,bold,bold_bm,js,base ->
+                            [sub,t1[0],bm[0],wm[0],csf[0],bold,bold_bm,js,base]
+                        }
+    gen_confounds(i_gen_confounds_batch)
+    new_confounds = per_run(gen_confounds.out.confounds, "_new_confounds.tsv")
+    new_metadata = per_run(gen_confounds.out.confounds_metadata,
+                           "_new_confounds.json")
+
+    // Merge the new confounds into fMRIPrep's for all runs of a subject
+    basenames = runs.map{r -> [r.sub, r.base, r.confounds, r.confounds_json]}
+
+    i_finalize_runs = basenames.join(new_confounds, by: [0,1])
+                               .join(new_metadata, by: [0,1])
+                               .map{sub,base,tsv,js,conf,meta ->
+                               [sub,conf,meta,file(tsv),file(js)]}
+    i_finalize_confounds = group_runs(i_finalize_runs, run_counts)
+    finalize_confounds(i_finalize_confounds)
+
+    // Consolidate the confounds of the whole study once all runs are written
+    if (params.confound_store){
+        build_confound_store(finalize_confounds.out.done.collect())
+    }
 
     if (params.dump_masks){
-        i_dump_masks = gen_confounds.out.csf
-                                .join(gen_confounds.out.wm, by: [0,1])
-                                .join(gen_confounds.out.acc, by: [0,1])
-        dump_masks(i_dump_masks)
+        dump_masks(per_run(gen_confounds.out.rois, "_rois.npz"))
+    }
+
+    // Carpet plots of every run once its confounds are written, with the
+    // ROI containers staged in rather than read from the publish directory
+    if (params.qc){
+        qc_rois = params.dump_masks
+                ? gen_confounds.out.rois.map{sub, rois -> rois}.flatten().collect()
+                : Channel.value([])
+        confound_qc(finalize_confounds.out.done.collect(), qc_rois)
+    }
+
+    if (params.profiles){
+        dump_profiles(gen_confounds.out.profile)
     }
 
 }
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from direct import truncated_svd, compute_noise_components
+
+
+def _low_rank(n_times, n_voxels, rank, noise=0., seed=0):
+    '''
+    Time x voxel matrix of `rank` components with decaying weights, plus
+    optional full rank noise
+    '''
+    rng = np.random.RandomState(seed)
+    weights = 2.0**-np.arange(rank)
+    M = (rng.randn(n_times, rank) * weights).dot(rng.randn(rank, n_voxels))
+    return M + noise * rng.randn(n_times, n_voxels)
+
+
+def _assert_matches_svd(M, variance_threshold):
+    u_full, s_full, _ = np.linalg.svd(M, full_matrices=False)
+    u, s = truncated_svd(M, variance_threshold)
+
+    assert np.all(np.isfinite(u))
+    np.testing.assert_allclose(s[:len(s_full)],
+                               s_full,
+                               rtol=0,
+                               atol=1e-6 * s_full[0])
+
+    # Retained components agree up to their sign
+    n = u.shape[1]
+    u_full = u_full[:, :n]
+    sign = np.sign(np.sum(u_full * u, axis=0))
+    np.testing.assert_allclose(u * sign, u_full, rtol=0, atol=1e-8)
+    return n
+
+
+@pytest.mark.parametrize('shape', [(120, 400), (300, 60)])
+@pytest.mark.parametrize('variance_threshold', [0.5, 0.9, 0.99])
+def test_truncated_svd_matches_full_svd(shape, variance_threshold):
+    M = _low_rank(*shape, rank=8, noise=0.01)
+
+    s_full = np.linalg.svd(M, compute_uv=False)
+    cumulative = np.cumsum(s_full**2) / np.sum(s_full**2)
+    expected = int(np.searchsorted(cumulative, variance_threshold) + 1)
+
+    assert _assert_matches_svd(M, variance_threshold) == expected
+    if variance_threshold > 0.5:
+        assert expected > 1
+
+
+@pytest.mark.parametrize('shape', [(120, 400), (300, 60)])
+def test_truncated_svd_rank_deficient(shape):
+    # Asking for all of the variance reaches past the rank of the matrix
+    M = _low_rank(*shape, rank=3)
+    n = _assert_matches_svd(M, 1.0)
+    assert 1 <= n <= 3
+
+
+@pytest.mark.parametrize('shape', [(120, 400), (300, 60)])
+def test_truncated_svd_zero_matrix(shape):
+    u, s = truncated_svd(np.zeros(shape), 0.5)
+    assert u.shape == (shape[0], 0)
+    assert not np.any(s)
+
+
+@pytest.mark.parametrize('n_voxels', [400, 60])
+@pytest.mark.parametrize('level', [0., 1.])
+def test_noise_components_of_flat_signals(n_voxels, level):
+    # ROI voxels all zero (e.g. outside of the brain) or constant
+    rng = np.random.RandomState(0)
+    n_times = 300
+    flat = np.ones((n_voxels, n_times)) * level * rng.rand(n_voxels, 1)
+    components, metadata = compute_noise_components([flat], ['WM'],
+                                                    2.0,
+                                                    svd='truncated')
+    assert np.all(np.isfinite(components))
+    assert components.shape[1] == sum(metadata['retained'])
+
+
+@pytest.mark.parametrize('n_voxels', [400, 60])
+def test_noise_components_truncated_matches_full(n_voxels):
+    ts = _low_rank(n_voxels, 300, rank=8, noise=0.05, seed=1)
+    full, full_meta = compute_noise_components([ts], ['CSF'], 2.0, 0.9)
+    trunc, trunc_meta = compute_noise_components([ts], ['CSF'],
+                                                 2.0,
+                                                 0.9,
+                                                 svd='truncated')
+    assert full_meta['retained'] == trunc_meta['retained']
+    assert full.shape[1] > 1
+    sign = np.sign(np.sum(full * trunc, axis=0))
+    np.testing.assert_allclose(trunc * sign, full, rtol=0, atol=1e-8)
+    np.testing.assert_allclose(trunc_meta['singular_value'],
+                               full_meta['singular_value'],
+                               rtol=0,
+                               atol=1e-6 * full_meta['singular_value'][0])
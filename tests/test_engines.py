@@ -0,0 +1,96 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import confounds
+from benchmark_confounds import make_fixtures
+from roi_pack import ROIPack
+
+try:
+    from niworkflows.interfaces.images import SignalExtraction
+except ImportError:
+    SignalExtraction = None
+
+needs_niworkflows = pytest.mark.skipif(SignalExtraction is None,
+                                       reason='niworkflows is not installed')
+
+INPUTS = ('t1', 't1_mask', 'wm_tpm', 'csf_tpm', 'bold', 'bold_mask',
+          'bold_json')
+
+
+@pytest.fixture(scope='module')
+def outputs(tmpdir_factory):
+    '''
+    Outputs of both engines, and of the truncated aCompCor SVD, on a short
+    synthetic run
+    '''
+    tmpdir = tmpdir_factory.mktemp('engines')
+    fixtures = make_fixtures(str(tmpdir.join('fixtures')),
+                             bold_zoom=4.0,
+                             n_vols=60)
+    args = [fixtures[k] for k in INPUTS]
+
+    workdir = tmpdir.mkdir('work')
+    runs = {
+        'nipype': ['--workdir', str(workdir)],
+        'direct': ['--engine', 'direct'],
+        'truncated': ['--engine', 'direct', '--acompcor-svd', 'truncated']
+    }
+    outbases = {}
+    for name, run_args in runs.items():
+        outbases[name] = str(tmpdir.join(name))
+        confounds.main(args + [outbases[name]] + run_args)
+    return outbases
+
+
+def _read(outbase):
+    with open(f'{outbase}_confounds.json') as f:
+        metadata = json.load(f)
+    return pd.read_csv(f'{outbase}_confounds.tsv', sep='\t'), metadata
+
+
+@needs_niworkflows
+@pytest.mark.parametrize('engine', ['direct', 'truncated'])
+def test_confounds_match(outputs, engine):
+    expected, expected_meta = _read(outputs['nipype'])
+    result, result_meta = _read(outputs[engine])
+
+    assert list(result.columns) == list(expected.columns)
+    assert len(result) == len(expected)
+    assert any(c.startswith('a_comp_cor_') for c in expected.columns)
+
+    for name in ('white_matter', 'csf'):
+        np.testing.assert_allclose(result[name], expected[name], rtol=1e-5)
+
+    # Components agree up to their sign
+    for name in expected.columns.drop(['white_matter', 'csf']):
+        x, y = expected[name].values, result[name].values
+        sign = np.sign(np.dot(x, y))
+        np.testing.assert_allclose(sign * y, x, rtol=0, atol=1e-5)
+
+    # Trailing singular values of the truncated SVD are only accurate
+    # relative to the largest one
+    assert sorted(result_meta) == sorted(expected_meta)
+    largest = max(m['SingularValue'] for m in expected_meta.values())
+    for name, meta in expected_meta.items():
+        assert result_meta[name]['Mask'] == meta['Mask']
+        assert result_meta[name]['Retained'] == meta['Retained']
+        np.testing.assert_allclose(result_meta[name]['SingularValue'],
+                                   meta['SingularValue'],
+                                   rtol=1e-5,
+                                   atol=1e-6 * largest)
+
+
+@needs_niworkflows
+def test_rois_match(outputs):
+    expected = ROIPack(outputs['nipype'] + '_rois.npz')
+    result = ROIPack(outputs['direct'] + '_rois.npz')
+
+    assert result.names == expected.names
+    np.testing.assert_array_equal(result.affine, expected.affine)
+    for name in expected.names:
+        assert expected.mask(name).any()
+        np.testing.assert_array_equal(result.mask(name),
+                                      expected.mask(name))
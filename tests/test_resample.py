@@ -0,0 +1,53 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from resample import _resample_roi, _resample_masked_rois
+
+resampling = pytest.importorskip('nilearn.image')
+
+
+def _grids(seed):
+    '''
+    Random pairs of a fine ROI grid and a coarser, shifted and (every other
+    one) rotated BOLD grid, overlapping only partly
+    '''
+    rng = np.random.RandomState(seed)
+    for k in range(8):
+        src_affine = np.diag(list(rng.uniform(0.8, 1.5, 3)) + [1.])
+        src_affine[:3, 3] = rng.uniform(-5, 5, 3)
+        tgt_affine = np.diag(list(rng.uniform(2, 4, 3)) + [1.])
+        tgt_affine[:3, 3] = rng.uniform(-8, 8, 3)
+        if k % 2:
+            theta = rng.uniform(-.3, .3)
+            c, s = np.cos(theta), np.sin(theta)
+            rotation = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+            tgt_affine[:3, :3] = rotation.dot(tgt_affine[:3, :3])
+        roi = (rng.rand(30, 34, 28) > 0.5).astype(np.uint8)
+        yield (nb.Nifti1Image(roi, src_affine),
+               nb.Nifti1Image(np.zeros((12, 11, 13), np.uint8), tgt_affine))
+
+
+def _nilearn(src, tgt):
+    return np.asanyarray(
+        resampling.resample_to_img(src, tgt,
+                                   interpolation='nearest').dataobj)
+
+
+@pytest.mark.filterwarnings('ignore')
+@pytest.mark.parametrize('seed', [0, 1])
+def test_resample_roi_matches_nilearn(seed):
+    for src, tgt in _grids(seed):
+        out = np.asanyarray(_resample_roi(src, tgt).dataobj)
+        np.testing.assert_array_equal(out, _nilearn(src, tgt))
+
+
+@pytest.mark.filterwarnings('ignore')
+def test_resample_masked_rois_matches_nilearn():
+    rng = np.random.RandomState(2)
+    for src, tgt in _grids(2):
+        mask = rng.rand(*tgt.shape) > 0.3
+        mask_img = nb.Nifti1Image(mask.astype(np.uint8), tgt.affine)
+        out, = _resample_masked_rois([src], mask_img)
+        np.testing.assert_array_equal(
+            np.asanyarray(out.dataobj), _nilearn(src, tgt) * mask)
@@ -0,0 +1,87 @@
+import numpy as np
+import nibabel as nb
+import pytest
+
+from rois import build_rois, ROI_NAMES
+from confounds import ROI_PARAMS
+
+try:
+    from niworkflows.interfaces.utils import TPM2ROI, AddTPMs
+except ImportError:
+    TPM2ROI = AddTPMs = None
+
+needs_niworkflows = pytest.mark.skipif(TPM2ROI is None,
+                                       reason='niworkflows is not installed')
+
+# Settings exercising the thresholds and both kinds of erosion
+OTHER_PARAMS = {
+    'wm': {
+        'erode_mm': 3,
+        'mask_erode_prop': 0.5,
+        'prob_thresh': 0.9
+    },
+    'csf': {
+        'erode_prop': 0.8,
+        'mask_erode_mm': 4
+    },
+    'acc': {
+        'prob_thresh': 0.5
+    }
+}
+
+
+def _head(tmpdir, zooms, seed=0):
+    '''
+    Brain mask and WM/CSF probability maps of an ellipsoidal head, with CSF
+    in its centre and on its surface and a noisy WM shell in between
+    '''
+    rng = np.random.RandomState(seed)
+    shape = tuple(int(f / z) for f, z in zip((140, 160, 130), zooms))
+    affine = np.diag(list(zooms) + [1.])
+    ijk = np.indices(shape).astype(float)
+    r = np.sqrt(sum(((i - (n - 1) / 2.) / (n / 2.2))**2
+                    for i, n in zip(ijk, shape)))
+    mask = r < 1
+    wm = np.clip((0.2 - np.abs(r - 0.55)) / 0.05, 0, 1)
+    csf = np.clip((0.2 - r) / 0.05, 0, 1) + np.clip((r - 0.85) / 0.05, 0, 1)
+    wm = np.clip(wm + 0.05 * rng.randn(*shape), 0, 1) * mask
+    csf = np.clip(csf + 0.05 * rng.randn(*shape), 0, 1) * mask
+
+    files = {}
+    for name, data in (('mask', mask.astype(np.uint8)),
+                       ('wm', wm.astype(np.float32)),
+                       ('csf', csf.astype(np.float32))):
+        files[name] = str(tmpdir.join(name + '.nii.gz'))
+        nb.Nifti1Image(data, affine).to_filename(files[name])
+    return files
+
+
+def _tpm2roi(tpm, mask, params):
+    roi_file = TPM2ROI(in_tpm=tpm, in_mask=mask,
+                       **params).run().outputs.roi_file
+    return np.asanyarray(nb.load(roi_file).dataobj)
+
+
+@needs_niworkflows
+@pytest.mark.parametrize('zooms', [(2., 2., 2.), (2.5, 2., 3.)])
+@pytest.mark.parametrize('roi_params', [ROI_PARAMS, OTHER_PARAMS])
+def test_build_rois_matches_tpm2roi(tmpdir, zooms, roi_params):
+    tmpdir.chdir()
+    f = _head(tmpdir, zooms)
+
+    acc_tpm = AddTPMs(in_files=[f['wm'], f['csf']],
+                      indices=[0, 1]).run().outputs.out_file
+    expected = {
+        'wm': _tpm2roi(f['wm'], f['mask'], roi_params['wm']),
+        'csf': _tpm2roi(f['csf'], f['mask'], roi_params['csf']),
+        'acc': _tpm2roi(acc_tpm, f['mask'], roi_params['acc'])
+    }
+
+    mask_img = nb.load(f['mask'])
+    rois = build_rois(np.asanyarray(mask_img.dataobj),
+                      nb.load(f['wm']).get_fdata(),
+                      nb.load(f['csf']).get_fdata(),
+                      mask_img.header.get_zooms()[:3], roi_params)
+    for name in ROI_NAMES:
+        assert expected[name].any()
+        np.testing.assert_array_equal(rois[name], expected[name])
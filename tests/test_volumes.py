@@ -0,0 +1,76 @@
+import gzip
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from volumes import iter_volume_blocks
+from direct import read_roi_timeseries
+
+
+@pytest.fixture
+def series(tmpdir):
+    '''
+    A scaled int16 series written uncompressed and gzipped, with its data
+    '''
+    rng = np.random.RandomState(0)
+    data = (rng.rand(10, 12, 8, 40) * 1000).astype(np.int16)
+    img = nb.Nifti1Image(data, np.eye(4))
+    img.header.set_slope_inter(0.5, 3)
+    files = {}
+    for ext in ('.nii', '.nii.gz'):
+        files[ext] = str(tmpdir.join('bold' + ext))
+        img.to_filename(files[ext])
+    return files, nb.load(files['.nii']).get_fdata().astype(np.float32)
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('vols', [None, range(0, 40, 3), range(5, 37, 7)])
+def test_blocks_match_nibabel(series, ext, vols):
+    files, data = series
+    vols = range(40) if vols is None else vols
+
+    # Blocks of 3 volumes, so every series spans several of them
+    blocks = list(iter_volume_blocks(files[ext], vols, chunk_mb=0.011))
+    assert len(blocks) > 1
+    assert [b[0] for b in blocks] == list(range(0, len(vols), 3))
+    out = np.concatenate([b for _, _, b in blocks], axis=3)
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out, data[..., vols.start:vols.stop:
+                                            vols.step])
+
+
+@pytest.mark.parametrize('vols', [None, range(0, 40, 3)])
+def test_gzip_read_in_a_single_pass(series, monkeypatch, vols):
+    files, _ = series
+    positions = []
+    seek = gzip.GzipFile.seek
+
+    def record(self, offset, whence=0):
+        pos = seek(self, offset, whence)
+        positions.append(pos)
+        return pos
+
+    monkeypatch.setattr(gzip.GzipFile, 'seek', record)
+    for _ in iter_volume_blocks(files['.nii.gz'], vols, chunk_mb=0.011):
+        pass
+    assert positions
+    assert positions == sorted(positions)
+
+
+def test_roi_timeseries_of_compressed_series(series):
+    files, data = series
+    rng = np.random.RandomState(1)
+    rois = [rng.rand(*data.shape[:3]) > p for p in (0.5, 0.8)]
+
+    expected = [data[roi] for roi in rois]
+    for ext in ('.nii', '.nii.gz'):
+        timeseries, global_signal = read_roi_timeseries(files[ext],
+                                                        rois,
+                                                        n_global=10,
+                                                        chunk_mb=0.011)
+        for ts, exp in zip(timeseries, expected):
+            np.testing.assert_array_equal(ts, exp)
+        np.testing.assert_allclose(global_signal,
+                                   data[..., :10].mean(axis=(0, 1, 2)),
+                                   rtol=1e-6)